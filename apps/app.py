@@ -1,14 +1,17 @@
 from flask import Flask
 from playhouse.flask_utils import FlaskDB
 
-from apps.models import mysql_database
-from apps.shipments.views import order_bp, track_bp, exception_bp
+from apps import idgen
+from apps.models import database
+from apps.shipments.views import order_bp, track_bp, exception_bp, system_bp
 
 
 def create_app():
+    # worker id 缺失时在启动阶段报错 而不是在第一次生成id的请求里
+    idgen.check()
     app = Flask(__name__)
 
-    FlaskDB(app, mysql_database)
+    FlaskDB(app, database)
     init_routes(app)
 
     return app
@@ -18,6 +21,7 @@ def init_routes(app):
     app.register_blueprint(order_bp, url_prefix="/shipments")
     app.register_blueprint(track_bp, url_prefix="/shipments")
     app.register_blueprint(exception_bp, url_prefix="/shipments")
+    app.register_blueprint(system_bp, url_prefix="/shipments")
 
 
 app = create_app()
\ No newline at end of file
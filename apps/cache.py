@@ -0,0 +1,237 @@
+"""
+cache.py模块
+    读穿(read-through)缓存 LRU + TTL
+    存储后端按环境变量选择(create_backend):
+        未配置 CACHE_REDIS_URL 时用进程内的 LocalBackend: 失效只作用于执行写操作的进程,
+            多个web worker和命令行任务之间互相看不到对方的失效, 只能靠较短的TTL兜底
+        配置 CACHE_REDIS_URL 时用 RedisBackend(需要安装 redis): 所有进程共用同一份缓存和失效
+    每个key有一个代数 失效时加一; 未命中时先记下代数再加载, 只有代数没变才写回,
+    避免加载期间有写操作提交并失效后 旧值又被写回缓存直到TTL到期
+"""
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class CacheBackend:
+    """缓存存储后端接口"""
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """取值 不存在或已过期时返回None"""
+        raise NotImplementedError
+
+    def set(self, key: Hashable, value: Any, ttl: float):
+        """写入 ttl秒后过期"""
+        raise NotImplementedError
+
+    def delete(self, key: Hashable):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def generation(self, key: Hashable) -> int:
+        """key当前的代数 从未失效过时为0"""
+        raise NotImplementedError
+
+    def set_if_generation(self, key: Hashable, value: Any, ttl: float, generation: int) -> bool:
+        """key的代数仍等于 generation 时才写入(原子操作) 返回是否写入"""
+        raise NotImplementedError
+
+    def invalidate(self, key: Hashable):
+        """删除key并把它的代数加一 正在加载的旧值不会再被写入"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """后端自身的统计(容量/淘汰次数等) 没有时返回空字典"""
+        return {}
+
+
+class LocalBackend(CacheBackend):
+    """进程内 LRU + TTL 存储 超出容量时淘汰最久未使用的条目"""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (过期时间, 值)
+        # key -> 代数 同样按LRU限制在 maxsize 个; 被淘汰的代数回到0, 只会让加载中的值不写入(不会写入旧值)
+        # 除非同一次加载期间又有 maxsize 个其他key失效
+        self._generations = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0  # 因容量淘汰的次数
+        self.expirations = 0  # 因过期丢弃的次数
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def _set(self, key, value, ttl):
+        # 调用方持有 self._lock
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def set_if_generation(self, key, value, ttl, generation):
+        with self._lock:
+            if self._generations.get(key, 0) != generation:
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._generations.move_to_end(key)
+            while len(self._generations) > self.maxsize:
+                self._generations.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class RedisBackend(CacheBackend):
+    """
+    Redis 存储 所有进程共用 值用 pickle 序列化
+    代数存在 <key>:gen 里, 过期时间是 GENERATION_TTL(远大于一次加载的耗时) 不会无限增长
+    """
+
+    GENERATION_TTL = 3600
+
+    # 代数没变时才写入
+    SET_IF_SCRIPT = """
+    if (redis.call('GET', KEYS[2]) or '0') == ARGV[3] then
+        redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+        return 1
+    end
+    return 0
+    """
+    # 删除值并把代数加一
+    INVALIDATE_SCRIPT = """
+    redis.call('DEL', KEYS[1])
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[1])
+    return 1
+    """
+
+    def __init__(self, url: str, namespace: str = "cache:"):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self.namespace = namespace
+        self._set_if = self._redis.register_script(self.SET_IF_SCRIPT)
+        self._invalidate = self._redis.register_script(self.INVALIDATE_SCRIPT)
+
+    def _keys(self, key) -> list:
+        name = f"{self.namespace}{key}"
+        return [name, name + ":gen"]
+
+    def get(self, key):
+        value = self._redis.get(self._keys(key)[0])
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        self._redis.set(self._keys(key)[0], pickle.dumps(value), px=int(ttl * 1000))
+
+    def delete(self, key):
+        self._redis.delete(self._keys(key)[0])
+
+    def clear(self):
+        for name in self._redis.scan_iter(match=f"{self.namespace}*"):
+            self._redis.delete(name)
+
+    def generation(self, key):
+        return int(self._redis.get(self._keys(key)[1]) or 0)
+
+    def set_if_generation(self, key, value, ttl, generation):
+        return bool(self._set_if(keys=self._keys(key), args=[pickle.dumps(value), int(ttl * 1000), generation]))
+
+    def invalidate(self, key):
+        self._invalidate(keys=self._keys(key), args=[self.GENERATION_TTL])
+
+    def stats(self) -> dict:
+        return {"shared": True}
+
+
+def create_backend(maxsize: int) -> CacheBackend:
+    """按环境变量 CACHE_REDIS_URL 创建存储后端 未配置时用进程内的 LocalBackend(maxsize)"""
+    url = os.getenv("CACHE_REDIS_URL")
+    if url:
+        return RedisBackend(url)
+    return LocalBackend(maxsize)
+
+
+class ReadThroughCache:
+    """读穿缓存 未命中时调用loader加载并写回后端 统计命中/未命中次数"""
+
+    def __init__(self, backend: CacheBackend, ttl: float, prefix: str = ""):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    def get(self, key, loader: Callable[[], Any]):
+        """
+        取缓存 未命中时调用 loader() 加载
+        loader 抛出的异常(如记录不存在)直接向上抛出 不写入缓存
+        加载期间key被失效过时(代数变了) 只返回加载到的值 不写回缓存
+        """
+        value = self.backend.get(self._key(key))
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+        with self._lock:
+            self.misses += 1
+        generation = self.backend.generation(self._key(key))
+        value = loader()
+        self.backend.set_if_generation(self._key(key), value, self.ttl, generation)
+        return value
+
+    def invalidate(self, *keys):
+        """写操作提交后让对应的缓存失效"""
+        for key in keys:
+            self.backend.invalidate(self._key(key))
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "ttl": self.ttl, **self.backend.stats()}
@@ -0,0 +1,253 @@
+"""
+events.py模块
+    轨迹节点变更事件的发布/订阅 通过SSE(text/event-stream)推送给审核页面, 代替定时轮询待审核列表
+    事件只携带受影响的订单号, 客户端收到后只刷新这些订单
+
+    事件类型:
+        node.pending    新节点进入待审核(轨迹入库任务)
+        node.reviewed   节点人工审核完成(单个/批量审核)
+        node.accepted   待审核节点按阈值自动采纳
+        node.added      人工添加节点
+        reset           客户端的 Last-Event-ID 已超出回放范围(或服务重启) 需要整页刷新
+
+    代理(Broker)按环境变量选择:
+        未配置 EVENTS_REDIS_URL 时用 LocalBroker, 只在当前进程内分发: 只适合单进程部署和本地开发,
+            轨迹入库/自动采纳是独立的命令行进程, 它们发布的 node.pending / node.accepted 在这种模式下送不到任何SSE连接,
+            多个web worker时每个worker也只能收到自己处理的审核请求产生的事件
+        配置 EVENTS_REDIS_URL 时用 RedisBroker(需要安装 redis): 所有进程把事件写进同一个 Redis Stream,
+            每个web进程一个后台线程读取后分发给本进程的SSE连接, 上面所有事件类型都能送达
+    也可以实现 Broker 接口并调用 configure() 替换
+
+    每个SSE连接只是一个等待条件变量的生成器, 不占用数据库连接(RedisBroker 下也不占用Redis连接);
+    大量空闲连接需要协程worker: 用仓库根目录的 gunicorn.conf.py(gunicorn -k gevent) 运行,
+    threading 的等待会被打补丁为协程切换, 不需要每个连接一个线程; Flask 自带的开发服务器不适合
+"""
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import List, NamedTuple, Optional
+
+NODE_PENDING = "node.pending"
+NODE_REVIEWED = "node.reviewed"
+NODE_ACCEPTED = "node.accepted"
+NODE_ADDED = "node.added"
+RESET = "reset"
+
+# 没有事件时发送心跳注释的间隔(秒) 防止代理/负载均衡断开空闲连接
+HEARTBEAT_SECONDS = 15
+# 客户端断线后的重连间隔(毫秒)
+RETRY_MILLISECONDS = 3000
+
+
+class Event(NamedTuple):
+    id: int
+    type: str
+    data: dict
+
+
+class Broker:
+    """事件代理接口"""
+
+    def publish(self, event_type: str, data: dict) -> int:
+        """发布事件 返回事件id"""
+        raise NotImplementedError
+
+    @property
+    def last_id(self) -> int:
+        """最新事件的id 还没有事件时为0"""
+        raise NotImplementedError
+
+    def replay(self, after: int) -> Optional[List[Event]]:
+        """id大于after的事件 after已经超出保留范围时返回None"""
+        raise NotImplementedError
+
+    def wait(self, after: int, timeout: float) -> List[Event]:
+        """等待id大于after的事件 超时返回空列表"""
+        raise NotImplementedError
+
+
+class LocalBroker(Broker):
+    """进程内代理 保留最近 maxlen 个事件用于断线重连时回放"""
+
+    def __init__(self, maxlen: int = 1000):
+        self._events = deque(maxlen=maxlen)
+        self._last_id = 0
+        self._cond = threading.Condition()
+
+    def publish(self, event_type, data):
+        with self._cond:
+            return self._append(Event(self._last_id + 1, event_type, data))
+
+    def _append(self, event: Event) -> int:
+        # 调用方持有 self._cond
+        self._last_id = event.id
+        self._events.append(event)
+        self._cond.notify_all()
+        return event.id
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def _after(self, after: int) -> List[Event]:
+        # 事件id连续 直接按偏移切片
+        if not self._events:
+            return []
+        start = max(after - self._events[0].id + 1, 0)
+        return list(itertools.islice(self._events, start, None))
+
+    def replay(self, after):
+        with self._cond:
+            oldest = self._events[0].id if self._events else self._last_id + 1
+            if after > self._last_id or after < oldest - 1:
+                return None
+            return self._after(after)
+
+    def wait(self, after, timeout):
+        with self._cond:
+            if self._last_id <= after:
+                self._cond.wait(timeout)
+            return self._after(after)
+
+
+class RedisBroker(LocalBroker):
+    """
+    跨进程代理 事件写入 Redis Stream(保留最近 maxlen 个)
+    发布方只写 Redis; 读取方(web进程)第一次使用时启动一个后台线程阻塞读取 stream,
+    读到的事件放进本地缓冲 由 LocalBroker 的逻辑分发给本进程的SSE连接和处理回放
+    """
+
+    # 用计数器分配连续的事件id并写入 stream, 多个进程同时发布时id仍然连续递增
+    PUBLISH_SCRIPT = """
+    local id = redis.call('INCR', KEYS[2])
+    redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], id .. '-0', 'type', ARGV[1], 'data', ARGV[2])
+    return id
+    """
+
+    def __init__(self, url: str, key: str = "shipments:events", maxlen: int = 1000):
+        import redis
+
+        super().__init__(maxlen)
+        self._redis = redis.Redis.from_url(url)
+        self._key = key
+        self._maxlen = maxlen
+        self._script = self._redis.register_script(self.PUBLISH_SCRIPT)
+        self._listener_pid = None  # 启动后台读取线程的进程 fork 之后需要在子进程里重新启动
+
+    def publish(self, event_type, data):
+        data = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        return int(self._script(keys=[self._key, self._key + ":id"], args=[event_type, data, self._maxlen]))
+
+    @property
+    def last_id(self):
+        self._listen()
+        return self._last_id
+
+    def replay(self, after):
+        self._listen()
+        return super().replay(after)
+
+    def wait(self, after, timeout):
+        self._listen()
+        return super().wait(after, timeout)
+
+    def _listen(self):
+        """当前进程还没有后台读取线程时 载入最近的事件并启动线程"""
+        if self._listener_pid == os.getpid():
+            return
+        with self._cond:
+            if self._listener_pid == os.getpid():
+                return
+            self._events.clear()
+            entries = self._redis.xrevrange(self._key, count=self._maxlen)
+            # stream 为空时从计数器取最新的id
+            self._last_id = 0 if entries else int(self._redis.get(self._key + ":id") or 0)
+            for entry in reversed(entries):
+                self._receive(entry)
+            self._listener_pid = os.getpid()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        import redis
+
+        while True:
+            try:
+                streams = self._redis.xread({self._key: f"{self._last_id}-0"}, block=HEARTBEAT_SECONDS * 1000)
+            except redis.RedisError:
+                time.sleep(1)
+                continue
+            with self._cond:
+                for _, entries in streams or []:
+                    for entry in entries:
+                        self._receive(entry)
+
+    def _receive(self, entry):
+        # 调用方持有 self._cond
+        entry_id, fields = entry
+        event_id = int(entry_id.split(b"-")[0])
+        if event_id <= self._last_id:
+            return
+        if self._events and event_id != self._last_id + 1:
+            # 读取中断期间错过的事件已被裁剪: 清空缓冲 早于这里的 Last-Event-ID 会收到 reset
+            self._events.clear()
+        self._append(Event(event_id, fields[b"type"].decode(), json.loads(fields[b"data"])))
+
+
+def create_broker() -> Broker:
+    """按环境变量 EVENTS_REDIS_URL 创建代理 未配置时只在进程内分发"""
+    url = os.getenv("EVENTS_REDIS_URL")
+    if url:
+        return RedisBroker(url)
+    return LocalBroker()
+
+
+broker: Broker = create_broker()
+
+
+def configure(new_broker: Broker):
+    """替换事件代理(应用启动时调用)"""
+    global broker
+    broker = new_broker
+
+
+def publish(event_type: str, order_codes, **data) -> Optional[int]:
+    """发布节点变更事件 应在事务提交之后调用; 没有受影响的订单时不发布"""
+    order_codes = sorted(set(order_codes))
+    if not order_codes:
+        return None
+    return broker.publish(event_type, {"orderCodes": order_codes, **data})
+
+
+def format_event(event: Event) -> str:
+    """编码为SSE消息"""
+    data = json.dumps(event.data, ensure_ascii=False, separators=(",", ":"))
+    return f"id: {event.id}\nevent: {event.type}\ndata: {data}\n\n"
+
+
+def stream(last_event_id: int = None):
+    """
+    SSE消息生成器
+    带 Last-Event-ID 重连时先回放错过的事件, 无法回放时发送 reset 让客户端整页刷新
+    """
+    yield f"retry: {RETRY_MILLISECONDS}\n\n"
+    after = broker.last_id
+    if last_event_id is not None:
+        missed = broker.replay(last_event_id)
+        if missed is None:
+            yield format_event(Event(after, RESET, {}))
+        else:
+            after = last_event_id
+            for event in missed:
+                yield format_event(event)
+                after = event.id
+    while True:
+        events = broker.wait(after, HEARTBEAT_SECONDS)
+        if not events:
+            yield ": heartbeat\n\n"
+            continue
+        for event in events:
+            yield format_event(event)
+            after = event.id
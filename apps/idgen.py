@@ -0,0 +1,100 @@
+"""
+idgen.py模块
+    Snowflake 风格的64位唯一id 不需要访问数据库
+    | 1位保留 | 41位毫秒时间戳(自 EPOCH 起 约69年) | 10位 worker id | 12位序列号 |
+    同一进程内严格递增; 不同进程只要 worker id 不同就不会重复
+
+    worker id 必须在所有同时生成id的进程(跨主机/容器)之间唯一:
+        单进程部署: 环境变量 ID_WORKER_ID(0~1023) 每个主机/容器一个不同的值
+        预fork的多进程部署: fork 出的子进程不能沿用父进程的 ID_WORKER_ID, 必须在 fork 之后调用 configure(),
+            gunicorn 见仓库根目录的 gunicorn.conf.py: ID_WORKER_ID 作为该主机的起始值, 每个 worker 取 起始值 + 槽位号
+    两者都没有时生成id会报错(不再回退到进程号: 不同容器的进程号经常相同); 应用启动时 check() 提前报错
+
+    多进程压测(fork 出多个 worker id 不同的进程 校验没有重复)见 tests/test_idgen.py
+"""
+import os
+import threading
+import time
+
+# 2024-01-01 00:00:00 UTC
+EPOCH = 1704067200000
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class SnowflakeGenerator:
+    """单个进程内的id生成器 线程安全"""
+
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be in [0, {MAX_WORKER_ID}]: {worker_id}")
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last = 0  # 上一个id使用的时间戳(毫秒 相对EPOCH)
+        self._sequence = 0
+
+    def next_id(self) -> int:
+        with self._lock:
+            now = time.time_ns() // 1_000_000 - EPOCH
+            if now > self._last:
+                self._last, self._sequence = now, 0
+            else:
+                # 同一毫秒内 或系统时钟回拨: 沿用上一个时间戳继续递增序列, 序列用完时借用下一毫秒
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last, self._sequence = self._last + 1, 0
+            return (self._last << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+def default_worker_id() -> int:
+    """从环境变量 ID_WORKER_ID 取 worker id 未配置或当前进程是fork出的子进程时报错"""
+    value = os.environ.get("ID_WORKER_ID")
+    if value is None:
+        raise RuntimeError("ID_WORKER_ID is not set: every process that generates ids needs a unique worker id")
+    if _forked:
+        raise RuntimeError("forked process must call idgen.configure() with its own worker id "
+                           "instead of inheriting ID_WORKER_ID from its parent")
+    return int(value)
+
+
+_generator = None
+_forked = False  # 当前进程是否由已导入本模块的进程fork而来
+_init_lock = threading.Lock()
+
+
+def configure(worker_id: int):
+    """显式指定当前进程的 worker id(同时生成id的进程之间必须不同)"""
+    global _generator
+    _generator = SnowflakeGenerator(worker_id)
+
+
+def check():
+    """确认当前进程能取得 worker id 应用启动时调用 配置缺失时立即报错而不是在第一次生成id时"""
+    _get_generator()
+
+
+def _get_generator() -> SnowflakeGenerator:
+    global _generator
+    if _generator is None:
+        with _init_lock:
+            if _generator is None:
+                _generator = SnowflakeGenerator(default_worker_id())
+    return _generator
+
+
+def _after_fork():
+    """子进程不能沿用父进程的 worker id 和序列 否则会和父进程生成相同的id"""
+    global _generator, _forked
+    _generator = None
+    _forked = True
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def next_id() -> int:
+    """生成一个新的id"""
+    return _get_generator().next_id()
+
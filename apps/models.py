@@ -1,10 +1,161 @@
 """
 数据库模型类
 """
+import os
+import threading
 
 from peewee import *
+from playhouse.pool import PooledMySQLDatabase, PooledSqliteDatabase
+from playhouse.shortcuts import ReconnectMixin
 
-mysql_database = MySQLDatabase('jcs', **{'charset': 'utf8', 'sql_mode': 'PIPES_AS_CONCAT', 'use_unicode': True, 'host': 'localhost', 'user': 'root', 'password': 'root'})
+# 数据库配置 从环境变量读取
+DATABASE_CONFIG = {
+    "engine": os.getenv("DB_ENGINE", "mysql"),  # mysql / sqlite(本地测试用)
+    "name": os.getenv("DB_NAME", "jcs"),
+    "host": os.getenv("DB_HOST", "localhost"),
+    "port": int(os.getenv("DB_PORT", "3306")),
+    "user": os.getenv("DB_USER", "root"),
+    "password": os.getenv("DB_PASSWORD", ""),
+    # 连接池配置
+    "pool": os.getenv("DB_POOL", "1") == "1",
+    "max_connections": int(os.getenv("DB_MAX_CONNECTIONS", "20")),  # 最大连接数
+    "stale_timeout": int(os.getenv("DB_STALE_TIMEOUT", "300")),  # 连接空闲超过该秒数后丢弃重建
+    "timeout": int(os.getenv("DB_POOL_TIMEOUT", "10")),  # 连接池满时等待空闲连接的秒数
+}
+
+
+class PoolStatsMixin:
+    """连接池统计 使用中/空闲连接数 以及因连接池已满而需要等待的次数"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self._stats_lock = threading.Lock()
+
+    def connect(self, reuse_if_open=False):
+        if self.is_closed() and self._max_connections and len(self._in_use) >= self._max_connections:
+            with self._stats_lock:
+                self.waits += 1
+        return super().connect(reuse_if_open)
+
+    def pool_stats(self) -> dict:
+        return {
+            "pooled": True,
+            "maxConnections": self._max_connections,
+            "inUse": len(self._in_use),
+            "idle": len(self._connections),
+            "waits": self.waits,
+        }
+
+
+class ReconnectPooledMySQLDatabase(ReconnectMixin, PoolStatsMixin, PooledMySQLDatabase):
+    """MySQL连接池 取出连接时ping检查 执行中遇到断开的连接时自动重连"""
+    pass
+
+
+class StatsPooledSqliteDatabase(PoolStatsMixin, PooledSqliteDatabase):
+    """SQLite连接池 用于本地测试"""
+    pass
+
+
+def create_database(config: dict) -> Database:
+    """按配置创建数据库对象"""
+    pool_kwargs = {
+        "max_connections": config["max_connections"],
+        "stale_timeout": config["stale_timeout"],
+        "timeout": config["timeout"],
+    }
+    if config["engine"] == "sqlite":
+        if config["pool"]:
+            return StatsPooledSqliteDatabase(config["name"], **pool_kwargs)
+        return SqliteDatabase(config["name"])
+
+    mysql_kwargs = {
+        "charset": "utf8", "sql_mode": "PIPES_AS_CONCAT", "use_unicode": True,
+        "host": config["host"], "port": config["port"], "user": config["user"], "password": config["password"],
+    }
+    if config["pool"]:
+        return ReconnectPooledMySQLDatabase(config["name"], **pool_kwargs, **mysql_kwargs)
+    return MySQLDatabase(config["name"], **mysql_kwargs)
+
+
+def database_stats() -> dict:
+    """数据库连接池统计 未启用连接池时只返回 pooled=False"""
+    if isinstance(database, PoolStatsMixin):
+        return database.pool_stats()
+    return {"pooled": False}
+
+
+def conflict_target(*fields) -> list:
+    """
+    upsert(insert ... on_conflict)的冲突列
+    MySQL的 ON DUPLICATE KEY 按唯一索引判断 不允许指定冲突列; SQLite等需要显式指定
+    """
+    if fields and isinstance(fields[0].model._meta.database, MySQLDatabase):
+        return None
+    return list(fields)
+
+
+def lock_rows(query):
+    """
+    SELECT ... FOR UPDATE 锁住读到的行直到事务结束 用于"先读再按读到的值改"的写路径
+    SQLite不支持行锁(写事务本身整库串行) 原样返回
+    """
+    if query.model._meta.database.for_update:
+        return query.for_update()
+    return query
+
+
+# 单条批量insert语句的参数个数上限(SQLite 3.32+ 为32766; MySQL受 max_allowed_packet 限制)
+BULK_INSERT_MAX_PARAMS = 30000
+
+
+def bulk_insert(model, fields: list, rows: list, adapt: bool = True, **on_conflict):
+    """
+    批量insert(可带 on_conflict upsert)
+    SQL由 insert_many(...).on_conflict(...) 只针对第一行生成一次, 再把 VALUES 的占位符组复制成多行,
+    省去peewee为每个值构造SQL节点的开销(万行级别时这部分开销远大于数据库本身)
+    语句经 database.execute_sql 执行 连接断开时的自动重连(ReconnectMixin)仍然生效
+    rows: 与 fields 顺序一致的元组列表
+    adapt: 是否用字段的 db_value 转换参数 值已经是校验过的Python类型时可以关掉
+    """
+    if not rows:
+        return
+    database = model._meta.database
+    query = model.insert_many(rows[:1], fields=fields)
+    if on_conflict:
+        query = query.on_conflict(**on_conflict)
+    sql, params = query.sql()
+    # 第一行的占位符组 之前是表名和列名 之后是 on_conflict 部分(其参数在 params 里排在第一行之后)
+    group = "(" + ", ".join([database.param] * len(fields)) + ")"
+    head, tail = sql.split(group, 1)
+    tail_params = params[len(fields):]
+    if adapt:
+        converters = [field.db_value for field in fields]
+        rows = [tuple(convert(value) for convert, value in zip(converters, row)) for row in rows]
+    per_statement = max(1, BULK_INSERT_MAX_PARAMS // len(fields))
+    for i in range(0, len(rows), per_statement):
+        chunk = rows[i:i + per_statement]
+        values = [value for row in chunk for value in row]
+        database.execute_sql(head + ", ".join([group] * len(chunk)) + tail, values + tail_params)
+
+
+database = create_database(DATABASE_CONFIG)
+
+
+class LazyBlobField(BlobField):
+    """
+    写入时才向数据库驱动取二进制类型的 BlobField
+    peewee 的 BlobField 在绑定数据库时(即导入模型时)就取 pymysql.Binary, 没有安装MySQL驱动时导入模型会失败
+    """
+
+    def _db_hook(self, database):
+        self._binary_database = database
+        self._constructor = self._binary
+
+    def _binary(self, value: bytes):
+        database = self._binary_database
+        return (bytearray if database is None else database.get_binary_type())(value)
 
 
 # 定义一个基础模型类，继承自Model
@@ -13,7 +164,7 @@ class BaseModel(Model):
 
     class Meta:
         # 设置数据库连接，指向之前定义的database对象
-        database = mysql_database
+        database = database
 
 
 class ShipmentOrderInfo(BaseModel):
@@ -47,23 +198,57 @@ class ShipmentOrderInfo(BaseModel):
     super_product_fee = DecimalField(null=True)
     deduction = DecimalField(null=True)
     shipping_date = DateTimeField(null=True)
-    departure_date = DateTimeField(null=True)
+    departure_date = DateTimeField(null=True, index=True)  # SLA 增量检测按日期范围查找 (apps.shipments.sla)
     port_arrival_date = DateTimeField(null=True)
-    delivery_date = DateTimeField(null=True)
+    delivery_date = DateTimeField(null=True, index=True)
     shipping_status = CharField(constraints=[SQL("DEFAULT '待发货'")], null=True)
     signed_date = DateTimeField(null=True)
     signed_num = IntegerField(constraints=[SQL("DEFAULT 0")], null=True)
     shelved_time = DateTimeField(null=True)
-    total_track = TextField(null=True)
-    tracking_history = TextField(null=True)
-    latest_track_time = DateTimeField(null=True)
+    # 头程完整轨迹/轨迹历史 压缩后存在 ShipmentOrderTrackBlob 里 只在需要时加载(见 apps.shipments.blobs)
+    latest_track_time = DateTimeField(null=True, index=True)
+    pending_count = IntegerField(constraints=[SQL("DEFAULT 0")], index=True)  # 待审核(PENDING)节点数 由 apps.shipments.pending 维护
     remark = TextField(null=True)
     is_exception = IntegerField(constraints=[SQL("DEFAULT 0")], null=True)
+    # 时效指标(天) 由 apps.shipments.aging 根据各日期字段批量计算
+    shipping_days = IntegerField(null=True, index=True)
+    warehouse_aging = IntegerField(null=True, index=True)
+    navigation_aging = IntegerField(null=True, index=True)
+    port_delivery_date = IntegerField(null=True, index=True)
+    delivery_accept_aging = IntegerField(null=True, index=True)
+    shelf_aging = IntegerField(null=True, index=True)
+    aging_time = DateTimeField(null=True, index=True)  # 时效指标最近一次计算的时间
     create_time = DateTimeField(constraints=[SQL("DEFAULT CURRENT_TIMESTAMP")])
     update_time = DateTimeField(constraints=[SQL("DEFAULT CURRENT_TIMESTAMP")])
 
     class Meta:
         table_name = 'shipment_order_info'
+        indexes = (
+            (('update_time', 'id'), False),  # 变更流 按 (update_time, id) 顺序读取
+            (('create_time', 'id'), False),  # 游标分页 按 (create_time, id) 倒序翻页
+        )
+
+
+class ShipmentOrderTrackBlob(BaseModel):
+    """订单轨迹大字段表 压缩存储 不放在订单主表上"""
+    order_code = CharField(unique=True)
+    total_track = LazyBlobField(null=True)
+    tracking_history = LazyBlobField(null=True)
+    update_time = DateTimeField(constraints=[SQL("DEFAULT CURRENT_TIMESTAMP")])
+
+    class Meta:
+        table_name = 'shipment_order_track_blob'
+
+
+class ShipmentOrderNgram(BaseModel):
+    """订单号/追踪号的三元组(trigram)索引表 用于 contains() 子串搜索"""
+    field = SmallIntegerField()  # 被索引的订单字段 见 apps.shipments.ngram.NGRAM_FIELDS
+    gram = CharField(max_length=3)
+    order_id = IntegerField(index=True)
+
+    class Meta:
+        table_name = 'shipment_order_ngram'
+        primary_key = CompositeKey('field', 'gram', 'order_id')
 
 
 class ShipmentFirstLegTracking(BaseModel):
@@ -91,12 +276,13 @@ class ShipmentFirstLegTracking(BaseModel):
         table_name = 'shipment_first_leg_tracking'
         indexes = (
             (('order_code', 'node_id'), True),
+            (('update_time', 'id'), False),  # 变更流 按 (update_time, id) 顺序读取
         )
 
 
 class ShipmentExceptionHandle(BaseModel):
     """订单异常处置记录表"""
-    exception_id = IntegerField()
+    exception_id = IntegerField(index=True)
     order_code = CharField(index=True)
     content = TextField(null=True)
     status = CharField(constraints=[SQL("DEFAULT '待处理'")])
@@ -107,6 +293,9 @@ class ShipmentExceptionHandle(BaseModel):
 
     class Meta:
         table_name = 'shipment_exception_handle'
+        indexes = (
+            (('create_time', 'id'), False),  # 游标分页 按 (create_time, id) 倒序翻页
+        )
 
 
 class ShipmentOrderException(BaseModel):
@@ -123,6 +312,10 @@ class ShipmentOrderException(BaseModel):
 
     class Meta:
         table_name = 'shipment_order_exception'
+        indexes = (
+            (('update_time', 'id'), False),  # 变更流 按 (update_time, id) 顺序读取
+            (('create_time', 'id'), False),  # 游标分页 按 (create_time, id) 倒序翻页
+        )
 
 
 class ShipmentProviderTracking(BaseModel):
@@ -137,13 +330,40 @@ class ShipmentProviderTracking(BaseModel):
     class Meta:
         table_name = 'shipment_provider_tracking'
 
+
+class ShipmentJobState(BaseModel):
+    """后台任务的增量水位记录表(每个任务一行)"""
+    name = CharField(unique=True)
+    watermark = DateTimeField(null=True)
+    update_time = DateTimeField(constraints=[SQL("DEFAULT CURRENT_TIMESTAMP")])
+
+    class Meta:
+        table_name = 'shipment_job_state'
+
+
+class ShipmentExceptionRollup(BaseModel):
+    """异常数汇总表 按 (异常类型, 异常节点, 处置状态, 物流商) 分组计数 由写入异常的路径增量维护"""
+    exception_type = CharField()
+    exception_node = CharField()
+    status = CharField()
+    # 找不到订单的异常记为空字符串(唯一索引里NULL互不相等 不能用NULL)
+    provider_code = CharField(constraints=[SQL("DEFAULT ''")])
+    exception_count = IntegerField(constraints=[SQL("DEFAULT 0")])
+    update_time = DateTimeField(constraints=[SQL("DEFAULT CURRENT_TIMESTAMP")])
+
+    class Meta:
+        table_name = 'shipment_exception_rollup'
+        indexes = (
+            (('exception_type', 'exception_node', 'status', 'provider_code'), True),
+        )
+
 # if __name__ == '__main__':
 #     # 调用connect()方法，使用这些参数建立实际的数据库连接
-#     mysql_database.connect()
+#     database.connect()
 #     # ShipmentOrderInfo, ShipmentFirstLegTracking, ShipmentOrderExceptions, ShipmentExceptionHandlingInfo, ShipmentProviderContent
-#     mysql_database.create_tables([ShipmentExceptionHandle])
+#     database.create_tables([ShipmentExceptionHandle])
 #     # 检查并关闭连接
-#     if not mysql_database.is_closed():
-#         mysql_database.close()
+#     if not database.is_closed():
+#         database.close()
 #
 #         print("数据库连接已关闭")
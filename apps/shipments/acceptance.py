@@ -0,0 +1,150 @@
+"""
+acceptance.py模块
+    待审核节点的置信度阈值自动采纳
+    按 (物流商, 轨迹类型) 配置不同的置信度阈值, 分批读取待审核(PENDING)节点, 用NumPy整批比较置信度和阈值,
+    达到阈值的节点改为自动采纳, 按id批量 UPDATE 并扣减订单的待审核数
+    --dry-run 只统计每个阈值会采纳多少节点 不修改数据库, 用来调整阈值
+
+    阈值查找顺序: (物流商, 轨迹类型) -> (物流商, *) -> (*, 轨迹类型) -> 默认阈值
+    阈值文件为JSON: {"P01:到港": 0.7, "P01:*": 0.75, "*:签收": 0.9}
+
+    python -m apps.shipments.acceptance run --thresholds thresholds.json [--dry-run]
+"""
+import argparse
+import json
+import time
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+
+from apps import events
+from apps.models import database, lock_rows, ShipmentFirstLegTracking, ShipmentOrderInfo
+from apps.shipments import pending
+from apps.shipments.pipeline import AUTO_ACCEPTED, CONFIDENCE_THRESHOLD
+
+WILDCARD = "*"
+
+
+def load_thresholds(path: str) -> dict:
+    """读取阈值文件 返回 (物流商, 轨迹类型) -> 阈值"""
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    return {tuple(key.split(":", 1)): float(value) for key, value in raw.items()}
+
+
+class AutoAcceptance:
+    """按阈值自动采纳待审核节点"""
+
+    # 每批读取的待审核节点数
+    BATCH_SIZE = 20000
+    # 每条 UPDATE 里的节点数
+    CHUNK_SIZE = 1000
+
+    def __init__(self, thresholds: dict = None, default: float = CONFIDENCE_THRESHOLD, dry_run: bool = False):
+        self.thresholds = thresholds or {}
+        self.default = default
+        self.dry_run = dry_run
+
+    def threshold(self, provider_code, track_type) -> float:
+        """单个 (物流商, 轨迹类型) 的阈值"""
+        for key in ((provider_code, track_type), (provider_code, WILDCARD), (WILDCARD, track_type)):
+            if key in self.thresholds:
+                return self.thresholds[key]
+        return self.default
+
+    def run(self) -> dict:
+        """
+        处理全部待审核节点
+        返回: 读取/采纳的节点数 耗时 以及每个 (物流商, 轨迹类型) 的待审核数/采纳数/阈值
+        """
+        start = time.perf_counter()
+        t, o = ShipmentFirstLegTracking, ShipmentOrderInfo
+        query = (t.select(t.id, t.order_code, o.provider_code, t.track_type, t.confidence)
+                 .join(o, on=(t.order_code == o.order_code))
+                 .where(t.identify_status == pending.PENDING)
+                 .order_by(t.id))
+
+        report, scanned, accepted, last_id = {}, 0, 0, 0
+        while True:
+            rows = list(query.where(t.id > last_id).limit(self.BATCH_SIZE).tuples())
+            if not rows:
+                break
+            accepted += self.process(rows, report)
+            scanned += len(rows)
+            last_id = rows[-1][0]
+
+        return {
+            "dryRun": self.dry_run,
+            "scanned": scanned,
+            "accepted": accepted,
+            "seconds": round(time.perf_counter() - start, 3),
+            "thresholds": [
+                {"providerCode": provider_code, "trackType": track_type, "threshold": self.threshold(provider_code, track_type),
+                 "pending": counts[0], "accepted": counts[1]}
+                for (provider_code, track_type), counts in sorted(report.items(), key=lambda item: -item[1][1])
+            ],
+        }
+
+    def process(self, rows: list, report: dict) -> int:
+        """比较一批节点的置信度和阈值 返回采纳的节点数"""
+        ids, _, providers, track_types, confidences = zip(*rows)
+        ids = np.array(ids, dtype=np.int64)
+        # 置信度为空的节点视为 NaN 与任何阈值比较都不会采纳
+        confidences = np.array([np.nan if c is None else float(c) for c in confidences], dtype=np.float64)
+
+        # 同一批里的 (物流商, 轨迹类型) 组合很少 先对组合去重 只为每个组合查一次阈值
+        keys = list(zip(providers, track_types))
+        unique_keys = list(dict.fromkeys(keys))
+        key_index = {key: i for i, key in enumerate(unique_keys)}
+        inverse = np.fromiter((key_index[key] for key in keys), dtype=np.int64, count=len(keys))
+        thresholds = np.array([self.threshold(*key) for key in unique_keys], dtype=np.float64)
+
+        accept = confidences >= thresholds[inverse]
+        pending_counts = np.bincount(inverse, minlength=len(unique_keys))
+        accepted_counts = np.bincount(inverse[accept], minlength=len(unique_keys))
+        for key, pending_count, accepted_count in zip(unique_keys, pending_counts.tolist(), accepted_counts.tolist()):
+            counts = report.setdefault(key, [0, 0])
+            counts[0] += pending_count
+            counts[1] += accepted_count
+
+        if not self.dry_run and accept.any():
+            return self.write(ids[accept].tolist())
+        return int(accept.sum())
+
+    def write(self, ids: list) -> int:
+        """
+        按id批量改为自动采纳 并扣减订单的待审核数 返回实际采纳的节点数
+        读取之后可能有节点已被人工审核: 事务里先锁住仍是待审核的节点, 只改这些节点 按它们的订单扣减待审核数
+        """
+        now = datetime.now()
+        t = ShipmentFirstLegTracking
+        accepted = Counter()
+        with database.atomic():
+            for i in range(0, len(ids), self.CHUNK_SIZE):
+                rows = list(lock_rows(t.select(t.id, t.order_code).where(
+                    t.id.in_(ids[i:i + self.CHUNK_SIZE]) & (t.identify_status == pending.PENDING)
+                )).tuples())
+                if not rows:
+                    continue
+                t.update({t.identify_status: AUTO_ACCEPTED, t.update_time: now}).where(
+                    t.id.in_([node_id for node_id, _ in rows])
+                ).execute()
+                accepted.update(order_code for _, order_code in rows)
+            pending.apply_changes({code: (-count, None) for code, count in accepted.items()})
+        events.publish(events.NODE_ACCEPTED, accepted)
+        return sum(accepted.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="待审核节点按置信度阈值自动采纳")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="执行自动采纳")
+    run.add_argument("--thresholds", default=None, help="阈值JSON文件")
+    run.add_argument("--default", type=float, default=CONFIDENCE_THRESHOLD, help="未配置的组合使用的阈值")
+    run.add_argument("--dry-run", action="store_true", help="只统计 不修改数据库")
+    args = parser.parse_args()
+
+    with database:
+        thresholds = load_thresholds(args.thresholds) if args.thresholds else None
+        print(json.dumps(AutoAcceptance(thresholds, args.default, args.dry_run).run(), ensure_ascii=False, indent=2))
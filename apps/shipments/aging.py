@@ -0,0 +1,136 @@
+"""
+aging.py模块
+    订单时效指标的批量计算
+    时效按天计算并写入 ShipmentOrderInfo 上带索引的列, 列表/详情直接读取, 也可以作为筛选和排序条件
+    增量计算: 只处理从未算过的、日期修改过的(update_time > aging_time)
+    以及尚未签收的订单(已发货天数随日期增长 每天重算一次)
+
+    python -m apps.shipments.aging migrate    给订单表添加时效列
+    python -m apps.shipments.aging run        增量计算 --full 全量重算
+"""
+import argparse
+import time
+from datetime import datetime
+
+import numpy as np
+from peewee import Case
+from playhouse.migrate import SchemaMigrator, migrate
+
+from apps.models import database, ShipmentOrderInfo
+from apps.shipments import totals
+from apps.shipments.order import order_detail_cache
+
+# 时效列 -> (开始日期列, 结束日期列)
+AGING_SPANS = {
+    "warehouse_aging": ("shipping_date", "departure_date"),  # 仓库时效: 发货 -> 开船
+    "navigation_aging": ("departure_date", "port_arrival_date"),  # 航行时效: 开船 -> 到港
+    "port_delivery_date": ("port_arrival_date", "delivery_date"),  # 到港派送时效: 到港 -> 派送
+    "delivery_accept_aging": ("delivery_date", "signed_date"),  # 签收时效: 派送 -> 签收
+    "shelf_aging": ("signed_date", "shelved_time"),  # 上架时效: 签收 -> 上架
+}
+# 已发货天数: 发货 -> 签收, 未签收时 发货 -> 今天
+AGING_COLUMNS = ["shipping_days"] + list(AGING_SPANS)
+DATE_COLUMNS = ["shipping_date", "departure_date", "port_arrival_date", "delivery_date", "signed_date", "shelved_time"]
+
+
+def compute_aging(columns: dict, today: np.datetime64) -> dict:
+    """
+    按列批量计算时效
+    columns: 日期列名 -> datetime/None 列表(同一批订单)
+    返回: 时效列名 -> int/None 列表
+    """
+    days = {name: np.array(values, dtype="datetime64[D]") for name, values in columns.items()}
+    result = {}
+
+    shipping_end = np.where(np.isnat(days["signed_date"]), today, days["signed_date"])
+    spans = {"shipping_days": (days["shipping_date"], shipping_end)}
+    spans.update({name: (days[start], days[end]) for name, (start, end) in AGING_SPANS.items()})
+
+    for name, (start, end) in spans.items():
+        diff = (end - start).astype("timedelta64[D]")
+        missing = np.isnat(diff)
+        values = diff.astype(np.int64)
+        result[name] = [None if m else int(v) for m, v in zip(missing.tolist(), values.tolist())]
+    return result
+
+
+class AgingEngine:
+    """订单时效批量计算"""
+
+    BATCH_SIZE = 2000
+
+    def __init__(self, full: bool = False):
+        # full=True 时忽略增量条件 全量重算
+        self.full = full
+
+    def pending_condition(self, now: datetime):
+        """需要(重新)计算的订单"""
+        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        o = ShipmentOrderInfo
+        return (
+            o.aging_time.is_null()
+            | (o.update_time > o.aging_time)
+            # 尚未签收的订单 已发货天数每天都在变化
+            | (o.signed_date.is_null() & o.shipping_date.is_null(False) & (o.aging_time < today_start))
+        )
+
+    def run(self) -> dict:
+        """按id分批计算 返回处理的订单数和耗时"""
+        start = time.perf_counter()
+        now = datetime.now()
+        today = np.datetime64(now.date(), "D")
+        fields = [ShipmentOrderInfo.id, ShipmentOrderInfo.order_code] + [getattr(ShipmentOrderInfo, c) for c in DATE_COLUMNS]
+        query = ShipmentOrderInfo.select(*fields)
+        if not self.full:
+            query = query.where(self.pending_condition(now))
+
+        last_id, total = 0, 0
+        while True:
+            rows = list(query.where(ShipmentOrderInfo.id > last_id).order_by(ShipmentOrderInfo.id).limit(self.BATCH_SIZE).tuples())
+            if not rows:
+                break
+            ids, codes, *dates = zip(*rows)
+            aging = compute_aging(dict(zip(DATE_COLUMNS, dates)), today)
+            self.write(ids, aging, now)
+            order_detail_cache.invalidate(*codes)
+            last_id = ids[-1]
+            total += len(ids)
+
+        if total:
+            # 时效列可以作为订单列表的筛选条件
+            totals.totals_cache.invalidate(totals.ORDERS)
+        return {"orders": total, "seconds": round(time.perf_counter() - start, 3)}
+
+    @staticmethod
+    def write(ids, aging: dict, now: datetime):
+        """一条 CASE id WHEN ... 的 UPDATE 写回一批订单的时效 不修改 update_time"""
+        update = {
+            getattr(ShipmentOrderInfo, name): Case(ShipmentOrderInfo.id, list(zip(ids, values)))
+            for name, values in aging.items()
+        }
+        update[ShipmentOrderInfo.aging_time] = now
+        with database.atomic():
+            ShipmentOrderInfo.update(update).where(ShipmentOrderInfo.id.in_(list(ids))).execute()
+
+
+def add_columns():
+    """给已有的订单表添加时效列和索引"""
+    migrator = SchemaMigrator.from_database(database)
+    table = ShipmentOrderInfo._meta.table_name
+    migrate(*[migrator.add_column(table, name, getattr(ShipmentOrderInfo, name))
+              for name in AGING_COLUMNS + ["aging_time"]])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="订单时效批量计算")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="给订单表添加时效列")
+    run = sub.add_parser("run", help="计算时效")
+    run.add_argument("--full", action="store_true", help="全量重算")
+    args = parser.parse_args()
+
+    with database:
+        if args.command == "migrate":
+            add_columns()
+        else:
+            print(AgingEngine(full=args.full).run())
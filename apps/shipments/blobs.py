@@ -0,0 +1,222 @@
+"""
+blobs.py模块
+    订单的头程完整轨迹(total_track)和轨迹历史(tracking_history)
+    两个大文本字段从订单主表移到 shipment_order_track_blob, 压缩后存储, 只有调用方显式请求时才加载,
+    订单列表/详情/修改等读取主表的查询不再带上它们
+
+    存储格式: 1字节格式头 + 数据
+        0x00 未压缩的UTF-8(压缩后没有变小时)
+        0x01 zlib
+        0x02 zstd(安装了 zstandard 时写入时优先使用)
+
+    python -m apps.shipments.blobs migrate [--drop]    把主表上已有的两列分批压缩迁移到新表 --drop 迁移后删除旧列
+    python -m apps.shipments.blobs bench               在SQLite上构造数据 对比存储大小和读取耗时
+"""
+import argparse
+import time
+import zlib
+from datetime import datetime
+from typing import Optional
+
+from peewee import Table
+from playhouse.migrate import SchemaMigrator, migrate
+
+from apps.models import database, bulk_insert, conflict_target, ShipmentOrderInfo, ShipmentOrderTrackBlob
+from apps.shipments import schemas
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖 没有安装时使用zlib
+    zstandard = None
+
+RAW, ZLIB, ZSTD = b"\x00", b"\x01", b"\x02"
+BLOB_FIELDS = ("total_track", "tracking_history")
+BATCH_SIZE = 1000
+
+
+def compress(text: Optional[str]) -> Optional[bytes]:
+    """压缩文本 加上格式头"""
+    if text is None:
+        return None
+    raw = text.encode("utf-8")
+    if zstandard is not None:
+        header, data = ZSTD, zstandard.ZstdCompressor(level=6).compress(raw)
+    else:
+        header, data = ZLIB, zlib.compress(raw, 6)
+    if len(data) >= len(raw):
+        header, data = RAW, raw
+    return header + data
+
+
+def decompress(blob: Optional[bytes]) -> Optional[str]:
+    """按格式头解压"""
+    if blob is None:
+        return None
+    header, data = bytes(blob[:1]), bytes(blob[1:])
+    if header == RAW:
+        return data.decode("utf-8")
+    if header == ZLIB:
+        return zlib.decompress(data).decode("utf-8")
+    if header == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd compressed track blobs")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    raise ValueError(f"Unknown track blob format: {header!r}")
+
+
+def save_track_history(rows) -> tuple:
+    """
+    写入(覆盖)订单的轨迹大字段
+    rows: (订单号, 头程完整轨迹, 轨迹历史) 元组
+    返回: (原文字节数, 压缩后字节数)
+    """
+    now = datetime.now()
+    fields = [ShipmentOrderTrackBlob.order_code, ShipmentOrderTrackBlob.total_track,
+              ShipmentOrderTrackBlob.tracking_history, ShipmentOrderTrackBlob.update_time]
+    values, raw_bytes, stored_bytes = [], 0, 0
+    for code, *texts in rows:
+        blobs = [compress(text) for text in texts]
+        raw_bytes += sum(len(text.encode("utf-8")) for text in texts if text is not None)
+        stored_bytes += sum(len(blob) for blob in blobs if blob is not None)
+        values.append((code, *blobs, now))
+    bulk_insert(
+        ShipmentOrderTrackBlob, fields, values,
+        conflict_target=conflict_target(ShipmentOrderTrackBlob.order_code),
+        preserve=fields[1:],
+    )
+    return raw_bytes, stored_bytes
+
+
+class OrderTrackHistory:
+    """订单的头程完整轨迹和轨迹历史(按需加载)"""
+
+    def __init__(self, order_code: str):
+        self.order_code = order_code
+
+    def get_history(self) -> schemas.ShipmentsOrderTrackHistory:
+        """读取并解压 没有记录时两个字段为空"""
+        b = ShipmentOrderTrackBlob
+        row = b.select(b.total_track, b.tracking_history).where(b.order_code == self.order_code).tuples().first()
+        total_track, history = row or (None, None)
+        return schemas.ShipmentsOrderTrackHistory(
+            orderCode=self.order_code,
+            totalTrack=decompress(total_track),
+            trackingHistory=decompress(history),
+        )
+
+
+def migrate_columns(drop: bool = False, batch_size: int = BATCH_SIZE) -> dict:
+    """
+    把订单主表上的 total_track/tracking_history 按id分批压缩写入新表
+    模型上已经没有这两列 通过 Table 直接读取; 可以重复执行(按订单号覆盖)
+    """
+    ShipmentOrderTrackBlob.create_table(safe=True)
+    table_name = ShipmentOrderInfo._meta.table_name
+    columns = {column.name for column in database.get_columns(table_name)}
+    if not set(BLOB_FIELDS) <= columns:
+        return {"orders": 0, "message": "columns already dropped"}
+
+    source = Table(table_name, ("id", "order_code") + BLOB_FIELDS).bind(database)
+    last_id, total, raw_bytes, stored_bytes = 0, 0, 0, 0
+    while True:
+        rows = list(source
+                    .select(source.id, source.order_code, source.total_track, source.tracking_history)
+                    .where((source.id > last_id)
+                           & (source.total_track.is_null(False) | source.tracking_history.is_null(False)))
+                    .order_by(source.id)
+                    .limit(batch_size)
+                    .tuples())
+        if not rows:
+            break
+        with database.atomic():
+            raw, stored = save_track_history([row[1:] for row in rows])
+        raw_bytes += raw
+        stored_bytes += stored
+        last_id = rows[-1][0]
+        total += len(rows)
+
+    if drop:
+        migrator = SchemaMigrator.from_database(database)
+        migrate(*[migrator.drop_column(table_name, name) for name in BLOB_FIELDS])
+    return {"orders": total, "rawBytes": raw_bytes, "storedBytes": stored_bytes}
+
+
+def benchmark(orders: int = 5000, events: int = 60, repeat: int = 5):
+    """
+    在临时SQLite库上构造轨迹文本 对比:
+    存储大小(原文 vs 压缩) / 订单列表整行读取(大字段在主表 vs 移出) / 单个订单按需加载解压的耗时
+    """
+    import json
+    import random
+    import tempfile
+    from datetime import timedelta
+
+    from peewee import SqliteDatabase
+
+    random.seed(0)
+    places = ["Shenzhen", "Yantian Port", "Singapore", "Los Angeles Port", "Ontario CA", "Fontana CA"]
+    texts = ["Shipment picked up", "Departed from port of loading", "Vessel arrived at transshipment port",
+             "Arrived at port of discharge", "Customs clearance completed", "Out for delivery", "Delivered"]
+
+    def track_text():
+        base = datetime(2025, 1, 1) + timedelta(hours=random.randint(0, 1000))
+        return json.dumps([{"time": f"{base + timedelta(hours=6 * k):%Y-%m-%d %H:%M:%S}",
+                            "location": random.choice(places), "content": random.choice(texts)}
+                           for k in range(events)], ensure_ascii=False)
+
+    with tempfile.NamedTemporaryFile(suffix=".db") as f:
+        bench_db = SqliteDatabase(f.name)
+        # 旧结构: 大字段在订单主表上
+        inline = Table("order_inline", ("id", "order_code", "shipment_name", "total_track", "tracking_history")).bind(bench_db)
+        bench_db.execute_sql("CREATE TABLE order_inline (id INTEGER PRIMARY KEY, order_code TEXT, shipment_name TEXT, "
+                             "total_track TEXT, tracking_history TEXT)")
+        with bench_db.bind_ctx([ShipmentOrderTrackBlob]):
+            bench_db.create_tables([ShipmentOrderTrackBlob])
+            bench_db.execute_sql("CREATE TABLE order_slim (id INTEGER PRIMARY KEY, order_code TEXT, shipment_name TEXT)")
+            slim = Table("order_slim", ("id", "order_code", "shipment_name")).bind(bench_db)
+
+            rows = [(f"OC{i:08d}", "shipment", track_text(), track_text()) for i in range(orders)]
+            with bench_db.atomic():
+                inline.insert([(i + 1, *row) for i, row in enumerate(rows)],
+                              columns=[inline.id, inline.order_code, inline.shipment_name, inline.total_track,
+                                       inline.tracking_history]).execute()
+                slim.insert([(i + 1, row[0], row[1]) for i, row in enumerate(rows)],
+                            columns=[slim.id, slim.order_code, slim.shipment_name]).execute()
+                raw_bytes, stored_bytes = save_track_history([(row[0], row[2], row[3]) for row in rows])
+
+            def timed(run):
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    run()
+                return round((time.perf_counter() - start) / repeat * 1000, 2)
+
+            codes = [row[0] for row in random.sample(rows, 200)]
+            result = {
+                "codec": "zstd" if zstandard else "zlib",
+                "rawBytes": raw_bytes,
+                "storedBytes": stored_bytes,
+                "ratio": round(raw_bytes / stored_bytes, 1),
+                # 整行读取全部订单(SELECT * 的效果)
+                "fullScanInlineMs": timed(lambda: list(inline.select().tuples())),
+                "fullScanSlimMs": timed(lambda: list(slim.select().tuples())),
+                # 200 个订单各自按需加载并解压
+                "lazyLoad200Ms": timed(lambda: [OrderTrackHistory(code).get_history() for code in codes]),
+            }
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="订单轨迹大字段压缩存储")
+    sub = parser.add_subparsers(dest="command", required=True)
+    mig = sub.add_parser("migrate", help="迁移主表上已有的轨迹大字段")
+    mig.add_argument("--drop", action="store_true", help="迁移后删除主表上的旧列")
+    bench = sub.add_parser("bench", help="对比存储大小和读取耗时")
+    bench.add_argument("--orders", type=int, default=5000)
+    bench.add_argument("--events", type=int, default=60)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        print(benchmark(args.orders, args.events))
+    else:
+        with database:
+            print(migrate_columns(drop=args.drop))
@@ -0,0 +1,95 @@
+"""
+changes.py模块
+    轨迹节点/异常/订单的变更流 供下游系统(BI/客户门户)增量同步
+    按 (update_time, id) 升序返回游标之后的变更行, 每次最多 limit 行, 并返回下一次请求用的游标
+    三张表都有 (update_time, id) 联合索引, 没有新变更时只是一次索引探测
+
+    依赖所有写入路径在修改行时更新 update_time;
+    订单上由后台任务维护的派生列(时效/待审核数)不更新 update_time, 不会出现在变更流里
+
+    update_time 由写入方在事务内设置, 早于提交时间; 变更流只返回 SETTLE_SECONDS 之前的变更,
+    所以要求每个写事务从设置 update_time 到提交不超过 SETTLE_SECONDS, 超过的行会落在消费方游标之后永远读不到.
+    SETTLE_SECONDS 由环境变量 CHANGES_SETTLE_SECONDS 配置(默认60秒), 应大于事务的最长耗时
+    (MySQL 锁等待超时 innodb_lock_wait_timeout 默认50秒); 后台任务每批一个事务并在该批开始时取时间
+
+    python -m apps.shipments.changes migrate    给三张表添加 (update_time, id) 索引
+"""
+import argparse
+import os
+from datetime import datetime, timedelta
+
+from playhouse.migrate import SchemaMigrator, migrate
+
+from apps.models import database, ShipmentFirstLegTracking, ShipmentOrderException, ShipmentOrderInfo
+from apps.shipments import schemas, serializers
+from apps.shipments.pagination import decode_cursor, encode_cursor
+
+# 变更流名称 -> (表, 响应模型)
+FEEDS = {
+    "nodes": (ShipmentFirstLegTracking, schemas.ShipmentsChangeNodeItem),
+    "exceptions": (ShipmentOrderException, schemas.ShipmentsChangeExceptionItem),
+    "orders": (ShipmentOrderInfo, schemas.ShipmentsChangeOrderItem),
+}
+
+
+class ChangeFeed:
+    """单个变更流的一次读取"""
+
+    # 只返回至少这么多秒之前的变更 见模块说明:
+    # 事务里写入的 update_time 早于提交时间, 刚写入的行可能还有同一时间、id更小的行未提交, 等它们落定后再读
+    SETTLE_SECONDS = int(os.getenv("CHANGES_SETTLE_SECONDS", "60"))
+
+    def __init__(self, filters: schemas.ShipmentsChangesRequest):
+        self.filters = filters
+        self.model, self.schema = FEEDS[filters.feed]
+
+    def get_changes(self) -> schemas.ShipmentsChangesResult:
+        """读取游标之后的一批变更"""
+        limit = self.filters.limit
+        rows = list(self.query.limit(limit + 1).dicts())
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["update_time"], rows[-1]["id"]) if rows else self.filters.after
+        return schemas.ShipmentsChangesResult(
+            content=serializers.to_items(self.schema, rows),
+            nextCursor=next_cursor,
+            hasMore=has_more,
+        )
+
+    @property
+    def columns(self) -> list:
+        """响应模型中在表上存在的列"""
+        fields = self.model._meta.fields
+        return [fields[f.alias] for f in self.schema.model_fields.values() if f.alias in fields]
+
+    @property
+    def query(self):
+        """查询数据库操作"""
+        m = self.model
+        settled = datetime.now() - timedelta(seconds=self.SETTLE_SECONDS)
+        query = m.select(*self.columns).where(m.update_time <= settled)
+        if self.filters.after:
+            update_time, row_id = decode_cursor(self.filters.after)
+            # update_time >= 游标时间 给出索引范围的起点, OR条件处理同一时间的行
+            query = query.where(
+                (m.update_time >= update_time)
+                & ((m.update_time > update_time) | (m.id > row_id))
+            )
+        return query.order_by(m.update_time, m.id)
+
+
+def add_indexes():
+    """给已有的三张表添加 (update_time, id) 索引"""
+    migrator = SchemaMigrator.from_database(database)
+    migrate(*[migrator.add_index(model._meta.table_name, ("update_time", "id"), False)
+              for model, _ in FEEDS.values()])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="变更流")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="添加 (update_time, id) 索引")
+    args = parser.parse_args()
+
+    with database:
+        add_indexes()
@@ -1,11 +1,35 @@
 """异常处置接口类"""
+import argparse
+from collections import defaultdict
 from datetime import datetime
 from functools import cached_property
 
-from peewee import JOIN
+from playhouse.migrate import SchemaMigrator, migrate
 
-from apps.models import ShipmentOrderException, ShipmentOrderInfo, ShipmentExceptionHandle
+from apps.models import database, bulk_insert, lock_rows, ShipmentOrderException, ShipmentOrderInfo, ShipmentExceptionHandle
 from apps.shipments import schemas
+from apps.shipments import rollups, serializers, totals
+from apps.shipments.pagination import cursor_page, is_cursor_mode
+
+# 异常处置状态: 新产生的异常为待处理, 处于 CLOSED_STATUSES 之外的都算未关闭
+PENDING_STATUS = "待处理"
+CLOSED_STATUSES = ("已处理", "已关闭")
+
+
+def fill_columns(rows: list, key: str, lookup_field, fields: list) -> list:
+    """
+    把关联表的列补到一页结果上: 按当前页的 key 值去重后一次 IN 查询 lookup_field, 找不到的行这些列为None
+    列表查询本身不再关联这些表, 总数和分页只扫主表
+    """
+    values = list({row[key] for row in rows if row[key] is not None})
+    found = {}
+    if values:
+        query = lookup_field.model.select(lookup_field.alias("lookup_key"), *fields).where(lookup_field.in_(values))
+        found = {row.pop("lookup_key"): row for row in query.dicts()}
+    missing = dict.fromkeys(field.name for field in fields)
+    for row in rows:
+        row.update(found.get(row[key], missing))
+    return rows
 
 
 class ExceptionList:
@@ -24,69 +48,72 @@ class ExceptionList:
         )
 
         # 拿列表
+        next_cursor = None
+        if is_cursor_mode(self.filters):
+            # 游标分页 不受页码深度影响
+            details, next_cursor = self.get_cursor_details()
         # 判断 如果传入的页码数 > 总页数  则返回空列表
-        if self.filters.pageNum > pagination.totalPages:
+        elif pagination.is_out_of_range():
             details = []
         else:
             details = self.get_details()
         # **pagination.model_dump() 将字典解包为关键字参数
         # ShipmentsOrdersResult返回内容列表content,分页信息
-        return schemas.ShipmentsExceptionsResult(content=details, **pagination.model_dump())
+        return schemas.ShipmentsExceptionsResult(content=details, nextCursor=next_cursor, **pagination.model_dump())
 
     def get_total(self) -> int:
-        """拿取查询的结果总数"""
-        return self.query.count()
+        """拿取查询的结果总数(按筛选条件缓存)"""
+        return totals.count_total(totals.EXCEPTIONS, self.query, self.filters)
 
     def get_details(self) -> list:
         """拿取查询的结果详情"""
         query = self.query.order_by(ShipmentOrderException.create_time.desc()).paginate(self.filters.pageNum, self.filters.pageSize)
-        records = []
-        for q in query:
-            # model_validate 用于验证和转换输入数据为 Pydantic模型实例
-            exception = schemas.ExceptionsItem.model_validate(q)
-            # 订单头程号
-            if hasattr(q, 't'):
-                order_info = schemas.ExceptionsJoinItem.model_validate(q.t)
-            else:
-                # 默认值为None
-                order_info = schemas.ExceptionsJoinItem()
-
-            record = schemas.ShipmentsExceptionsItem(
-                **exception.model_dump(),
-                **order_info.model_dump()
-            )
-            records.append(record)
-        return records
+        # .dicts() 取行 补上订单表的列后直接批量校验为 ShipmentsExceptionsItem
+        return serializers.to_items(schemas.ShipmentsExceptionsItem, self.fill_order_columns(list(query.dicts())))
+
+    def get_cursor_details(self) -> tuple:
+        """按 (create_time, id) 游标拿取一页结果详情 返回(结果列表, 下一页游标)"""
+        rows, next_cursor = cursor_page(
+            self.query.dicts(), ShipmentOrderException.create_time, ShipmentOrderException.id,
+            self.filters.after, self.filters.pageSize, time_attr="exception_date", id_attr="exception_id",
+        )
+        return serializers.to_items(schemas.ShipmentsExceptionsItem, self.fill_order_columns(rows)), next_cursor
+
+    @staticmethod
+    def fill_order_columns(rows: list) -> list:
+        """按当前页的订单号一次查出订单表的三个字段"""
+        return fill_columns(rows, "order_code", ShipmentOrderInfo.order_code, [
+            ShipmentOrderInfo.provider_code,
+            ShipmentOrderInfo.shipment_name,
+            ShipmentOrderInfo.first_leg_tracking_number,
+        ])
 
     @cached_property
     def query(self):
         """查询数据库操作"""
-        # 从ShipmentOrderException表中选择需要的字段
-        # 并通过order_code关联ShipmentOrderInfo表获取额外字段
+        # 只从ShipmentOrderException表中选择字段 订单表的字段在分页之后由 fill_order_columns 补上
         query = ShipmentOrderException.select(
             ShipmentOrderException.id.alias('exception_id'),
             ShipmentOrderException.order_code,
-            # 从关联表获取这三个字段
-            ShipmentOrderInfo.provider_code,
-            ShipmentOrderInfo.shipment_name,
-            ShipmentOrderInfo.first_leg_tracking_number,
             ShipmentOrderException.exception_type,
             ShipmentOrderException.exception_node,
             ShipmentOrderException.create_time.alias("exception_date"),
             ShipmentOrderException.status,
             ShipmentOrderException.update_time
-        ).join(
-            ShipmentOrderInfo,
-            # 通过order_code建立两个表的连接
-            join_type=JOIN.LEFT_OUTER,
-            on=(ShipmentOrderException.order_code == ShipmentOrderInfo.order_code),
-            attr="t",
         )
 
         f = self.filters
         # 字符串精确匹配条件
         if f.orderCode:
             query = query.where(ShipmentOrderException.order_code == f.orderCode)
+        if f.firstLegTrackingNumber or f.shipmentName:
+            # 只有按订单表的字段筛选时才关联订单表
+            # 条件落在订单表上 找不到订单的异常本来就会被过滤掉 内连接与原来的左连接结果相同
+            query = query.join(
+                ShipmentOrderInfo,
+                on=(ShipmentOrderException.order_code == ShipmentOrderInfo.order_code),
+                attr="t",
+            )
         if f.firstLegTrackingNumber:
             query = query.where(ShipmentOrderInfo.first_leg_tracking_number == f.firstLegTrackingNumber)
         if f.shipmentName:
@@ -114,21 +141,90 @@ class ExceptionsProcessing:
         self.item = item
 
     def processing(self):
-        """异常处理操作"""
-        # 去异常信息表拿异常信息
-        query_result = ShipmentOrderException.get_by_id(self.exception_id)
-        order_code = query_result.order_code
-        # 添加异常操作记录表一条记录
-        item = self.item.model_dump()
-        item["exception_id"] = self.exception_id
-        item["order_code"] = order_code
-        item["operator_uid"] = 1
-        item["operator_name"] = "admin"
-        item["create_time"] = datetime.now()
-        item["update_time"] = datetime.now()
-        ShipmentExceptionHandle.create(**item)
-        # 更新异常信息表的处置状态
-        query_result.update(status=self.item.status, update_time=datetime.now()).where(ShipmentOrderException.id == self.exception_id).execute()
+        """异常处理操作 读取异常/写处置记录/更新状态在同一个事务里"""
+        with database.atomic():
+            # 去异常信息表拿异常信息 锁住该行: 并发处置同一异常时后一个事务读到的是前一个改过的状态 看板计数不会重复移动
+            query_result = lock_rows(
+                ShipmentOrderException.select().where(ShipmentOrderException.id == self.exception_id)
+            ).get()
+            order_code = query_result.order_code
+            # 添加异常操作记录表一条记录
+            item = self.item.model_dump()
+            item["exception_id"] = self.exception_id
+            item["order_code"] = order_code
+            item["operator_uid"] = 1
+            item["operator_name"] = "admin"
+            item["create_time"] = datetime.now()
+            item["update_time"] = datetime.now()
+            ShipmentExceptionHandle.create(**item)
+            # 更新异常信息表的处置状态
+            query_result.update(status=self.item.status, update_time=datetime.now()).where(ShipmentOrderException.id == self.exception_id).execute()
+            # 看板计数从原状态移到新状态
+            rollups.apply_changes(rollups.status_changes(
+                [(self.exception_id, order_code, query_result.exception_type, query_result.exception_node, query_result.status)],
+                {self.exception_id: self.item.status},
+            ))
+        # 异常状态和处置记录都变了 对应的总数缓存失效
+        totals.totals_cache.invalidate(totals.EXCEPTIONS, totals.EXCEPTION_LOGS)
+
+
+class ExceptionsBatchProcessing:
+    """异常批量处置"""
+
+    # 每条 SELECT/UPDATE 里的异常数
+    CHUNK_SIZE = 500
+
+    def __init__(self, items: list):
+        # items: ShipmentsExceptionsBatchProcessingItem 列表 同一异常出现多次时以最后一条为准
+        self.items = {item.exceptionId: item for item in items}
+
+    def processing(self) -> schemas.ShipmentsExceptionsBatchProcessingResult:
+        """
+        一个事务内处置全部异常
+        先一次取出异常的订单号, 再用一条 insert_many 写入全部处置记录, 最后按目标状态分组 UPDATE,
+        语句数与异常数无关
+        """
+        ids = list(self.items)
+        now = datetime.now()
+        e = ShipmentOrderException
+        with database.atomic():
+            exceptions = []
+            for i in range(0, len(ids), self.CHUNK_SIZE):
+                # 锁住这些异常 看板计数按锁定后读到的原状态移动
+                query = lock_rows(e.select(e.id, e.order_code, e.exception_type, e.exception_node, e.status).where(
+                    e.id.in_(ids[i:i + self.CHUNK_SIZE])))
+                exceptions.extend(query.tuples())
+            order_codes = {row[0]: row[1] for row in exceptions}
+
+            found = [exception_id for exception_id in ids if exception_id in order_codes]
+            h = ShipmentExceptionHandle
+            bulk_insert(h, [h.exception_id, h.order_code, h.content, h.status, h.operator_uid, h.operator_name,
+                            h.create_time, h.update_time], [
+                (exception_id, order_codes[exception_id], self.items[exception_id].content,
+                 self.items[exception_id].status, 1, "admin", now, now)
+                for exception_id in found
+            ])
+
+            by_status = defaultdict(list)
+            for exception_id in found:
+                by_status[self.items[exception_id].status].append(exception_id)
+            for status, status_ids in by_status.items():
+                for i in range(0, len(status_ids), self.CHUNK_SIZE):
+                    e.update({e.status: status, e.update_time: now}).where(
+                        e.id.in_(status_ids[i:i + self.CHUNK_SIZE])
+                    ).execute()
+            # 看板计数从原状态移到新状态
+            rollups.apply_changes(rollups.status_changes(
+                exceptions, {exception_id: item.status for exception_id, item in self.items.items()}))
+        if found:
+            totals.totals_cache.invalidate(totals.EXCEPTIONS, totals.EXCEPTION_LOGS)
+
+        return schemas.ShipmentsExceptionsBatchProcessingResult(
+            processed=len(found),
+            results=[schemas.ShipmentsExceptionsBatchProcessingOutcome(
+                exceptionId=exception_id, status="PROCESSED" if exception_id in order_codes else "NOT_FOUND")
+                for exception_id in ids],
+        )
 
 
 class ExceptionLogs:
@@ -145,86 +241,135 @@ class ExceptionLogs:
             pageSize=self.filters.pageSize,
         )
         # 拿列表
+        next_cursor = None
+        if is_cursor_mode(self.filters):
+            # 游标分页 不受页码深度影响
+            logs, next_cursor = self.get_cursor_details()
         # 判断 如果传入的页码数 > 总页数  则返回空列表
-        if self.filters.pageNum > pagination.totalPages:
+        elif pagination.is_out_of_range():
             logs = []
         else:
             logs = self.get_details()
         # **pagination.model_dump() 将字典解包为关键字参数
         # ShipmentsOrdersResult返回内容列表content,分页信息
-        return schemas.ShipmentsExceptionLogsResult(content=logs, **pagination.model_dump())
+        return schemas.ShipmentsExceptionLogsResult(content=logs, nextCursor=next_cursor, **pagination.model_dump())
 
     def get_total(self) -> int:
-        """拿取查询的结果总数"""
-        return self.query.count()
+        """拿取查询的结果总数(按筛选条件缓存)"""
+        return totals.count_total(totals.EXCEPTION_LOGS, self.query, self.filters)
 
     def get_details(self) -> list:
         """拿取查询的结果详情"""
         query = self.query.order_by(ShipmentExceptionHandle.create_time.desc()).paginate(self.filters.pageNum, self.filters.pageSize)
-        records = []
-        for q in query:
-            # model_validate 用于验证和转换输入数据为 Pydantic模型实例
-            exception = schemas.ExceptionLogsItem.model_validate(q)
-            if hasattr(q, 'e'):
-                exception_info = schemas.ExceptionLogsJoinExceptionItem.model_validate(q.e)
-            else:
-                # 默认值为None
-                exception_info = schemas.ExceptionLogsJoinExceptionItem()
-            if hasattr(q, 's'):
-                order_info = schemas.ExceptionLogsJoinInfoItem.model_validate(q.s)
-            else:
-                # 默认值为None
-                order_info = schemas.ExceptionLogsJoinInfoItem()
-
-            record = schemas.ShipmentsExceptionLogsItem(
-                **order_info.model_dump(),
-                **exception.model_dump(),
-                **exception_info.model_dump(),
-            )
-            records.append(record)
-        return records
+        # .dicts() 取行 补上订单表和异常表的列后直接批量校验为 ShipmentsExceptionLogsItem
+        return serializers.to_items(schemas.ShipmentsExceptionLogsItem, self.fill_join_columns(list(query.dicts())))
+
+    def get_cursor_details(self) -> tuple:
+        """按 (create_time, id) 游标拿取一页结果详情 返回(结果列表, 下一页游标)"""
+        rows, next_cursor = cursor_page(
+            self.query.dicts(), ShipmentExceptionHandle.create_time, ShipmentExceptionHandle.id,
+            self.filters.after, self.filters.pageSize, time_attr="handle_time", id_attr="id",
+        )
+        return serializers.to_items(schemas.ShipmentsExceptionLogsItem, self.fill_join_columns(rows)), next_cursor
+
+    @staticmethod
+    def fill_join_columns(rows: list) -> list:
+        """按当前页的订单号/异常id 各一次查出订单表和异常表的字段"""
+        fill_columns(rows, "order_code", ShipmentOrderInfo.order_code, [
+            ShipmentOrderInfo.first_leg_tracking_number,
+            ShipmentOrderInfo.shipment_name,
+        ])
+        return fill_columns(rows, "exception_id", ShipmentOrderException.id, [
+            ShipmentOrderException.exception_type,
+            ShipmentOrderException.exception_node,
+            ShipmentOrderException.create_time,
+        ])
 
     @cached_property
     def query(self):
         """查询数据库操作"""
-        # 从ShipmentExceptionHandle表中选择需要的字段
-        # 并通过order_code关联ShipmentOrderInfo表获取额外字段
-        query = (ShipmentExceptionHandle.select(
-            # 处置记录表字段
+        # 只从ShipmentExceptionHandle表中选择字段 订单表和异常表的字段在分页之后由 fill_join_columns 补上
+        query = ShipmentExceptionHandle.select(
             ShipmentExceptionHandle.id,
+            ShipmentExceptionHandle.exception_id,
+            ShipmentExceptionHandle.order_code,
             ShipmentExceptionHandle.status,
             ShipmentExceptionHandle.content,
             ShipmentExceptionHandle.operator_name,
-            # 异常信息表字段
-            ShipmentOrderException.exception_type,
-            ShipmentOrderException.exception_node,
-            ShipmentOrderException.create_time,
-            # 订单信息表字段
-            ShipmentOrderInfo.first_leg_tracking_number,
-            ShipmentOrderInfo.shipment_name
-        ).join(
-            ShipmentOrderInfo,
-            on=(ShipmentExceptionHandle.order_code == ShipmentOrderInfo.order_code),
-            join_type=JOIN.LEFT_OUTER,
-            attr='s'
-        )  # 三个表关联查询时 需要用switch切回主表
-        .switch(ShipmentExceptionHandle)  # 切回主表
-        .join(
-            ShipmentOrderException,
-            on=(ShipmentExceptionHandle.exception_id == ShipmentOrderException.id),
-            join_type=JOIN.LEFT_OUTER,
-            attr='e'
-        ))
+            ShipmentExceptionHandle.create_time.alias('handle_time'),  # 游标分页需要 与异常表的create_time区分
+        )
 
         f = self.filters
         # 字符串精确匹配条件
         if f.orderCode:
             query = query.where(ShipmentExceptionHandle.order_code == f.orderCode)
+        if f.firstLegTrackingNumber or f.shipmentName:
+            # 只有按订单表的字段筛选时才关联订单表
+            query = query.join(
+                ShipmentOrderInfo,
+                on=(ShipmentExceptionHandle.order_code == ShipmentOrderInfo.order_code),
+                attr='s'
+            )
         if f.firstLegTrackingNumber:
             query = query.where(ShipmentOrderInfo.first_leg_tracking_number == f.firstLegTrackingNumber)
         if f.shipmentName:
             query = query.where(ShipmentOrderInfo.shipment_name == f.shipmentName)
         if f.exceptionId:
-            query = query.where(ShipmentOrderException.id == f.exceptionId)
+            # 处置记录表上就有异常id 不需要关联异常表
+            query = query.where(ShipmentExceptionHandle.exception_id == f.exceptionId)
         # query:未排序的Peewee查询对象(ModelSelect)
         return query
+
+
+class ExceptionTimeline:
+    """异常时间线接口类 一页异常连同各自的处置记录"""
+
+    def __init__(self, filters: schemas.ShipmentsExceptionTimelineRequest):
+        self.filters = filters
+
+    def get_timeline(self) -> schemas.ShipmentsExceptionTimelineResult:
+        """
+        每页固定两条查询: 按游标取一页异常, 再按这页的异常id一次 IN 查出全部处置记录, 在内存里按异常分组
+        (处置记录表的 exception_id 不是外键 不能用peewee的prefetch, 效果相同)
+        """
+        rows, next_cursor = cursor_page(
+            ExceptionList(self.filters).query.dicts(), ShipmentOrderException.create_time, ShipmentOrderException.id,
+            self.filters.after, self.filters.pageSize, time_attr="exception_date", id_attr="exception_id",
+        )
+        logs = self.get_logs([row["exception_id"] for row in rows])
+        for row in rows:
+            row["logs"] = logs.get(row["exception_id"], [])
+        return schemas.ShipmentsExceptionTimelineResult(
+            content=serializers.to_items(schemas.ShipmentsExceptionTimelineItem, rows),
+            nextCursor=next_cursor,
+        )
+
+    @staticmethod
+    def get_logs(exception_ids: list) -> dict:
+        """异常id -> 处置记录列表(按处置时间正序)"""
+        if not exception_ids:
+            return {}
+        h = ShipmentExceptionHandle
+        query = (h.select(h.id, h.exception_id, h.status, h.content, h.operator_name, h.create_time.alias("handle_time"))
+                 .where(h.exception_id.in_(exception_ids))
+                 .order_by(h.create_time, h.id))
+        logs = defaultdict(list)
+        for row in query.dicts():
+            logs[row["exception_id"]].append(row)
+        return logs
+
+
+def add_indexes():
+    """给已有的处置记录表添加 exception_id 索引(时间线按异常id批量查处置记录)"""
+    migrator = SchemaMigrator.from_database(database)
+    migrate(migrator.add_index(ShipmentExceptionHandle._meta.table_name, ("exception_id",), False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="异常处置")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="添加处置记录表的 exception_id 索引")
+    args = parser.parse_args()
+
+    with database:
+        add_indexes()
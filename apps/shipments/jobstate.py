@@ -0,0 +1,31 @@
+"""
+jobstate.py模块
+    后台增量任务的水位(上次处理到的时间) 存在 shipment_job_state 表里 每个任务一行
+"""
+from datetime import datetime
+from typing import Optional
+
+from apps.models import conflict_target, ShipmentJobState
+
+
+def get_watermark(name: str) -> Optional[datetime]:
+    """任务上次处理到的时间 从未运行过时返回None"""
+    return (ShipmentJobState
+            .select(ShipmentJobState.watermark)
+            .where(ShipmentJobState.name == name)
+            .scalar())
+
+
+def set_watermark(name: str, watermark: datetime):
+    """记录任务处理到的时间 应与该批数据的写入在同一事务里调用"""
+    now = datetime.now()
+    (ShipmentJobState
+     .insert(name=name, watermark=watermark, update_time=now)
+     .on_conflict(conflict_target=conflict_target(ShipmentJobState.name),
+                  update={ShipmentJobState.watermark: watermark, ShipmentJobState.update_time: now})
+     .execute())
+
+
+def create_table():
+    """创建水位表(已存在时跳过)"""
+    ShipmentJobState.create_table(safe=True)
@@ -0,0 +1,268 @@
+"""
+ngram.py模块
+    订单号/追踪号的三元组(trigram)子串索引
+    LIKE '%x%' 用不上 ShipmentOrderInfo 上的索引, 每次搜索都是全表扫描
+    这里把每个字段拆成三元组存进 shipment_order_ngram, 搜索时先通过索引表查出候选订单id,
+    再以 id IN (候选id列表) 按主键在候选集上做 LIKE 精确校验(三元组只能保证"可能包含");
+    候选id先单独查出来而不是写成子查询: MySQL 对带 GROUP BY/HAVING/UNION 的 IN 子查询不做半连接,
+    会按外层每一行执行一次子查询 主表仍然全表扫描. 候选超过 MAX_CANDIDATES 个时直接用 LIKE,
+    命中订单太多的三元组不参与候选查询(见 selective_grams)
+
+    索引是否可用记在 shipment_job_state 的 ngram 水位里(见 jobstate.py):
+        水位为空(回填还没跑完)时搜索直接用 LIKE, 不会因为索引表为空而搜不到订单
+        批量导入不同步重建索引, 由 sync 按 update_time 增量补上并推进水位;
+        搜索时 update_time 晚于 水位 - SYNC_LAG_SECONDS 的订单不经过索引表 直接参与 LIKE 校验
+    LIKE 中的 % _ 按字面匹配(转义), 与三元组索引的结果一致
+
+    python -m apps.shipments.ngram backfill     回填已有订单的索引 完成后记录水位
+    python -m apps.shipments.ngram sync         增量重建水位之后写入/修改的订单的索引(定时运行)
+    python -m apps.shipments.ngram bench XXX    对比 LIKE 和索引两种方式的耗时(--rows N 在临时SQLite库上构造N个订单)
+"""
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+from peewee import fn, Expression, NodeList, SQL, OP
+
+from apps.models import database, bulk_insert, ShipmentOrderInfo, ShipmentOrderNgram
+from apps.shipments import jobstate
+
+# 索引表里 field 列的取值 -> 被索引的订单字段
+NGRAM_FIELDS = {
+    1: ShipmentOrderInfo.order_code,
+    2: ShipmentOrderInfo.first_leg_tracking_number,
+    3: ShipmentOrderInfo.last_mile_tracking_number,
+}
+FIELD_CODES = {field.name: code for code, field in NGRAM_FIELDS.items()}
+
+GRAM_SIZE = 3
+BATCH_SIZE = 1000
+# 候选订单数上限 超过时索引的选择性已经不高 直接用 LIKE 全表扫描
+MAX_CANDIDATES = 5000
+
+JOB_NAME = "ngram"
+# sync 以 update_time 判断需要重建的订单; 写事务从设置 update_time 到提交的耗时不能超过这个秒数(同 changes.py)
+SYNC_LAG_SECONDS = int(os.getenv("NGRAM_SYNC_LAG_SECONDS", "60"))
+# LIKE 的转义字符 MySQL和SQLite的字符串字面量里都不需要再转义
+LIKE_ESCAPE = "!"
+
+
+def trigrams(value: str) -> set:
+    """把字符串拆成不重复的三元组 大小写不敏感(与MySQL的 _ci 排序规则一致)"""
+    if not value:
+        return set()
+    value = value.lower()
+    return {value[i:i + GRAM_SIZE] for i in range(len(value) - GRAM_SIZE + 1)}
+
+
+def index_orders(rows):
+    """
+    重建一批订单的三元组索引
+    rows: (id, 订单号, 头程追踪号, 尾程追踪号) 元组 即 index_query().tuples() 的结果
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    grams = []
+    for order_id, *values in rows:
+        for code, value in zip(NGRAM_FIELDS, values):
+            for gram in trigrams(value):
+                grams.append((code, gram, order_id))
+    # 与 bulk_insert 一样取模型绑定的库(benchmark 会临时绑定到SQLite)
+    with ShipmentOrderNgram._meta.database.atomic():
+        ShipmentOrderNgram.delete().where(ShipmentOrderNgram.order_id.in_([row[0] for row in rows])).execute()
+        bulk_insert(ShipmentOrderNgram, [ShipmentOrderNgram.field, ShipmentOrderNgram.gram, ShipmentOrderNgram.order_id], grams, adapt=False)
+
+
+def index_query():
+    """建索引需要读取的订单字段"""
+    return ShipmentOrderInfo.select(ShipmentOrderInfo.id, *NGRAM_FIELDS.values()).tuples()
+
+
+def refresh_orders(order_codes):
+    """订单号/追踪号写入或修改后 重建这些订单的索引"""
+    order_codes = list(order_codes)
+    for i in range(0, len(order_codes), BATCH_SIZE):
+        index_orders(index_query().where(ShipmentOrderInfo.order_code.in_(order_codes[i:i + BATCH_SIZE])))
+
+
+def selective_grams(field, grams) -> list:
+    """
+    命中订单数不超过 MAX_CANDIDATES 的三元组
+    太常见的三元组(如订单号前缀 "oc0")几乎命中全部订单, 放进 GROUP BY 只会增加扫描量, 对缩小范围没有帮助;
+    每个三元组只在索引上跳过 MAX_CANDIDATES 行探测一次 代价有上限
+    """
+    code = FIELD_CODES[field.name]
+    selective = []
+    for gram in sorted(grams):
+        beyond_limit = (ShipmentOrderNgram
+                        .select(ShipmentOrderNgram.order_id)
+                        .where((ShipmentOrderNgram.field == code) & (ShipmentOrderNgram.gram == gram))
+                        .limit(1)
+                        .offset(MAX_CANDIDATES)
+                        .scalar())
+        if beyond_limit is None:
+            selective.append(gram)
+    return selective
+
+
+def candidate_ids(field, term: str):
+    """
+    通过索引表拿到字段可能包含 term 的订单id查询
+    要求订单命中 term 的全部选择性足够的三元组(见 selective_grams);
+    term 短于三个字符 或全部三元组都太常见时无法用索引缩小范围 返回None
+    """
+    grams = selective_grams(field, trigrams(term))
+    if not grams:
+        return None
+    return (ShipmentOrderNgram
+            .select(ShipmentOrderNgram.order_id)
+            .where((ShipmentOrderNgram.field == FIELD_CODES[field.name]) & ShipmentOrderNgram.gram.in_(grams))
+            .group_by(ShipmentOrderNgram.order_id)
+            .having(fn.COUNT(ShipmentOrderNgram.gram) == len(grams)))
+
+
+def like(field, term: str):
+    """field 包含 term 的 LIKE 条件 term 里的 % _ 按字面匹配(大小写不敏感 同 field.contains)"""
+    for char in (LIKE_ESCAPE, "%", "_"):
+        term = term.replace(char, LIKE_ESCAPE + char)
+    return Expression(field, OP.ILIKE, NodeList((f"%{term}%", SQL(f"ESCAPE '{LIKE_ESCAPE}'"))))
+
+
+def unindexed_since():
+    """update_time 晚于该时间的订单可能还没进索引 回填未完成时返回None(只能用 LIKE)"""
+    watermark = jobstate.get_watermark(JOB_NAME)
+    if watermark is None:
+        return None
+    return watermark - timedelta(seconds=SYNC_LAG_SECONDS)
+
+
+def contains(field, term: str):
+    """
+    替代 field.contains(term) 的查询条件 先通过索引表查出候选订单id 再在候选集上用 LIKE 校验
+    回填未完成时只用 LIKE; 还没同步进索引的订单(update_time 在水位附近及之后)也作为候选
+    """
+    since = unindexed_since()
+    if since is None:
+        return like(field, term)
+    query = candidate_ids(field, term)
+    if query is None:
+        return like(field, term)
+    # 两条查询各自走索引(三元组主键 / (update_time, id)) 在内存里合并 多取一个用来判断是否超过上限
+    ids = {order_id for order_id, in query.limit(MAX_CANDIDATES + 1).tuples()}
+    ids.update(order_id for order_id, in (ShipmentOrderInfo
+                                          .select(ShipmentOrderInfo.id)
+                                          .where(ShipmentOrderInfo.update_time > since)
+                                          .limit(MAX_CANDIDATES + 1)
+                                          .tuples()))
+    if len(ids) > MAX_CANDIDATES:
+        return like(field, term)
+    return ShipmentOrderInfo.id.in_(sorted(ids)) & like(field, term)
+
+
+def backfill(batch_size: int = BATCH_SIZE):
+    """按id分批回填所有订单的三元组索引 完成后记录水位(回填期间修改的订单由 sync 补上) 返回处理的订单数"""
+    ShipmentOrderNgram.create_table(safe=True)
+    jobstate.create_table()
+    start = datetime.now()
+    last_id, total = 0, 0
+    while True:
+        rows = list(index_query()
+                    .where(ShipmentOrderInfo.id > last_id)
+                    .order_by(ShipmentOrderInfo.id)
+                    .limit(batch_size))
+        if not rows:
+            jobstate.set_watermark(JOB_NAME, start)
+            return total
+        index_orders(rows)
+        last_id = rows[-1][0]
+        total += len(rows)
+
+
+def sync(batch_size: int = BATCH_SIZE):
+    """
+    重建 update_time 晚于 水位 - SYNC_LAG_SECONDS 的订单的索引 并把水位推进到本次开始的时间 返回处理的订单数
+    回填未完成(没有水位)时不处理
+    """
+    since = unindexed_since()
+    if since is None:
+        return 0
+    start = datetime.now()
+    last_id, total = 0, 0
+    while True:
+        rows = list(index_query()
+                    .where((ShipmentOrderInfo.update_time > since) & (ShipmentOrderInfo.id > last_id))
+                    .order_by(ShipmentOrderInfo.id)
+                    .limit(batch_size))
+        if not rows:
+            jobstate.set_watermark(JOB_NAME, start)
+            return total
+        index_orders(rows)
+        last_id = rows[-1][0]
+        total += len(rows)
+
+
+def benchmark(term: str, repeat: int = 5) -> dict:
+    """对比 LIKE 全表扫描和三元组索引两种子串搜索的平均耗时(毫秒) 索引方式包括查候选id的时间"""
+    result = {}
+    for field in NGRAM_FIELDS.values():
+        timings = {}
+        for path, condition in (("like", like), ("ngram", contains)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                count = ShipmentOrderInfo.select(ShipmentOrderInfo.id).where(condition(field, term)).count()
+            timings[path] = round((time.perf_counter() - start) / repeat * 1000, 2)
+            timings[path + "_rows"] = count
+        result[field.name] = timings
+    return result
+
+
+def seeded_benchmark(term: str, rows: int, repeat: int = 5) -> dict:
+    """在临时SQLite库上构造 rows 个订单并回填索引后运行 benchmark 结果可重复"""
+    import tempfile
+
+    from peewee import SqliteDatabase
+
+    from apps.models import ShipmentJobState
+
+    models = [ShipmentOrderInfo, ShipmentOrderNgram, ShipmentJobState]
+    with tempfile.NamedTemporaryFile(suffix=".db") as f:
+        bench_db = SqliteDatabase(f.name)
+        with bench_db.bind_ctx(models):
+            bench_db.create_tables(models)
+            now = datetime(2025, 1, 1)
+            for i in range(0, rows, BATCH_SIZE):
+                ShipmentOrderInfo.insert_many([{
+                    "order_code": f"OC{n:08d}", "first_leg_tracking_number": f"FL{n * 7919 % 10 ** 9:09d}",
+                    "last_mile_tracking_number": f"LM{n * 104729 % 10 ** 9:09d}", "shipment_name": "shipment",
+                    "provider_code": "P01", "warehouse_code": "W01", "add_time": now, "create_time": now,
+                    "update_time": now,
+                } for n in range(i, min(i + BATCH_SIZE, rows))]).execute()
+            backfill()
+            return benchmark(term, repeat)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="订单号/追踪号三元组索引")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("backfill", help="回填已有订单的索引")
+    sub.add_parser("sync", help="增量重建水位之后写入/修改的订单的索引")
+    bench = sub.add_parser("bench", help="对比 LIKE 和索引的搜索耗时")
+    bench.add_argument("term")
+    bench.add_argument("--repeat", type=int, default=5)
+    bench.add_argument("--rows", type=int, default=None, help="在临时SQLite库上构造的订单数 不传时使用配置的数据库")
+    args = parser.parse_args()
+
+    if args.command == "bench" and args.rows:
+        for field_name, timings in seeded_benchmark(args.term, args.rows, args.repeat).items():
+            print(field_name, timings)
+    else:
+        with database:
+            if args.command == "backfill":
+                print(f"indexed {backfill()} orders")
+            elif args.command == "sync":
+                print(f"indexed {sync()} orders")
+            else:
+                for field_name, timings in benchmark(args.term, args.repeat).items():
+                    print(field_name, timings)
@@ -0,0 +1,85 @@
+"""
+pagination.py模块
+    游标(keyset)分页工具 按 (时间, id) 倒序翻页, 任意一页的代价都与第一页相同
+    依赖被分页的三张表上的 (create_time, id) 联合索引, 没有这个索引时每一页仍是全表扫描加排序
+
+    python -m apps.shipments.pagination migrate    给已有的三张表添加 (create_time, id) 索引
+"""
+import argparse
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from playhouse.migrate import SchemaMigrator, migrate
+
+from apps.models import database, ShipmentExceptionHandle, ShipmentOrderException, ShipmentOrderInfo
+
+# 使用游标分页的表 排序时间都是 create_time
+CURSOR_MODELS = [ShipmentOrderInfo, ShipmentOrderException, ShipmentExceptionHandle]
+
+
+def is_cursor_mode(filters) -> bool:
+    """请求体是否启用了游标分页(显式开启或传入了after游标)"""
+    return bool(filters.cursor) or bool(filters.after)
+
+
+def encode_cursor(sort_time: datetime, row_id: int) -> str:
+    """把(排序时间, id)编码为不透明的游标字符串"""
+    raw = json.dumps([sort_time.isoformat(), row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> tuple:
+    """把游标字符串解码为(排序时间, id)"""
+    try:
+        # 补齐编码时去掉的 '='
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        sort_time, row_id = json.loads(raw)
+        return datetime.fromisoformat(sort_time), int(row_id)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {token}") from e
+
+
+def after_cursor(query, time_field, id_field, after: str = None):
+    """在查询上追加 (time_field, id_field) < 游标 的条件, 并按同样的顺序倒序排序"""
+    if after:
+        sort_time, row_id = decode_cursor(after)
+        # 展开成OR条件 让MySQL可以走 (create_time, id) 联合索引上的范围扫描
+        query = query.where(
+            (time_field < sort_time) | ((time_field == sort_time) & (id_field < row_id))
+        )
+    return query.order_by(time_field.desc(), id_field.desc())
+
+
+def cursor_page(query, time_field, id_field, after: str, page_size: int, time_attr: str, id_attr: str):
+    """
+    执行一页游标分页查询
+    多取一条用来判断是否还有下一页, 返回(当前页结果列表, 下一页游标 没有下一页时为None)
+    time_attr/id_attr 是结果行上读取排序时间和id的属性名或键名(字段可能被alias过)
+    """
+    rows = list(after_cursor(query, time_field, id_field, after).limit(page_size + 1))
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    last = rows[-1]
+    if isinstance(last, dict):
+        # .dicts() 查询的结果行
+        return rows, encode_cursor(last[time_attr], last[id_attr])
+    return rows, encode_cursor(getattr(last, time_attr), getattr(last, id_attr))
+
+
+def add_indexes():
+    """给已有的三张表添加 (create_time, id) 索引"""
+    migrator = SchemaMigrator.from_database(database)
+    migrate(*[migrator.add_index(model._meta.table_name, ("create_time", "id"), False) for model in CURSOR_MODELS])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="游标分页")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="添加 (create_time, id) 索引")
+    args = parser.parse_args()
+
+    with database:
+        add_indexes()
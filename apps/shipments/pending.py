@@ -0,0 +1,102 @@
+"""
+pending.py模块
+    订单的待审核节点数(pending_count)和最新轨迹时间(latest_track_time)
+    节点写入/审核时在同一事务里增量维护, 待审核列表直接按订单表上的索引列查询, 不再 JOIN + GROUP BY 节点表
+    对账任务按订单id分批用节点表重建这两个字段, 修正可能的偏差
+
+    python -m apps.shipments.pending migrate      给订单表添加 pending_count 列 并做一次全量对账
+    python -m apps.shipments.pending reconcile    全量对账重建
+"""
+import argparse
+import time
+from collections import defaultdict
+
+from peewee import Case, fn
+from playhouse.migrate import SchemaMigrator, migrate
+
+from apps.models import database, ShipmentFirstLegTracking, ShipmentOrderInfo
+from apps.shipments import totals
+
+PENDING = "PENDING"
+
+
+def apply_changes(changes: dict):
+    """
+    在当前事务中调整订单的待审核节点数 并推进最新轨迹时间
+    changes: 订单号 -> (待审核数变化量, 新节点中最晚的轨迹时间 没有时为None)
+    变化相同的订单合并成一条 UPDATE
+    """
+    groups = defaultdict(list)
+    for order_code, (delta, track_time) in changes.items():
+        if delta or track_time:
+            groups[(delta, track_time)].append(order_code)
+
+    for (delta, track_time), order_codes in groups.items():
+        update = {}
+        if delta:
+            update[ShipmentOrderInfo.pending_count] = ShipmentOrderInfo.pending_count + delta
+        if track_time:
+            # 只向后推进 不覆盖更晚的轨迹时间
+            latest = ShipmentOrderInfo.latest_track_time
+            update[latest] = Case(None, [((latest.is_null() | (latest < track_time)), track_time)], latest)
+        ShipmentOrderInfo.update(update).where(ShipmentOrderInfo.order_code.in_(order_codes)).execute()
+    if groups:
+        totals.totals_cache.invalidate(totals.PENDING)
+
+
+def node_changes(nodes) -> dict:
+    """
+    按新写入的节点汇总每个订单的变化
+    nodes: (订单号, 审核状态, 轨迹时间) 元组
+    """
+    changes = {}
+    for order_code, identify_status, track_time in nodes:
+        delta, latest = changes.get(order_code, (0, None))
+        if identify_status == PENDING:
+            delta += 1
+        if track_time and (latest is None or track_time > latest):
+            latest = track_time
+        changes[order_code] = (delta, latest)
+    return changes
+
+
+class PendingReconcile:
+    """用节点表批量重建订单的 pending_count 和 latest_track_time"""
+
+    BATCH_SIZE = 5000
+
+    def run(self) -> dict:
+        """按订单id区间分批 每批一条带关联子查询的 UPDATE"""
+        start = time.perf_counter()
+        o, t = ShipmentOrderInfo, ShipmentFirstLegTracking
+        pending = t.select(fn.COUNT(t.id)).where((t.order_code == o.order_code) & (t.identify_status == PENDING))
+        latest = t.select(fn.MAX(t.track_time)).where(t.order_code == o.order_code)
+
+        max_id = o.select(fn.MAX(o.id)).scalar() or 0
+        for low in range(0, max_id, self.BATCH_SIZE):
+            with database.atomic():
+                o.update({
+                    o.pending_count: pending,
+                    o.latest_track_time: fn.COALESCE(latest, o.latest_track_time),
+                }).where(o.id.between(low + 1, low + self.BATCH_SIZE)).execute()
+        totals.totals_cache.invalidate(totals.PENDING)
+        return {"maxId": max_id, "seconds": round(time.perf_counter() - start, 3)}
+
+
+def add_column():
+    """给已有的订单表添加 pending_count 列和索引"""
+    migrator = SchemaMigrator.from_database(database)
+    migrate(migrator.add_column(ShipmentOrderInfo._meta.table_name, "pending_count", ShipmentOrderInfo.pending_count))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="订单待审核节点数")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="给订单表添加 pending_count 列 并做一次全量对账")
+    sub.add_parser("reconcile", help="用节点表重建 pending_count 和 latest_track_time")
+    args = parser.parse_args()
+
+    with database:
+        if args.command == "migrate":
+            add_column()
+        print(PendingReconcile().run())
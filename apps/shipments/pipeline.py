@@ -0,0 +1,316 @@
+"""
+pipeline.py模块
+    物流商原始轨迹(ShipmentProviderTracking.first_leg_tracking) -> 轨迹节点(ShipmentFirstLegTracking) 的增量入库
+    1. 按 update_time 水位只读取上次运行之后有变化、且头程尚未完结(is_first_finished=0)的原始记录
+    2. 在进程池里解析原始报文, 每个订单只保留不早于已入库节点最新时间(高水位)的事件, 再交给分类器识别轨迹类型/节点/置信度
+    3. 置信度低于阈值的节点标记为待审核(PENDING), 用 INSERT IGNORE 按 (order_code, node_id) 去重写入, 同时维护订单的待审核数
+
+    node_id 由事件时间和内容哈希得到, 同一事件重复解析得到的id不变, 任务重跑不会产生重复节点
+
+    python -m apps.shipments.pipeline migrate       创建任务水位表
+    python -m apps.shipments.pipeline run           增量入库 --workers 进程数 --classifier 模块:类名
+    python -m apps.shipments.pipeline bench         在SQLite上构造数据 测量 nodes/sec
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from itertools import repeat
+from typing import List, NamedTuple, Optional
+
+from peewee import fn
+
+from apps import events
+from apps.models import database, bulk_insert, ShipmentFirstLegTracking, ShipmentProviderTracking
+from apps.shipments import jobstate, pending
+
+JOB_NAME = "provider_tracking_pipeline"
+AUTO_ACCEPTED = "自动采纳"
+# 置信度低于该值的节点需要人工审核
+CONFIDENCE_THRESHOLD = 0.8
+
+# 原始报文里事件列表/时间/内容可能使用的键名
+LIST_KEYS = ("tracks", "events", "trackDetails", "details", "data")
+TIME_KEYS = ("time", "trackTime", "track_time", "eventTime", "date")
+CONTENT_KEYS = ("content", "trackContent", "track_content", "description", "desc", "status")
+# 非JSON报文按行解析: "2025-01-01 10:00:00 内容"
+LINE_PATTERN = re.compile(r"^\s*(\d{4}[-/]\d{1,2}[-/]\d{1,2}(?:[ T]\d{1,2}:\d{2}(?::\d{2})?)?)\s+(.+?)\s*$")
+
+
+class Classification(NamedTuple):
+    """分类器对单条轨迹的识别结果"""
+    track_type: Optional[str]
+    track_node: Optional[str]
+    confidence: float
+
+
+class Classifier:
+    """
+    轨迹分类器接口 一次识别一批轨迹内容(方便接入按批调用的模型服务)
+    实现会被发送到子进程中运行 需要可以pickle
+    """
+
+    def classify(self, contents: List[str]) -> List[Classification]:
+        raise NotImplementedError
+
+
+class KeywordClassifier(Classifier):
+    """按关键字识别的确定性分类器 用于本地开发和测试"""
+
+    # (关键字, 轨迹类型, 轨迹节点) 按顺序匹配第一条
+    RULES = (
+        ("签收", "派送", "签收"),
+        ("delivered", "派送", "签收"),
+        ("派送", "派送", "派送"),
+        ("out for delivery", "派送", "派送"),
+        ("到港", "海运", "到港"),
+        ("arrived", "海运", "到港"),
+        ("开船", "海运", "开船"),
+        ("departed", "海运", "开船"),
+        ("揽收", "仓库", "发货"),
+        ("picked up", "仓库", "发货"),
+    )
+
+    def classify(self, contents):
+        result = []
+        for content in contents:
+            text = content.lower()
+            for keyword, track_type, track_node in self.RULES:
+                if keyword in text:
+                    result.append(Classification(track_type, track_node, 0.95))
+                    break
+            else:
+                result.append(Classification(None, None, 0.3))
+        return result
+
+
+def load_classifier(path: str) -> Classifier:
+    """按 模块:类名 加载分类器"""
+    module, _, name = path.partition(":")
+    return getattr(importlib.import_module(module), name)()
+
+
+def parse_time(value) -> Optional[datetime]:
+    """解析事件时间 去掉时区信息(与库里的 DATETIME 一致) 无法解析时返回None"""
+    if isinstance(value, (int, float)):
+        # 毫秒/秒时间戳
+        return datetime.fromtimestamp(value / 1000 if value > 1e11 else value)
+    if not isinstance(value, str):
+        return None
+    value = value.strip().replace("/", "-")
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=None, microsecond=0)
+    except ValueError:
+        return None
+
+
+def parse_events(payload: str) -> list:
+    """把原始报文解析为 (事件时间, 内容) 列表 解析失败的事件直接跳过"""
+    if not payload:
+        return []
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        events = []
+        for line in payload.splitlines():
+            match = LINE_PATTERN.match(line)
+            if match and (track_time := parse_time(match.group(1))):
+                events.append((track_time, match.group(2)))
+        return events
+
+    if isinstance(data, dict):
+        data = next((data[key] for key in LIST_KEYS if isinstance(data.get(key), list)), [])
+    events = []
+    for event in data if isinstance(data, list) else []:
+        if not isinstance(event, dict):
+            continue
+        track_time = parse_time(next((event[k] for k in TIME_KEYS if event.get(k)), None))
+        content = next((event[k] for k in CONTENT_KEYS if event.get(k)), None)
+        if track_time and content:
+            events.append((track_time, str(content).strip()))
+    return events
+
+
+def make_node_id(track_time: datetime, content: str) -> str:
+    """由事件时间和内容生成稳定的节点id"""
+    return hashlib.sha1(f"{track_time:%Y-%m-%d %H:%M:%S}|{content}".encode()).hexdigest()[:20]
+
+
+def parse_batch(rows: list, classifier: Classifier, threshold: float) -> list:
+    """
+    (在子进程中)解析并分类一批原始轨迹
+    rows: (订单号, 原始报文, 高水位) 元组 高水位之前的事件已经入库 直接丢弃
+    返回: (order_code, node_id, track_time, track_content, track_type, track_node, confidence, identify_status) 元组
+    """
+    events = []
+    for order_code, payload, high_water in rows:
+        for track_time, content in parse_events(payload):
+            if high_water is None or track_time >= high_water:
+                events.append((order_code, make_node_id(track_time, content), track_time, content))
+    labels = classifier.classify([event[3] for event in events])
+    return [
+        (*event, label.track_type, label.track_node, round(label.confidence, 2),
+         pending.PENDING if label.confidence < threshold else AUTO_ACCEPTED)
+        for event, label in zip(events, labels)
+    ]
+
+
+class NodePipeline:
+    """原始轨迹 -> 轨迹节点 的增量入库"""
+
+    # 每批读取的原始记录数 一批一个事务
+    BATCH_SIZE = 1000
+    FIELDS = [
+        ShipmentFirstLegTracking.order_code,
+        ShipmentFirstLegTracking.node_id,
+        ShipmentFirstLegTracking.track_time,
+        ShipmentFirstLegTracking.track_content,
+        ShipmentFirstLegTracking.track_type,
+        ShipmentFirstLegTracking.track_node,
+        ShipmentFirstLegTracking.confidence,
+        ShipmentFirstLegTracking.identify_status,
+        ShipmentFirstLegTracking.source,
+        ShipmentFirstLegTracking.create_time,
+        ShipmentFirstLegTracking.update_time,
+    ]
+
+    def __init__(self, classifier: Classifier = None, workers: int = None, threshold: float = CONFIDENCE_THRESHOLD):
+        self.classifier = classifier or KeywordClassifier()
+        # workers<=1 时在当前进程解析
+        self.workers = os.cpu_count() if workers is None else workers
+        self.threshold = threshold
+
+    def run(self) -> dict:
+        """处理水位之后的全部原始记录 返回处理的记录数/新增节点数/吞吐"""
+        start = time.perf_counter()
+        p = ShipmentProviderTracking
+        query = p.select(p.id, p.order_code, p.first_leg_tracking, p.update_time).where(p.is_first_finished == 0)
+        watermark = jobstate.get_watermark(JOB_NAME)
+        if watermark:
+            # 与水位相同时间的记录可能在上次运行之后才写入 重新处理一次(节点按id去重)
+            query = query.where(p.update_time >= watermark)
+        query = query.order_by(p.update_time, p.id)
+
+        payloads, inserted, last = 0, 0, None
+        pool = ProcessPoolExecutor(self.workers) if self.workers > 1 else None
+        try:
+            while True:
+                batch = query
+                if last:
+                    batch = batch.where((p.update_time > last[0]) | ((p.update_time == last[0]) & (p.id > last[1])))
+                rows = list(batch.limit(self.BATCH_SIZE).tuples())
+                if not rows:
+                    break
+                inserted += self.process(rows, pool)
+                payloads += len(rows)
+                last = (rows[-1][3], rows[-1][0])
+        finally:
+            if pool:
+                pool.shutdown()
+
+        seconds = time.perf_counter() - start
+        return {"payloads": payloads, "nodes": inserted, "seconds": round(seconds, 3),
+                "nodesPerSecond": round(inserted / seconds) if seconds else 0}
+
+    def process(self, rows: list, pool) -> int:
+        """解析、分类并写入一批原始记录 返回新增的节点数"""
+        high_water = self.high_water_marks({row[1] for row in rows})
+        tasks = [(order_code, payload, high_water.get(order_code)) for _, order_code, payload, _ in rows]
+        if pool:
+            size = max(1, len(tasks) // (self.workers * 4))
+            chunks = [tasks[i:i + size] for i in range(0, len(tasks), size)]
+            parsed = pool.map(parse_batch, chunks, repeat(self.classifier), repeat(self.threshold))
+            nodes = [node for chunk in parsed for node in chunk]
+        else:
+            nodes = parse_batch(tasks, self.classifier, self.threshold)
+
+        # 同一批里重复出现的事件 以及恰好落在高水位时间上、已经入库的事件
+        nodes = list({(node[0], node[1]): node for node in nodes}.values())
+        existing = self.existing_nodes([node for node in nodes if node[2] == high_water.get(node[0])])
+        nodes = [node for node in nodes if (node[0], node[1]) not in existing]
+
+        now = datetime.now()
+        # 与 bulk_insert 一样取模型绑定的库(benchmark 会临时绑定到SQLite)
+        with ShipmentFirstLegTracking._meta.database.atomic():
+            # 并发运行时仍可能撞上唯一索引 IGNORE 保证不会失败
+            bulk_insert(ShipmentFirstLegTracking, self.FIELDS, [(*node, 0, now, now) for node in nodes], action="IGNORE")
+            pending.apply_changes(pending.node_changes((node[0], node[7], node[2]) for node in nodes))
+            jobstate.set_watermark(JOB_NAME, rows[-1][3])
+        events.publish(events.NODE_PENDING, [node[0] for node in nodes if node[7] == pending.PENDING])
+        return len(nodes)
+
+    @staticmethod
+    def high_water_marks(order_codes) -> dict:
+        """每个订单已入库的接口节点(source=0)的最新轨迹时间"""
+        t = ShipmentFirstLegTracking
+        query = (t.select(t.order_code, fn.MAX(t.track_time))
+                 .where(t.order_code.in_(list(order_codes)) & (t.source == 0))
+                 .group_by(t.order_code))
+        return dict(query.tuples())
+
+    @staticmethod
+    def existing_nodes(nodes: list) -> set:
+        """已入库的 (order_code, node_id)"""
+        if not nodes:
+            return set()
+        t = ShipmentFirstLegTracking
+        query = t.select(t.order_code, t.node_id).where(
+            t.order_code.in_({node[0] for node in nodes}) & t.node_id.in_({node[1] for node in nodes})
+        )
+        return set(query.tuples())
+
+
+def benchmark(orders: int = 2000, events: int = 30, workers: int = None):
+    """在临时SQLite库上构造原始轨迹 测量首次入库和无变化重跑的吞吐"""
+    import tempfile
+
+    from peewee import SqliteDatabase
+
+    from apps.models import ShipmentJobState, ShipmentOrderInfo
+
+    models = [ShipmentOrderInfo, ShipmentFirstLegTracking, ShipmentProviderTracking, ShipmentJobState]
+    contents = ["Picked up by carrier", "Departed from port", "Arrived at port", "Customs clearance", "Out for delivery"]
+    with tempfile.NamedTemporaryFile(suffix=".db") as f:
+        bench_db = SqliteDatabase(f.name)
+        with bench_db.bind_ctx(models):
+            bench_db.create_tables(models)
+            base = datetime(2025, 1, 1)
+            ShipmentProviderTracking.insert_many([{
+                "order_code": f"OC{i:08d}",
+                "first_leg_tracking": json.dumps({"tracks": [
+                    {"time": f"{base + timedelta(hours=k):%Y-%m-%d %H:%M:%S}", "content": f"{contents[k % len(contents)]} #{k}"}
+                    for k in range(events)]}),
+                "create_time": base, "update_time": base,
+            } for i in range(orders)]).execute()
+            for label in ("initial", "rerun"):
+                print(label, NodePipeline(workers=workers).run())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="原始轨迹 -> 轨迹节点 增量入库")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="创建任务水位表")
+    run = sub.add_parser("run", help="增量入库")
+    run.add_argument("--workers", type=int, default=None, help="解析进程数 默认CPU核数")
+    run.add_argument("--classifier", default=None, help="分类器 模块:类名 默认关键字分类器")
+    run.add_argument("--threshold", type=float, default=CONFIDENCE_THRESHOLD, help="低于该置信度的节点需要人工审核")
+    bench = sub.add_parser("bench", help="测量 nodes/sec")
+    bench.add_argument("--orders", type=int, default=2000)
+    bench.add_argument("--events", type=int, default=30)
+    bench.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        benchmark(args.orders, args.events, args.workers)
+    else:
+        with database:
+            if args.command == "migrate":
+                jobstate.create_table()
+            else:
+                classifier = load_classifier(args.classifier) if args.classifier else None
+                print(NodePipeline(classifier, args.workers, args.threshold).run())
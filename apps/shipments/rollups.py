@@ -0,0 +1,121 @@
+"""
+rollups.py模块
+    看板用的异常数汇总
+    shipment_exception_rollup 按 (异常类型, 异常节点, 处置状态, 物流商) 每组一行计数,
+    新增异常(SLA检测)和处置(单个/批量)时在同一事务里增减对应分组的计数,
+    看板一次读出全部分组, 代价与分组数成正比, 不再为每个格子 COUNT 一次异常表
+
+    直接改库/订单换物流商等不经过上述路径的变化会让计数漂移, 定期执行 rebuild 全量重算纠正
+
+    python -m apps.shipments.rollups migrate    创建汇总表并全量计算
+    python -m apps.shipments.rollups rebuild    全量重算(定时任务)
+"""
+import argparse
+import time
+from collections import Counter
+from datetime import datetime
+
+from peewee import JOIN, fn
+
+from apps.models import database, bulk_insert, conflict_target, lock_rows, ShipmentExceptionRollup, \
+    ShipmentOrderException, ShipmentOrderInfo
+from apps.shipments import schemas, serializers
+
+# 分组维度 与汇总表的唯一索引一致
+DIMENSIONS = ("exception_type", "exception_node", "status", "provider_code")
+
+
+def provider_codes(order_codes) -> dict:
+    """订单号 -> 物流商 一次IN查询"""
+    order_codes = list(set(order_codes))
+    if not order_codes:
+        return {}
+    o = ShipmentOrderInfo
+    return dict(o.select(o.order_code, o.provider_code).where(o.order_code.in_(order_codes)).tuples())
+
+
+def rollup_key(exception_type: str, exception_node: str, status: str, provider_code) -> tuple:
+    """分组key 物流商为空时记为空字符串"""
+    return exception_type, exception_node, status, provider_code or ""
+
+
+def apply_changes(changes: dict):
+    """
+    增减分组计数 应在写入异常的事务里调用
+    changes: rollup_key(...) -> 增量(可为负) 每个非零分组一条 upsert, 计数在数据库里原子地累加
+    """
+    r = ShipmentExceptionRollup
+    now = datetime.now()
+    for key, delta in changes.items():
+        if not delta:
+            continue
+        (r.insert(**dict(zip(DIMENSIONS, key)), exception_count=delta, update_time=now)
+         .on_conflict(conflict_target=conflict_target(r.exception_type, r.exception_node, r.status, r.provider_code),
+                      update={r.exception_count: r.exception_count + delta, r.update_time: now})
+         .execute())
+
+
+def status_changes(exceptions, new_status: dict) -> Counter:
+    """
+    处置导致的计数变化
+    exceptions: (异常id, 订单号, 异常类型, 异常节点, 原状态) 元组; new_status: 异常id -> 新状态
+    """
+    exceptions = list(exceptions)
+    providers = provider_codes(row[1] for row in exceptions)
+    changes = Counter()
+    for exception_id, order_code, exception_type, exception_node, status in exceptions:
+        provider_code = providers.get(order_code)
+        changes[rollup_key(exception_type, exception_node, status, provider_code)] -= 1
+        changes[rollup_key(exception_type, exception_node, new_status[exception_id], provider_code)] += 1
+    return changes
+
+
+def rebuild() -> dict:
+    """按异常表全量重算汇总表(一条 GROUP BY) 在一个事务里整表替换"""
+    start = time.perf_counter()
+    e, o = ShipmentOrderException, ShipmentOrderInfo
+    query = (e.select(e.exception_type, e.exception_node, e.status, fn.COALESCE(o.provider_code, ""), fn.COUNT(e.id))
+             .join(o, JOIN.LEFT_OUTER, on=(e.order_code == o.order_code))
+             .group_by(e.exception_type, e.exception_node, e.status, fn.COALESCE(o.provider_code, "")))
+    now = datetime.now()
+    r = ShipmentExceptionRollup
+    with database.atomic():
+        # 先锁住整张汇总表(MySQL下为全部行及其间隙): 已经改了异常但还没提交的写入方持有汇总行的锁, 等它们提交后
+        # 下面的 GROUP BY 才读取, 会包含它们的改动; 之后的写入方在汇总表上等待, 在重算结果上累加 计数不会丢
+        list(lock_rows(r.select(r.id)).tuples())
+        rows = [(*row, now) for row in query.tuples()]
+        r.delete().execute()
+        bulk_insert(r, [r.exception_type, r.exception_node, r.status, r.provider_code, r.exception_count, r.update_time],
+                    rows)
+    return {"groups": len(rows), "exceptions": sum(row[4] for row in rows),
+            "seconds": round(time.perf_counter() - start, 3)}
+
+
+class ExceptionRollups:
+    """看板异常数"""
+
+    def get_tiles(self) -> schemas.ShipmentsExceptionRollupResult:
+        """读出全部非零分组"""
+        tiles = serializers.to_items(schemas.ShipmentsExceptionRollupItem, self.query.dicts())
+        return schemas.ShipmentsExceptionRollupResult(total=sum(tile.count for tile in tiles), tiles=tiles)
+
+    @property
+    def query(self):
+        """查询数据库操作"""
+        r = ShipmentExceptionRollup
+        return (r.select(r.exception_type, r.exception_node, r.status, r.provider_code, r.exception_count)
+                .where(r.exception_count > 0)
+                .order_by(r.exception_type, r.exception_node, r.status, r.provider_code))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="看板异常数汇总")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="创建汇总表并全量计算")
+    sub.add_parser("rebuild", help="全量重算")
+    args = parser.parse_args()
+
+    with database:
+        if args.command == "migrate":
+            ShipmentExceptionRollup.create_table(safe=True)
+        print(rebuild())
@@ -5,11 +5,19 @@ schemas.py模块
 import math
 from datetime import datetime
 from decimal import Decimal
-from typing import Optional, Any, List
+from typing import Optional, Any, List, Literal
 
-from pydantic import Field
+from pydantic import Field, field_validator
 
 from apps.schemas import BaseModelWithORM
+from apps.shipments.pagination import decode_cursor
+
+
+def check_cursor(value: Optional[str]) -> Optional[str]:
+    """游标必须能解码 格式错误或被篡改时在请求校验阶段报错(返回400 而不是查询时500)"""
+    if value is not None:
+        decode_cursor(value)
+    return value
 
 
 class ShipmentsOrdersRequest(BaseModelWithORM):
@@ -17,6 +25,9 @@ class ShipmentsOrdersRequest(BaseModelWithORM):
     # Field()是 Pydantic中用来声明字段属性的方式
     pageSize: int = Field(default=10, title="每页的大小")
     pageNum: int = Field(default=1, title="当前页码")
+    cursor: Optional[bool] = Field(default=False, title="是否启用游标分页(启用后忽略pageNum)")
+    after: Optional[str] = Field(default=None, title="游标分页 上一页返回的nextCursor")
+    countMode: Optional[Literal["exact", "estimate", "none"]] = Field(default="exact", title="总数计算方式 精确/估算/不计算")
     # 查询条件
     orderCode: Optional[str] = Field(default=None, title="订单号")
     firstLegTrackingNumber: Optional[str] = Field(default=None, title="头程追踪号")
@@ -34,6 +45,28 @@ class ShipmentsOrdersRequest(BaseModelWithORM):
     portArrivalDate: Optional[List[datetime]] = Field(default=None, title="到港日期")
     deliveryDate: Optional[List[datetime]] = Field(default=None, title="派送日期")
     signedDate: Optional[List[datetime]] = Field(default=None, title="签收日期")
+    # 时效区间条件(天 数组[最小值, 最大值])
+    shippingDays: Optional[List[int]] = Field(default=None, title="已发货天数")
+    warehouseAging: Optional[List[int]] = Field(default=None, title="仓库时效")
+    navigationAging: Optional[List[int]] = Field(default=None, title="航行时效")
+    portDeliveryDate: Optional[List[int]] = Field(default=None, title="到港派送时效")
+    deliveryAcceptAging: Optional[List[int]] = Field(default=None, title="签收时效")
+    shelfAging: Optional[List[int]] = Field(default=None, title="上架时效")
+    # 排序(仅页码分页 游标分页固定按创建时间倒序)
+    sortBy: Optional[Literal[
+        "shippingDays", "warehouseAging", "navigationAging", "portDeliveryDate", "deliveryAcceptAging", "shelfAging",
+    ]] = Field(default=None, title="排序字段 默认按创建时间")
+    sortDesc: Optional[bool] = Field(default=True, title="是否倒序")
+
+    @field_validator("after")
+    @classmethod
+    def check_after(cls, value):
+        return check_cursor(value)
+
+
+class ShipmentsOrdersExportRequest(ShipmentsOrdersRequest):
+    """出货单管理-出货单导出请求体 筛选条件与出货单列表相同"""
+    format: Literal["csv", "ndjson"] = Field(default="csv", title="导出格式")
 
 
 class ShipmentsOrderUpdateRequest(BaseModelWithORM):
@@ -63,15 +96,112 @@ class ShipmentsOrderUpdateRequest(BaseModelWithORM):
     costDifference: Decimal = Field(..., title="费用差异", alias="cost_difference")
 
 
+class ShipmentsOrderTrackHistory(BaseModelWithORM):
+    """出货单管理-订单的头程完整轨迹和轨迹历史(按需加载)"""
+    orderCode: str = Field(..., title="订单号")
+    totalTrack: Optional[str] = Field(default=None, title="头程完整轨迹")
+    trackingHistory: Optional[str] = Field(default=None, title="轨迹历史")
+
+
+class ShipmentsOrderBatchUpdateItem(BaseModelWithORM):
+    """出货单管理-批量修改中的单个订单"""
+    orderCode: str = Field(..., title="订单号", alias="order_code")
+    data: ShipmentsOrderUpdateRequest = Field(..., title="修改内容")
+
+
+class ShipmentsOrderBatchUpdateRequest(BaseModelWithORM):
+    """出货单管理-批量修改请求体"""
+    items: List[ShipmentsOrderBatchUpdateItem] = Field(..., title="要修改的订单列表")
+
+
+class ShipmentsOrderBatchUpdateResult(BaseModelWithORM):
+    """出货单管理-批量修改结果"""
+    updated: int = Field(default=0, title="修改的订单数")
+    missing: List[str] = Field(default=[], title="不存在的订单号")
+
+
+class ShipmentsOrderIngestItem(BaseModelWithORM):
+    """出货单管理-批量导入的单个订单 默认值与数据库默认值一致"""
+    orderCode: str = Field(..., title="订单号", alias="order_code")
+    firstLegTrackingNumber: str = Field(..., title="头程追踪号", alias="first_leg_tracking_number")
+    lastMileTrackingNumber: Optional[str] = Field(default=None, title="尾程追踪号", alias="last_mile_tracking_number")
+    shipmentName: str = Field(..., title="货件名称", alias="shipment_name")
+    providerCode: str = Field(..., title="物流商", alias="provider_code")
+    warehouseCode: str = Field(..., title="仓库代码", alias="warehouse_code")
+    shippingWarehouse: Optional[str] = Field(default=None, title="发货仓库", alias="shipping_warehouse")
+    countryCode: Optional[str] = Field(default=None, title="目的国家", alias="country_code")
+    destination: Optional[str] = Field(default=None, title="目的地", alias="destination")
+    businessCode: Optional[str] = Field(default=None, title="业务单号", alias="business_code")
+    itemNum: int = Field(default=0, title="商品数", alias="item_num")
+    shippingChannel: Optional[str] = Field(default=None, title="物流渠道", alias="shipping_channel")
+    shippingMethod: Optional[str] = Field(default=None, title="运输方式", alias="shipping_method")
+    boxNum: Optional[int] = Field(default=0, title="箱数", alias="box_num")
+    weight: Optional[Decimal] = Field(default=None, title="重量", alias="weight")
+    volumeWeight: Optional[Decimal] = Field(default=None, title="体积重", alias="volume_weight")
+    billingHeavy: Optional[Decimal] = Field(default=None, title="计费重", alias="billing_heavy")
+    price: Optional[Decimal] = Field(default=None, title="单价", alias="price")
+    freight: Optional[Decimal] = Field(default=None, title="运费", alias="freight")
+    totalCost: Optional[Decimal] = Field(default=None, title="合计费用", alias="total_cost")
+    providerCost: Optional[Decimal] = Field(default=None, title="物流商费用", alias="provider_cost")
+    costDifference: Optional[Decimal] = Field(default=None, title="费用差异", alias="cost_difference")
+    customsDuty: Optional[Decimal] = Field(default=None, title="关税", alias="customs_duty")
+    clearanceFee: Optional[Decimal] = Field(default=None, title="清关费", alias="clearance_fee")
+    extraCategoryFee: Optional[Decimal] = Field(default=None, title="附加费", alias="extra_category_fee")
+    superProductFee: Optional[Decimal] = Field(default=None, title="超品名费", alias="super_product_fee")
+    deduction: Optional[Decimal] = Field(default=None, title="扣减", alias="deduction")
+    shippingDate: Optional[datetime] = Field(default=None, title="发货日期", alias="shipping_date")
+    departureDate: Optional[datetime] = Field(default=None, title="开船日期", alias="departure_date")
+    portArrivalDate: Optional[datetime] = Field(default=None, title="到港日期", alias="port_arrival_date")
+    deliveryDate: Optional[datetime] = Field(default=None, title="派送日期", alias="delivery_date")
+    shippingStatus: Optional[str] = Field(default="待发货", title="物流状态", alias="shipping_status")
+    signedDate: Optional[datetime] = Field(default=None, title="签收日期", alias="signed_date")
+    signedNum: Optional[int] = Field(default=0, title="已签收数", alias="signed_num")
+    shelvedTime: Optional[datetime] = Field(default=None, title="上架完成时间", alias="shelved_time")
+    remark: Optional[str] = Field(default=None, title="其他(业务备注)", alias="remark")
+
+
+class ShipmentsOrderIngestRequest(BaseModelWithORM):
+    """出货单管理-批量导入请求体 订单逐条校验 不合法的订单单独拒绝 不影响其他订单"""
+    orders: List[dict] = Field(..., title="订单列表")
+
+
+class ShipmentsOrderIngestRejected(BaseModelWithORM):
+    """出货单管理-批量导入被拒绝的订单"""
+    index: int = Field(..., title="在请求订单列表中的下标")
+    orderCode: Optional[str] = Field(default=None, title="订单号")
+    errors: List[dict] = Field(default=None, title="校验错误")
+
+
+class ShipmentsOrderIngestResult(BaseModelWithORM):
+    """出货单管理-批量导入结果"""
+    inserted: int = Field(default=0, title="新增订单数")
+    updated: int = Field(default=0, title="更新订单数")
+    rejected: int = Field(default=0, title="拒绝订单数")
+    rejectedItems: List[ShipmentsOrderIngestRejected] = Field(default=[], title="被拒绝的订单")
+
+
 class ShipmentsTrackingRequest(BaseModelWithORM):
     """头程轨迹跟踪-头程轨迹所有节点请求体"""
     identifyStatus: Optional[str] = Field(default=None, title="审核状态", alias="identify_status")
 
 
+class ShipmentsTrackingBatchRequest(BaseModelWithORM):
+    """头程轨迹跟踪-多个订单的轨迹节点请求体"""
+    orderCodes: List[str] = Field(..., min_length=1, max_length=500, title="订单号列表")
+    identifyStatus: Optional[str] = Field(default=None, title="审核状态", alias="identify_status")
+    limit: Optional[int] = Field(default=None, ge=1, title="每个订单最多返回的节点数(按轨迹时间取最新的)")
+
+
+class ShipmentsEventsRequest(BaseModelWithORM):
+    """头程轨迹跟踪-节点变更事件流请求体"""
+    lastEventId: Optional[int] = Field(default=None, title="从该事件之后开始推送(断线重连时浏览器会带上 Last-Event-ID 请求头)")
+
+
 class ShipmentsPendingRequest(BaseModelWithORM):
     """头程轨迹跟踪-轨迹订单节点列表请求体"""
     pageSize: int = Field(default=10, title="每页的大小")
     pageNum: int = Field(default=1, title="当前页码")
+    countMode: Optional[Literal["exact", "estimate", "none"]] = Field(default="exact", title="总数计算方式 精确/估算/不计算")
     shipmentName: Optional[str] = Field(default=None, title="货件名称")
     providerCode: Optional[str] = Field(default=None, title="物流商")
     orderCode: Optional[str] = Field(default=None, title="订单号")
@@ -85,6 +215,28 @@ class ShipmentsReviewPostRequest(BaseModelWithORM):
     artificialNodeDate: datetime = Field(..., title="人工节点时间", alias="artificial_node_date")
 
 
+class ShipmentsReviewBatchItem(ShipmentsReviewPostRequest):
+    """头程轨迹跟踪-批量审核中的单个节点"""
+    id: int = Field(..., title="节点id", alias="id")
+
+
+class ShipmentsReviewBatchRequest(BaseModelWithORM):
+    """头程轨迹跟踪-批量审核请求体"""
+    items: List[ShipmentsReviewBatchItem] = Field(..., title="要审核的节点列表")
+
+
+class ShipmentsReviewBatchOutcome(BaseModelWithORM):
+    """头程轨迹跟踪-批量审核中单个节点的结果"""
+    id: int = Field(..., title="节点id")
+    status: Literal["REVIEWED", "NOT_FOUND"] = Field(..., title="审核结果 已审核/节点不存在")
+
+
+class ShipmentsReviewBatchResult(BaseModelWithORM):
+    """头程轨迹跟踪-批量审核结果"""
+    reviewed: int = Field(default=0, title="审核的节点数")
+    results: List[ShipmentsReviewBatchOutcome] = Field(default=[], title="每个节点的结果(与请求顺序一致)")
+
+
 class ShipmentsAddNodeRequest(BaseModelWithORM):
     """头程轨迹跟踪-添加节点请求体"""
     orderCode: str = Field(..., title="订单号", alias="order_code")
@@ -98,6 +250,9 @@ class ShipmentsExceptionsRequest(BaseModelWithORM):
     """异常处置-异常列表请求体"""
     pageSize: int = Field(default=10, title="每页的大小")
     pageNum: int = Field(default=1, title="当前页码")
+    cursor: Optional[bool] = Field(default=False, title="是否启用游标分页(启用后忽略pageNum)")
+    after: Optional[str] = Field(default=None, title="游标分页 上一页返回的nextCursor")
+    countMode: Optional[Literal["exact", "estimate", "none"]] = Field(default="exact", title="总数计算方式 精确/估算/不计算")
     orderCode: Optional[str] = Field(default=None, title="订单号")
     firstLegTrackingNumber: Optional[str] = Field(default=None, title="头程追踪号")
     shipmentName: Optional[str] = Field(default=None, title="货件名称")
@@ -106,6 +261,11 @@ class ShipmentsExceptionsRequest(BaseModelWithORM):
     exceptionDate: Optional[List[datetime]] = Field(default=None, title="触发时间(我们系统计算的时间)")
     status: Optional[List[str]] = Field(default=None, title="触发时间(我们系统计算的时间)")
 
+    @field_validator("after")
+    @classmethod
+    def check_after(cls, value):
+        return check_cursor(value)
+
 
 class ShipmentsExceptionsProcessingRequest(BaseModelWithORM):
     """异常处置-异常处置操作body参数"""
@@ -113,33 +273,85 @@ class ShipmentsExceptionsProcessingRequest(BaseModelWithORM):
     status: str = Field(..., title="异常处置状态")
 
 
+class ShipmentsExceptionsBatchProcessingItem(ShipmentsExceptionsProcessingRequest):
+    """异常处置-批量处置中的单个异常"""
+    exceptionId: int = Field(..., title="异常id")
+
+
+class ShipmentsExceptionsBatchProcessingRequest(BaseModelWithORM):
+    """异常处置-批量处置请求体"""
+    items: List[ShipmentsExceptionsBatchProcessingItem] = Field(..., title="要处置的异常列表")
+
+
+class ShipmentsExceptionsBatchProcessingOutcome(BaseModelWithORM):
+    """异常处置-批量处置中单个异常的结果"""
+    exceptionId: int = Field(..., title="异常id")
+    status: Literal["PROCESSED", "NOT_FOUND"] = Field(..., title="处置结果 已处置/异常不存在")
+
+
+class ShipmentsExceptionsBatchProcessingResult(BaseModelWithORM):
+    """异常处置-批量处置结果"""
+    processed: int = Field(default=0, title="处置的异常数")
+    results: List[ShipmentsExceptionsBatchProcessingOutcome] = Field(default=[], title="每个异常的结果(与请求顺序一致)")
+
+
+class ShipmentsExceptionRollupItem(BaseModelWithORM):
+    """异常处置-看板中一个分组的异常数"""
+    exceptionType: str = Field(..., title="异常类型", alias="exception_type")
+    exceptionNode: str = Field(..., title="异常节点", alias="exception_node")
+    status: str = Field(..., title="处置状态", alias="status")
+    providerCode: str = Field(..., title="物流商 找不到订单时为空字符串", alias="provider_code")
+    count: int = Field(..., title="异常数", alias="exception_count")
+
+
+class ShipmentsExceptionRollupResult(BaseModelWithORM):
+    """异常处置-看板异常数"""
+    total: int = Field(default=0, title="异常总数")
+    tiles: List[ShipmentsExceptionRollupItem] = Field(default=[], title="每个分组的异常数")
+
+
 class ShipmentsExceptionsLogsRequest(BaseModelWithORM):
     """异常处置-异常处理日志列表请求体"""
     pageSize: int = Field(default=10, title="每页的大小")
     pageNum: int = Field(default=1, title="当前页码")
+    cursor: Optional[bool] = Field(default=False, title="是否启用游标分页(启用后忽略pageNum)")
+    after: Optional[str] = Field(default=None, title="游标分页 上一页返回的nextCursor")
+    countMode: Optional[Literal["exact", "estimate", "none"]] = Field(default="exact", title="总数计算方式 精确/估算/不计算")
     exceptionId: Optional[int] = Field(default=None, title="异常ID")
     orderCode: Optional[str] = Field(default=None, title="订单号")
     firstLegTrackingNumber: Optional[str] = Field(default=None, title="头程追踪号")
     shipmentName: Optional[str] = Field(default=None, title="货件名称")
 
+    @field_validator("after")
+    @classmethod
+    def check_after(cls, value):
+        return check_cursor(value)
+
 
 class PaginationResponse(BaseModelWithORM):
-    """分页应答体"""
-    totalElements: int = Field(..., title="符合条件的总记录数")
-    totalPages: int = Field(default=1, title="总页数")
+    """分页应答体 countMode=none时总数和总页数为空"""
+    totalElements: Optional[int] = Field(..., title="符合条件的总记录数")
+    totalPages: Optional[int] = Field(default=1, title="总页数")
     pageSize: int = Field(..., title="每页的大小")
     pageNum: int = Field(..., title="当前页码")
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.totalPages = math.ceil(self.totalElements / self.pageSize)
+        if self.totalElements is None:
+            self.totalPages = None
+        else:
+            self.totalPages = math.ceil(self.totalElements / self.pageSize)
+
+    def is_out_of_range(self) -> bool:
+        """传入的页码数是否 > 总页数 总数未知时不判断"""
+        return self.totalPages is not None and self.pageNum > self.totalPages
 
 
 class ShipmentsOrdersItem(BaseModelWithORM):
     """出货单管理-订单列表中要返回的的货件字段"""
     orderCode: str = Field(..., title="订单号", alias="order_code")  # ...表示该字段必填
     firstLegTrackingNumber: str = Field(..., title="头程追踪号", alias="first_leg_tracking_number")
-    lastMileTrackingNumber: str = Field(..., title="尾程跟踪号", alias="last_mile_tracking_number")
+    lastMileTrackingNumber: Optional[str] = Field(default=None, title="尾程跟踪号", alias="last_mile_tracking_number")
     countryCode: Optional[str] = Field(default=None, title="目的国家", alias="country_code")
     warehouseCode: Optional[str] = Field(default=None, title="仓库代码", alias="warehouse_code")
     shipmentName: Optional[str] = Field(default=None, title="货件名称", alias="shipment_name")
@@ -165,13 +377,14 @@ class ShipmentsOrdersResult(PaginationResponse):
     content存储内容列表 该类继承分页响应体 创建时带上分页参数
     """
     content: List[ShipmentsOrdersItem] = Field(default=None, title="内容列表")
+    nextCursor: Optional[str] = Field(default=None, title="游标分页的下一页游标 没有下一页时为空")
 
 
 class ShipmentsDetailItem(BaseModelWithORM):
     """出货单管理-订单详情页中要返回的的字段"""
     orderCode: str = Field(..., title="订单号", alias="order_code")  # ...表示该字段必填
     firstLegTrackingNumber: str = Field(..., title="头程追踪号", alias="first_leg_tracking_number")
-    lastMileTrackingNumber: str = Field(..., title="尾程跟踪号", alias="last_mile_tracking_number")
+    lastMileTrackingNumber: Optional[str] = Field(default=None, title="尾程跟踪号", alias="last_mile_tracking_number")
     shipmentName: Optional[str] = Field(default=None, title="货件名称", alias="shipment_name")
     warehouseCode: Optional[str] = Field(default=None, title="仓库代码", alias="warehouse_code")
     addTime: Optional[datetime] = Field(default=None, title="创建时间", alias="add_time")
@@ -278,6 +491,7 @@ class ShipmentsExceptionsItem(ExceptionsItem, ExceptionsJoinItem):
 class ShipmentsExceptionsResult(PaginationResponse):
     """异常处置管理-返回具体信息的结构"""
     content: List[ShipmentsExceptionsItem] = Field(default=None, title="内容列表")
+    nextCursor: Optional[str] = Field(default=None, title="游标分页的下一页游标 没有下一页时为空")
 
 
 class ExceptionLogsItem(BaseModelWithORM):
@@ -309,6 +523,72 @@ class ShipmentsExceptionLogsItem(ExceptionLogsItem, ExceptionLogsJoinInfoItem, E
 class ShipmentsExceptionLogsResult(PaginationResponse):
     """异常处置记录-异常处置记录列表的返回响应体"""
     content: List[ShipmentsExceptionLogsItem] = Field(default=None, title="内容列表")
+    nextCursor: Optional[str] = Field(default=None, title="游标分页的下一页游标 没有下一页时为空")
+
+
+class ShipmentsExceptionTimelineRequest(ShipmentsExceptionsRequest):
+    """异常处置-异常时间线请求体 筛选条件与异常列表相同 固定为游标分页且不计算总数"""
+
+
+class ShipmentsExceptionTimelineLog(ExceptionLogsItem):
+    """异常处置-时间线中一条处置记录"""
+    handleTime: datetime = Field(..., title="处置时间", alias="handle_time")
+
+
+class ShipmentsExceptionTimelineItem(ExceptionsItem):
+    """异常处置-时间线中的一个异常及其全部处置记录"""
+    logs: List[ShipmentsExceptionTimelineLog] = Field(default=[], title="处置记录(按处置时间正序)", alias="logs")
+
+
+class ShipmentsExceptionTimelineResult(BaseModelWithORM):
+    """异常处置-异常时间线返回响应体"""
+    content: List[ShipmentsExceptionTimelineItem] = Field(default=[], title="内容列表")
+    nextCursor: Optional[str] = Field(default=None, title="下一页游标 没有下一页时为空")
+
+
+class ShipmentsChangesRequest(BaseModelWithORM):
+    """增量同步-变更流请求体"""
+    feed: Literal["nodes", "exceptions", "orders"] = Field(..., title="变更流 轨迹节点/异常/订单")
+    after: Optional[str] = Field(default=None, title="上次返回的nextCursor 为空时从头读取")
+    limit: int = Field(default=500, ge=1, le=2000, title="每批最多返回的行数")
+
+    @field_validator("after")
+    @classmethod
+    def check_after(cls, value):
+        return check_cursor(value)
+
+
+class ShipmentsChangeNodeItem(ShipmentsTrackingItem):
+    """增量同步-轨迹节点变更"""
+    orderCode: str = Field(..., title="订单号", alias="order_code")
+    nodeId: str = Field(..., title="节点id", alias="node_id")
+    updateTime: datetime = Field(..., title="最新更新时间", alias="update_time")
+
+
+class ShipmentsChangeExceptionItem(BaseModelWithORM):
+    """增量同步-异常变更"""
+    id: int = Field(..., title="异常id", alias="id")
+    orderCode: str = Field(..., title="订单号", alias="order_code")
+    exceptionType: str = Field(..., title="异常类型", alias="exception_type")
+    exceptionNode: str = Field(..., title="异常节点", alias="exception_node")
+    exceptionDescribe: Optional[str] = Field(default=None, title="异常描述", alias="exception_describe")
+    status: str = Field(..., title="处置状态", alias="status")
+    operatorName: Optional[str] = Field(default=None, title="操作人", alias="operator_name")
+    createTime: datetime = Field(..., title="触发时间", alias="create_time")
+    updateTime: datetime = Field(..., title="最新更新时间", alias="update_time")
+
+
+class ShipmentsChangeOrderItem(ShipmentsDetailItem):
+    """增量同步-订单变更"""
+    id: int = Field(..., title="订单id", alias="id")
+    updateTime: datetime = Field(..., title="最新更新时间", alias="update_time")
+
+
+class ShipmentsChangesResult(BaseModelWithORM):
+    """增量同步-变更流响应体"""
+    content: List[Any] = Field(default=[], title="按 (updateTime, id) 升序的变更行")
+    nextCursor: Optional[str] = Field(default=None, title="下次请求传入的after 没有新变更时与请求的after相同")
+    hasMore: bool = Field(default=False, title="是否还有未读取的变更(为真时可以立即继续读取)")
 
 
 class Response(BaseModelWithORM):
@@ -0,0 +1,129 @@
+"""
+serializers.py模块
+    列表接口的批量序列化
+    查询用 .dicts() 取行(不构造peewee模型实例), 再用 TypeAdapter(List[...]) 一次性批量校验为响应模型,
+    代替逐行 model_validate + model_dump 的组合, 输出的JSON不变
+
+    python -m apps.shipments.serializers    在内存SQLite上对比新旧两种方式每个接口的 rows/sec
+"""
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import lru_cache
+from typing import List, Type
+
+from pydantic import BaseModel, TypeAdapter
+
+
+@lru_cache(maxsize=None)
+def list_adapter(schema: Type[BaseModel]) -> TypeAdapter:
+    """每个响应模型只构建一次列表校验器"""
+    return TypeAdapter(List[schema])
+
+
+def to_items(schema: Type[BaseModel], rows) -> list:
+    """把 .dicts() 查询结果(键为数据库列名 即模型的alias)批量校验为响应模型列表"""
+    return list_adapter(schema).validate_python(list(rows))
+
+
+def _benchmark(rows: int = 20000, repeat: int = 3):
+    """在内存SQLite上构造数据 对比每个列表接口 逐行校验 与 批量校验 的吞吐"""
+    from peewee import JOIN, SqliteDatabase
+
+    from apps.models import (ShipmentOrderInfo, ShipmentFirstLegTracking, ShipmentOrderException,
+                             ShipmentExceptionHandle)
+    from apps.shipments import schemas
+    from apps.shipments.exception import ExceptionList, ExceptionLogs
+    from apps.shipments.order import OrderList
+    from apps.shipments.track import PendingList, TrackingNodes
+
+    models = [ShipmentOrderInfo, ShipmentFirstLegTracking, ShipmentOrderException, ShipmentExceptionHandle]
+    database = SqliteDatabase(":memory:")
+    with database.bind_ctx(models):
+        database.create_tables(models)
+        now = datetime.now()
+        ShipmentOrderInfo.insert_many([{
+            "order_code": f"OC{i:08d}", "first_leg_tracking_number": f"FL{i:08d}",
+            "last_mile_tracking_number": f"LM{i:08d}", "shipment_name": "shipment", "provider_code": "P01",
+            "warehouse_code": "W01", "add_time": now, "shipping_date": now - timedelta(days=i % 30),
+            "create_time": now, "update_time": now, "weight": Decimal("1.5"),
+        } for i in range(rows)]).execute()
+        ShipmentFirstLegTracking.insert_many([{
+            "order_code": "OC00000000", "node_id": str(i), "track_time": now, "track_content": "content",
+            "confidence": Decimal("0.9"), "create_time": now, "update_time": now,
+        } for i in range(rows)]).execute()
+        ShipmentOrderException.insert_many([{
+            "order_code": f"OC{i:08d}", "exception_type": "type", "exception_node": "node", "status": "待处理",
+            "create_time": now, "update_time": now,
+        } for i in range(rows)]).execute()
+        ShipmentExceptionHandle.insert_many([{
+            "exception_id": i + 1, "order_code": f"OC{i:08d}", "content": "content", "status": "待处理",
+            "operator_uid": 1, "operator_name": "admin", "create_time": now, "update_time": now,
+        } for i in range(rows)]).execute()
+
+        # 改动前的列表查询: 异常列表/处置记录在查询里直接关联订单表(和异常表)
+        o, e, h = ShipmentOrderInfo, ShipmentOrderException, ShipmentExceptionHandle
+        joined_exceptions = e.select(
+            e.id.alias("exception_id"), e.order_code, o.provider_code, o.shipment_name, o.first_leg_tracking_number,
+            e.exception_type, e.exception_node, e.create_time.alias("exception_date"), e.status, e.update_time,
+        ).join(o, join_type=JOIN.LEFT_OUTER, on=(e.order_code == o.order_code), attr="t").order_by(e.id)
+        joined_logs = (h.select(
+            h.id, h.status, h.content, h.operator_name, h.create_time.alias("handle_time"),
+            e.exception_type, e.exception_node, e.create_time, o.first_leg_tracking_number, o.shipment_name,
+        ).join(o, on=(h.order_code == o.order_code), join_type=JOIN.LEFT_OUTER, attr="s")
+            .switch(h)
+            .join(e, on=(h.exception_id == e.id), join_type=JOIN.LEFT_OUTER, attr="e")
+            .order_by(h.id))
+
+        def legacy_exceptions():
+            return [schemas.ShipmentsExceptionsItem(
+                **schemas.ExceptionsItem.model_validate(q).model_dump(),
+                **schemas.ExceptionsJoinItem.model_validate(q.t).model_dump(),
+            ) for q in joined_exceptions.clone()]
+
+        def legacy_logs():
+            return [schemas.ShipmentsExceptionLogsItem(
+                **schemas.ExceptionLogsJoinInfoItem.model_validate(q.s).model_dump(),
+                **schemas.ExceptionLogsItem.model_validate(q).model_dump(),
+                **schemas.ExceptionLogsJoinExceptionItem.model_validate(q.e).model_dump(),
+            ) for q in joined_logs.clone()]
+
+        def legacy(schema, query):
+            return lambda: [schema.model_validate(q) for q in query.clone()]
+
+        def batched(schema, query, fill=list):
+            # fill: 分页之后补关联表字段的函数(与接口里的 get_details 一致)
+            return lambda: to_items(schema, fill(list(query.clone().dicts())))
+
+        exceptions = ExceptionList(schemas.ShipmentsExceptionsRequest()).query.order_by(e.id)
+        logs = ExceptionLogs(schemas.ShipmentsExceptionsLogsRequest()).query.order_by(h.id)
+        cases = []
+        for name, query, schema in (
+                ("orders", OrderList(schemas.ShipmentsOrdersRequest()).query, schemas.ShipmentsOrdersItem),
+                ("pending", PendingList(schemas.ShipmentsPendingRequest()).query, schemas.ShipmentsPendingItem),
+                ("tracking", TrackingNodes("OC00000000", schemas.ShipmentsTrackingRequest()).query,
+                 schemas.ShipmentsTrackingItem)):
+            cases.append((name, legacy(schema, query), batched(schema, query)))
+        cases += [
+            ("exceptions", legacy_exceptions,
+             batched(schemas.ShipmentsExceptionsItem, exceptions, ExceptionList.fill_order_columns)),
+            ("exception_logs", legacy_logs,
+             batched(schemas.ShipmentsExceptionLogsItem, logs, ExceptionLogs.fill_join_columns)),
+        ]
+        for name, old_path, new_path in cases:
+            timings = {}
+            for path, run in (("per-row", old_path), ("batched", new_path)):
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    items = run()
+                timings[path] = (time.perf_counter() - start) / repeat
+                timings[path + "_dump"] = [i.model_dump() for i in items]
+            assert timings["per-row_dump"] == timings["batched_dump"], name
+            count = len(timings["batched_dump"])
+            print(f"{name:<16} rows={count:<7} per-row={count / timings['per-row']:>10.0f} rows/s"
+                  f"  batched={count / timings['batched']:>10.0f} rows/s"
+                  f"  x{timings['per-row'] / timings['batched']:.1f}")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,303 @@
+"""
+sla.py模块
+    订单时效(SLA)异常的批量检测
+    按id分批读取订单的日期列, 用NumPy整列判断是否违反规则, 对违反规则且没有未关闭同类异常的订单
+    批量写入 ShipmentOrderException 并标记订单 is_exception=1
+
+    规则:
+        轨迹停滞     未签收 且最新轨迹时间之后 STALE_TRACK_DAYS 天没有新轨迹
+        到港超期     已开船未到港 且超过开船日期 + 渠道预计航程(TRANSIT_DAYS)
+        派送未签收   已派送未签收 且超过派送日期 UNSIGNED_DAYS 天
+
+    增量检测: 只处理上次运行之后有变化的订单(update_time / latest_track_time 晚于上次运行),
+    以及规则期限恰好落在 (上次运行, 本次运行] 之间的订单(没有任何变化 但随着时间推移刚刚超期);
+    每个条件单独按索引查出订单id 在内存里合并后按id分块读取, 不做带OR的全表扫描.
+    标记异常时会更新订单的 update_time(变更流需要), 这些自身的写入不能让下一次运行重新检测:
+    处理完之后再补查本次运行期间 update_time 有变化的订单(跳过本次自己写入的), 直到某一轮没有新的写入,
+    水位记为这一轮开始的时间 — 水位之后只剩其他写入方的修改
+
+    python -m apps.shipments.sla run [--full]     检测 --full 全量检测
+    python -m apps.shipments.sla migrate          给参与增量检测的日期列添加索引
+    python -m apps.shipments.sla bench            在SQLite上构造订单 测量全量检测耗时
+"""
+import argparse
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+import numpy as np
+from peewee import Case
+from playhouse.migrate import SchemaMigrator, migrate
+
+from apps.models import database, bulk_insert, ShipmentOrderException, ShipmentOrderInfo
+from apps.shipments import jobstate, rollups, totals
+from apps.shipments.exception import CLOSED_STATUSES, PENDING_STATUS
+from apps.shipments.order import order_detail_cache
+
+JOB_NAME = "sla_detection"
+
+STALE_TRACK_DAYS = 5
+UNSIGNED_DAYS = 3
+# 物流渠道 -> 预计航程(开船到到港 天) 未配置的渠道使用 DEFAULT_TRANSIT_DAYS
+TRANSIT_DAYS = {}
+DEFAULT_TRANSIT_DAYS = 35
+
+# 参与规则计算的日期列
+DATE_COLUMNS = ["latest_track_time", "departure_date", "port_arrival_date", "delivery_date", "signed_date"]
+# 增量检测按范围查找的日期列(需要索引)
+INDEXED_COLUMNS = ["latest_track_time", "departure_date", "delivery_date"]
+
+
+class SlaRule(NamedTuple):
+    exception_type: str
+    exception_node: str
+    describe: str
+
+
+RULES = {
+    "stale_track": SlaRule("轨迹停滞", "头程运输", f"最新轨迹之后超过{STALE_TRACK_DAYS}天没有新轨迹"),
+    "port_overdue": SlaRule("到港超期", "到港", "超过开船日期加预计航程仍未到港"),
+    "unsigned": SlaRule("派送未签收", "签收", f"派送后超过{UNSIGNED_DAYS}天仍未签收"),
+}
+
+
+def evaluate(columns: dict, channels: np.ndarray, now: np.datetime64) -> dict:
+    """
+    按列判断一批订单违反了哪些规则
+    columns: 日期列名 -> datetime64[s] 数组(空值为NaT); channels: 物流渠道数组
+    返回: 规则名 -> 布尔数组
+    """
+    latest, departure, arrival, delivery, signed = (columns[name] for name in DATE_COLUMNS)
+    unsigned = np.isnat(signed)
+
+    # 每个渠道只查一次预计航程
+    names, inverse = np.unique(channels.astype(str), return_inverse=True)
+    transit = np.array([TRANSIT_DAYS.get(name, DEFAULT_TRANSIT_DAYS) for name in names], dtype="timedelta64[D]")[inverse]
+
+    # NaT 参与比较的结果都是 False
+    return {
+        "stale_track": unsigned & (latest + np.timedelta64(STALE_TRACK_DAYS, "D") <= now),
+        "port_overdue": np.isnat(arrival) & (departure + transit <= now),
+        "unsigned": unsigned & (delivery + np.timedelta64(UNSIGNED_DAYS, "D") <= now),
+    }
+
+
+class SlaEngine:
+    """SLA异常批量检测"""
+
+    BATCH_SIZE = 50000
+    # 增量检测时每条 id IN (...) 的订单数
+    ID_CHUNK_SIZE = 5000
+
+    def __init__(self, full: bool = False):
+        # full=True 时忽略上次运行时间 检测全部订单
+        self.full = full
+        # 本次运行写入的订单 id -> 写入的 update_time 补查时跳过
+        self.own_writes = {}
+
+    def candidate_ids(self, last_run: datetime, now: datetime) -> set:
+        """需要(重新)检测的订单id 见模块说明 每个条件一条走索引的查询"""
+        o = ShipmentOrderInfo
+        stale, unsigned = timedelta(days=STALE_TRACK_DAYS), timedelta(days=UNSIGNED_DAYS)
+        transits = list(TRANSIT_DAYS.values()) + [DEFAULT_TRANSIT_DAYS]
+        ids = self.changed_ids(last_run)
+        for condition in (
+                o.latest_track_time.between(last_run - stale, now - stale),
+                o.delivery_date.between(last_run - unsigned, now - unsigned),
+                o.departure_date.between(last_run - timedelta(days=max(transits)), now - timedelta(days=min(transits))),
+        ):
+            ids.update(order_id for order_id, in o.select(o.id).where(condition).tuples())
+        return ids
+
+    def changed_ids(self, since: datetime) -> set:
+        """update_time / latest_track_time 晚于 since 的订单id 不包括本次运行自己写入 update_time 的订单"""
+        o = ShipmentOrderInfo
+        ids = {order_id for order_id, update_time in o.select(o.id, o.update_time).where(o.update_time > since).tuples()
+               if self.own_writes.get(order_id) != update_time}
+        ids.update(order_id for order_id, in o.select(o.id).where(o.latest_track_time > since).tuples())
+        return ids
+
+    def run(self) -> dict:
+        """检测 返回检测的订单数/新增异常数/耗时"""
+        start = time.perf_counter()
+        now = datetime.now().replace(microsecond=0)
+        last_run = None if self.full else jobstate.get_watermark(JOB_NAME)
+
+        if last_run:
+            scanned, created = self.scan_ids(self.candidate_ids(last_run, now), now)
+        else:
+            scanned, created = self.scan_all(now)
+        # 补查本次运行期间其他写入方修改(以及期限刚好到期)的订单 直到某一轮没有新的写入
+        watermark, written = now, created
+        while written:
+            since, watermark = watermark, datetime.now().replace(microsecond=0)
+            checked, written = self.scan_ids(self.candidate_ids(since, watermark), watermark)
+            scanned, created = scanned + checked, created + written
+
+        jobstate.set_watermark(JOB_NAME, watermark)
+        if created:
+            totals.totals_cache.invalidate(totals.ORDERS, totals.EXCEPTIONS)
+        return {"orders": scanned, "exceptions": created, "seconds": round(time.perf_counter() - start, 3)}
+
+    def select_rows(self):
+        o = ShipmentOrderInfo
+        return o.select(o.id, o.order_code, o.provider_code, o.shipping_channel,
+                        *[getattr(o, name) for name in DATE_COLUMNS])
+
+    def fetch(self, query) -> list:
+        # 直接取驱动返回的原始值 日期交给NumPy批量解析(SQLite返回字符串 MySQL返回datetime)
+        return ShipmentOrderInfo._meta.database.execute(query).fetchall()
+
+    def scan_all(self, now: datetime) -> tuple:
+        """按主键分批检测全部订单 返回(检测的订单数, 新增异常数)"""
+        o = ShipmentOrderInfo
+        last_id, scanned, created = 0, 0, 0
+        while True:
+            rows = self.fetch(self.select_rows().where(o.id > last_id).order_by(o.id).limit(self.BATCH_SIZE))
+            if not rows:
+                return scanned, created
+            created += self.process(rows, now)
+            scanned += len(rows)
+            last_id = rows[-1][0]
+
+    def scan_ids(self, ids, now: datetime) -> tuple:
+        """按主键分块检测指定的订单 返回(检测的订单数, 新增异常数)"""
+        ids = sorted(ids)
+        scanned, created = 0, 0
+        for i in range(0, len(ids), self.ID_CHUNK_SIZE):
+            rows = self.fetch(self.select_rows().where(ShipmentOrderInfo.id.in_(ids[i:i + self.ID_CHUNK_SIZE])))
+            if rows:
+                created += self.process(rows, now)
+                scanned += len(rows)
+        return scanned, created
+
+    def process(self, rows: list, now: datetime) -> int:
+        """检测一批订单并写入新异常 返回新增的异常数"""
+        ids, codes, providers, channels, *dates = zip(*rows)
+        providers = dict(zip(codes, providers))
+        codes = np.array(codes, dtype=object)
+        columns = {name: np.array(values, dtype="datetime64[s]") for name, values in zip(DATE_COLUMNS, dates)}
+        breaches = evaluate(columns, np.array(channels, dtype=object), np.datetime64(now, "s"))
+
+        found = [(code, rule) for rule, mask in breaches.items() for code in codes[mask].tolist()]
+        if not found:
+            return 0
+        existing = self.open_exceptions({code for code, _ in found})
+        new = [(code, RULES[rule]) for code, rule in found if (code, RULES[rule].exception_type) not in existing]
+        if not new:
+            return 0
+
+        fields = [ShipmentOrderException.order_code, ShipmentOrderException.exception_type,
+                  ShipmentOrderException.exception_node, ShipmentOrderException.exception_describe,
+                  ShipmentOrderException.status, ShipmentOrderException.create_time, ShipmentOrderException.update_time]
+        new_codes = list({code for code, _ in new})
+        # 写入时间取本批事务开始的时间 不用整次运行开始的 now: 变更流要求 update_time 到提交之间不超过 SETTLE_SECONDS
+        # 精确到秒(MySQL的DATETIME不存微秒) 补查时按读回的 update_time 识别自己的写入
+        written = datetime.now().replace(microsecond=0)
+        # 与 bulk_insert 一样取模型绑定的库(benchmark 会临时绑定到SQLite)
+        with ShipmentOrderException._meta.database.atomic():
+            bulk_insert(ShipmentOrderException, fields, [
+                (code, rule.exception_type, rule.exception_node, rule.describe, PENDING_STATUS, written, written)
+                for code, rule in new
+            ], adapt=False)
+            o = ShipmentOrderInfo
+            # is_exception 不影响时效: 时效原本是最新的订单同时推进 aging_time, 不因为这次写入被时效任务重算
+            # aging_time 放在最前面 MySQL 按顺序赋值, 这样比较的是修改前的 update_time
+            update = {
+                o.aging_time: Case(None, [(o.aging_time >= o.update_time, written)], o.aging_time),
+                o.is_exception: 1,
+                o.update_time: written,
+            }
+            for i in range(0, len(new_codes), 1000):
+                o.update(update).where(o.order_code.in_(new_codes[i:i + 1000])).execute()
+            rollups.apply_changes(Counter(
+                rollups.rollup_key(rule.exception_type, rule.exception_node, PENDING_STATUS, providers[code])
+                for code, rule in new
+            ))
+        order_detail_cache.invalidate(*new_codes)
+        order_ids = dict(zip(codes.tolist(), ids))
+        self.own_writes.update((order_ids[code], written) for code in new_codes)
+        return len(new)
+
+    @staticmethod
+    def open_exceptions(order_codes) -> set:
+        """这些订单未关闭的 (订单号, 异常类型)"""
+        e = ShipmentOrderException
+        order_codes = list(order_codes)
+        types = [rule.exception_type for rule in RULES.values()]
+        existing = set()
+        for i in range(0, len(order_codes), 1000):
+            query = e.select(e.order_code, e.exception_type).where(
+                e.order_code.in_(order_codes[i:i + 1000]) & e.exception_type.in_(types) & e.status.not_in(CLOSED_STATUSES)
+            )
+            existing.update(query.tuples())
+        return existing
+
+
+def add_indexes():
+    """给已有的订单表添加增量检测用的日期列索引"""
+    migrator = SchemaMigrator.from_database(database)
+    migrate(*[migrator.add_index(ShipmentOrderInfo._meta.table_name, (name,), False) for name in INDEXED_COLUMNS])
+
+
+def benchmark(orders: int = 1000000):
+    """在临时SQLite库上构造订单 测量全量检测和紧接着的增量检测耗时"""
+    import random
+    import tempfile
+
+    from peewee import SqliteDatabase
+
+    from apps.models import ShipmentExceptionRollup, ShipmentJobState
+
+    random.seed(0)
+    models = [ShipmentOrderInfo, ShipmentOrderException, ShipmentJobState, ShipmentExceptionRollup]
+    with tempfile.NamedTemporaryFile(suffix=".db") as f:
+        bench_db = SqliteDatabase(f.name, pragmas={"journal_mode": "off", "synchronous": 0})
+        with bench_db.bind_ctx(models):
+            bench_db.create_tables(models)
+            now = datetime.now()
+            fields = [ShipmentOrderInfo.order_code, ShipmentOrderInfo.first_leg_tracking_number,
+                      ShipmentOrderInfo.shipment_name, ShipmentOrderInfo.provider_code,
+                      ShipmentOrderInfo.warehouse_code, ShipmentOrderInfo.shipping_channel,
+                      ShipmentOrderInfo.add_time, ShipmentOrderInfo.create_time, ShipmentOrderInfo.update_time,
+                      ShipmentOrderInfo.latest_track_time, ShipmentOrderInfo.departure_date,
+                      ShipmentOrderInfo.port_arrival_date, ShipmentOrderInfo.delivery_date, ShipmentOrderInfo.signed_date]
+
+            def maybe(value, p):
+                return value if random.random() < p else None
+
+            for chunk in range(0, orders, 100000):
+                rows = []
+                for i in range(chunk, min(chunk + 100000, orders)):
+                    departure = now - timedelta(days=random.randint(0, 60))
+                    rows.append((f"OC{i:08d}", f"FL{i:08d}", "shipment", "P01", "W01", random.choice(["SEA", "FAST", None]),
+                                 now, now - timedelta(days=90), now - timedelta(days=90),
+                                 now - timedelta(days=random.randint(0, 10)), departure,
+                                 maybe(departure + timedelta(days=30), 0.5), maybe(departure + timedelta(days=40), 0.3),
+                                 maybe(departure + timedelta(days=45), 0.2)))
+                with bench_db.atomic():
+                    bulk_insert(ShipmentOrderInfo, fields, rows)
+
+            for label, full in (("full", True), ("incremental", False)):
+                print(label, SlaEngine(full=full).run())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="订单SLA异常批量检测")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="检测")
+    run.add_argument("--full", action="store_true", help="全量检测")
+    sub.add_parser("migrate", help="添加日期列索引")
+    bench = sub.add_parser("bench", help="测量全量检测耗时")
+    bench.add_argument("--orders", type=int, default=1000000)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        benchmark(args.orders)
+    else:
+        with database:
+            if args.command == "migrate":
+                add_indexes()
+            else:
+                print(SlaEngine(full=args.full).run())
@@ -0,0 +1,119 @@
+"""
+totals.py模块
+    列表接口的总数缓存
+    按 规范化后的筛选条件 缓存count结果(带TTL), 写操作按接口作用域让缓存失效
+    countMode=estimate 时用 EXPLAIN 的行数估算代替 COUNT, countMode=none 时不计算总数
+"""
+import json
+import threading
+from collections import defaultdict
+from typing import Optional
+
+from peewee import MySQLDatabase
+
+from apps.cache import LocalBackend
+
+# 总数缓存的有效期(秒)
+TOTALS_TTL = 60
+# 总数缓存最多保存的筛选条件组合数
+TOTALS_MAXSIZE = 2048
+
+# 缓存作用域 每个分页列表接口一个
+ORDERS = "orders"
+PENDING = "pending"
+EXCEPTIONS = "exceptions"
+EXCEPTION_LOGS = "exception_logs"
+
+# 不影响总数的请求字段 不参与缓存key
+PAGING_FIELDS = {"pageNum", "pageSize", "cursor", "after", "countMode"}
+
+
+class TotalsCache:
+    """
+    按作用域分组的 TTL 总数缓存(进程内, 线程安全)
+    条目存在 LRU 的 LocalBackend 里, 不同的筛选条件(自由文本搜索)再多也不会超过 maxsize 个;
+    让作用域失效只是把该作用域的代数加一, 旧代数的条目不再被读到 随后被LRU淘汰
+    """
+
+    def __init__(self, ttl: int = TOTALS_TTL, maxsize: int = TOTALS_MAXSIZE):
+        self.ttl = ttl
+        self._backend = LocalBackend(maxsize)
+        self._generations = defaultdict(int)  # 作用域 -> 代数
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key: tuple) -> tuple:
+        # key: (scope, countMode, filters) 前面加上作用域当前的代数
+        with self._lock:
+            return (self._generations[key[0]],) + key
+
+    def get(self, key: tuple) -> Optional[int]:
+        value = self._backend.get(self._key(key))
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: tuple, value: int):
+        self._backend.set(self._key(key), value, self.ttl)
+
+    def invalidate(self, *scopes: str):
+        """让指定作用域下的所有缓存失效"""
+        with self._lock:
+            for scope in scopes:
+                self._generations[scope] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = {"hits": self.hits, "misses": self.misses}
+        return {**self._backend.stats(), **counters}
+
+
+totals_cache = TotalsCache()
+
+
+def filters_key(filters) -> str:
+    """把请求筛选条件规范化为缓存key 去掉分页字段和空值 时间区间排序"""
+    data = filters.model_dump(exclude=PAGING_FIELDS, exclude_none=True)
+    for name, value in data.items():
+        if isinstance(value, list):
+            data[name] = sorted(value)
+    return json.dumps(data, sort_keys=True, default=str)
+
+
+def estimate_count(query) -> int:
+    """用 EXPLAIN 中驱动表的 rows * filtered 估算结果行数 非MySQL时退回精确count"""
+    database = query.model._meta.database
+    if not isinstance(database, MySQLDatabase):
+        return query.count()
+    sql, params = query.sql()
+    cursor = database.execute_sql("EXPLAIN " + sql, params)
+    columns = [c[0] for c in cursor.description]
+    row = cursor.fetchone()
+    if not row:
+        return 0
+    plan = dict(zip(columns, row))
+    rows = plan.get("rows") or 0
+    filtered = plan.get("filtered") or 100
+    return int(rows * filtered / 100)
+
+
+def count_total(scope: str, query, filters) -> Optional[int]:
+    """
+    按 filters.countMode 拿列表总数
+        exact(默认): 精确count 结果按筛选条件缓存
+        estimate: 执行计划估算值 同样缓存
+        none: 不计算 返回None
+    """
+    mode = filters.countMode or "exact"
+    if mode == "none":
+        return None
+    key = (scope, mode, filters_key(filters))
+    total = totals_cache.get(key)
+    if total is None:
+        total = estimate_count(query) if mode == "estimate" else query.count()
+        totals_cache.set(key, total)
+    return total
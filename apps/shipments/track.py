@@ -1,13 +1,32 @@
 """头程轨迹跟踪接口类"""
-import random
-import time
+from collections import Counter, defaultdict
 from datetime import datetime
 from functools import cached_property
 
-from peewee import JOIN, fn
+from peewee import Case, SQL, fn
+from werkzeug.http import http_date, quote_etag
 
-from apps.models import ShipmentFirstLegTracking, ShipmentOrderInfo
-from apps.shipments import schemas
+from apps import events, idgen
+from apps.models import database, lock_rows, ShipmentFirstLegTracking, ShipmentOrderInfo
+from apps.shipments import ngram, pending, schemas, serializers, totals
+
+
+# 节点列表返回的列(ShipmentsTrackingItem)
+NODE_COLUMNS = (
+    ShipmentFirstLegTracking.id,
+    ShipmentFirstLegTracking.track_time,
+    ShipmentFirstLegTracking.track_content,
+    ShipmentFirstLegTracking.track_type,
+    ShipmentFirstLegTracking.track_node,
+    ShipmentFirstLegTracking.node_date,
+    ShipmentFirstLegTracking.confidence,
+    ShipmentFirstLegTracking.identify_status,
+    ShipmentFirstLegTracking.artificial_review_time,
+    ShipmentFirstLegTracking.artificial_track_type,
+    ShipmentFirstLegTracking.artificial_track_node,
+    ShipmentFirstLegTracking.artificial_node_date,
+    ShipmentFirstLegTracking.source,
+)
 
 
 class TrackingNodes:
@@ -20,37 +39,31 @@ class TrackingNodes:
     def get_tracking(self):
         """获取当下订单的所有轨迹节点"""
         query = self.query.order_by(ShipmentFirstLegTracking.track_time.desc())
-        # 存放节点的列表
-        node_list = []
-        for q in query:
-            # q是一条查询结果 里面包含一个节点时间 一个节点内容
-            # q 验证并转换为 ProviderTrackingItem 实例
-            detail = schemas.ShipmentsTrackingItem.model_validate(q)
-            node_list.append(detail)
-        return schemas.ShipmentsTrackingResult(nodeCount=self.get_count(), nodes=node_list)
-
-    def get_count(self):
-        """获取当下订单的节点数量"""
-        return self.query.count()
+        # 节点列表 整批校验为 ShipmentsTrackingItem
+        node_list = serializers.to_items(schemas.ShipmentsTrackingItem, query.dicts())
+        # 节点已经全部在内存中 数量直接取列表长度 不再单独 COUNT
+        return schemas.ShipmentsTrackingResult(nodeCount=len(node_list), nodes=node_list)
+
+    def get_validators(self):
+        """
+        条件请求的校验信息 只查节点数和最新修改时间 不加载节点
+        返回(ETag, 响应头) 节点新增/修改/删除都会改变其中之一
+        """
+        count, last_update = self.query.select(
+            fn.COUNT(ShipmentFirstLegTracking.id),
+            fn.MAX(ShipmentFirstLegTracking.update_time),
+        ).tuples().get()
+        version = f"{count}-{last_update:%Y%m%d%H%M%S%f}" if last_update else f"{count}"
+        etag = f"{self.order_code}-{version}"
+        headers = {"ETag": quote_etag(etag), "Cache-Control": "no-cache"}
+        if last_update:
+            headers["Last-Modified"] = http_date(last_update)
+        return etag, headers
 
     @cached_property
     def query(self):
         """查询数据库操作"""
-        query = ShipmentFirstLegTracking.select(
-            ShipmentFirstLegTracking.id,
-            ShipmentFirstLegTracking.track_time,
-            ShipmentFirstLegTracking.track_content,
-            ShipmentFirstLegTracking.track_type,
-            ShipmentFirstLegTracking.track_node,
-            ShipmentFirstLegTracking.node_date,
-            ShipmentFirstLegTracking.confidence,
-            ShipmentFirstLegTracking.identify_status,
-            ShipmentFirstLegTracking.artificial_review_time,
-            ShipmentFirstLegTracking.artificial_track_type,
-            ShipmentFirstLegTracking.artificial_track_node,
-            ShipmentFirstLegTracking.artificial_node_date,
-            ShipmentFirstLegTracking.source,
-        )
+        query = ShipmentFirstLegTracking.select(*NODE_COLUMNS)
         query = query.where(ShipmentFirstLegTracking.order_code == self.order_code)
 
         if self.filters.identifyStatus:
@@ -58,6 +71,57 @@ class TrackingNodes:
         return query
 
 
+class TrackingNodesBatch:
+    """多个订单的轨迹节点 一次 IN 查询取回后在内存中按订单分组"""
+
+    def __init__(self, filters: schemas.ShipmentsTrackingBatchRequest):
+        self.filters = filters
+        # 去重 保持请求顺序
+        self.order_codes = list(dict.fromkeys(filters.orderCodes))
+
+    def get_tracking(self) -> dict:
+        """返回 订单号 -> ShipmentsTrackingResult 没有节点的订单返回空列表"""
+        grouped = {code: [] for code in self.order_codes}
+        node_totals = {}
+        # MySQL 的 _ci 排序规则下返回的订单号大小写可能与请求的不同 按小写对应回请求的订单号
+        requested = defaultdict(list)
+        for code in self.order_codes:
+            requested[code.lower()].append(code)
+        for row in self.query.dicts():
+            for code in requested.get(row["order_code"].lower()) or [row["order_code"]]:
+                grouped.setdefault(code, []).append(row)
+                node_totals[code] = row.get("node_total")
+        return {
+            code: schemas.ShipmentsTrackingResult(
+                # 限制了每单节点数时 nodeCount 仍是该订单(符合筛选条件的)全部节点数
+                nodeCount=node_totals.get(code) or len(rows),
+                nodes=serializers.to_items(schemas.ShipmentsTrackingItem, rows),
+            )
+            for code, rows in grouped.items()
+        }
+
+    @cached_property
+    def query(self):
+        """查询数据库操作"""
+        t = ShipmentFirstLegTracking
+        query = t.select(t.order_code, *NODE_COLUMNS).where(t.order_code.in_(self.order_codes))
+        if self.filters.identifyStatus:
+            query = query.where(t.identify_status == self.filters.identifyStatus)
+        order_by = [t.track_time.desc(), t.id.desc()]
+
+        if self.filters.limit:
+            # 每个订单只取最新的 limit 个节点: 窗口函数给节点排名 外层按排名过滤
+            ranked = query.select_extend(
+                fn.ROW_NUMBER().over(partition_by=[t.order_code], order_by=order_by).alias("node_rank"),
+                fn.COUNT(t.id).over(partition_by=[t.order_code]).alias("node_total"),
+            ).alias("ranked")
+            return (t.select(SQL("*"))
+                    .from_(ranked)
+                    .where(ranked.c.node_rank <= self.filters.limit)
+                    .order_by(ranked.c.track_time.desc(), ranked.c.id.desc()))
+        return query.order_by(*order_by)
+
+
 class PendingList:
     """轨迹订单列表"""
 
@@ -74,32 +138,27 @@ class PendingList:
 
         # 拿列表
         # 判断 如果传入的页码数 > 总页数  则返回空列表
-        if self.filters.pageNum > pagination.totalPages:
+        if pagination.is_out_of_range():
             details = []
         else:
             details = self.get_details()
         return schemas.ShipmentsPendingResult(content=details, **pagination.model_dump())
 
     def get_total(self):
-        """获取查询结果总数"""
-        return self.query.count()
+        """获取查询结果总数(按筛选条件缓存)"""
+        return totals.count_total(totals.PENDING, self.query, self.filters)
 
     def get_details(self):
         """获取查询结果存入列表"""
         query = self.query.paginate(self.filters.pageNum, self.filters.pageSize)
-        # 存放带审核订单的列表
-        pending_list = []
-        for q in query:
-            # q是一条查询结果 里面包含一个节点时间 一个节点内容
-            # q 验证并转换为 ProviderTrackingItem 实例
-            detail = schemas.ShipmentsPendingItem.model_validate(q)
-            pending_list.append(detail)
-        return pending_list
+        # 待审核订单列表 整页批量校验为 ShipmentsPendingItem
+        return serializers.to_items(schemas.ShipmentsPendingItem, query.dicts())
 
     @cached_property
     def query(self):
         """查询数据库操作"""
-        query = (ShipmentOrderInfo.select(
+        # 待审核节点数是订单表上维护的计数列(见 apps.shipments.pending) 不需要 JOIN 节点表再 GROUP BY
+        query = ShipmentOrderInfo.select(
             ShipmentOrderInfo.order_code,
             ShipmentOrderInfo.shipment_name,
             ShipmentOrderInfo.first_leg_tracking_number,
@@ -107,24 +166,18 @@ class PendingList:
             ShipmentOrderInfo.provider_code,
             ShipmentOrderInfo.shipping_channel,
             ShipmentOrderInfo.latest_track_time,
-            # 统计每个订单对应的追踪记录数（重复次数）
-            # fn是用于访问数据库函数的一个对象
-            # 通过它可以调用像 COUNT、SUM、AVG、MAX、MIN 等各种数据库原生支持的聚合函数或者其他函数，来实现更复杂的查询操作
-            fn.COUNT(ShipmentFirstLegTracking.order_code).alias('pending_count')
-        ).join(ShipmentFirstLegTracking,
-               on=(ShipmentOrderInfo.order_code == ShipmentFirstLegTracking.order_code),
-               join_type=JOIN.LEFT_OUTER)
-                 .group_by(ShipmentOrderInfo.order_code))
+            ShipmentOrderInfo.pending_count,
+        )
 
         f = self.filters
         if f.orderCode:
-            query = query.where(ShipmentOrderInfo.order_code.contains(f.orderCode))
+            query = query.where(ngram.contains(ShipmentOrderInfo.order_code, f.orderCode))
         if f.shipmentName:
             query = query.where(ShipmentOrderInfo.shipment_name == f.shipmentName)
         if f.providerCode:
             query = query.where(ShipmentOrderInfo.provider_code == f.providerCode)
         if f.isPending:  # 仅展示待审核订单
-            query = query.where(ShipmentFirstLegTracking.identify_status == 'PENDING')
+            query = query.where(ShipmentOrderInfo.pending_count > 0)
         return query
 
 
@@ -144,8 +197,67 @@ class TrackReview:
         item['update_time'] = datetime.now()
         # 审核人姓名
 
-        # 执行操作
-        ShipmentFirstLegTracking.update(**item).where(ShipmentFirstLegTracking.id == self.id).execute()
+        # 执行操作 节点状态和订单的待审核数在同一事务里修改
+        with database.atomic():
+            # 锁住节点: 并发审核同一个待审核节点时 后一个事务等前一个提交后读到已审核状态 不会重复扣减待审核数
+            node = lock_rows(ShipmentFirstLegTracking
+                             .select(ShipmentFirstLegTracking.order_code, ShipmentFirstLegTracking.identify_status)
+                             .where(ShipmentFirstLegTracking.id == self.id)).first()
+            if node is None:
+                return
+            ShipmentFirstLegTracking.update(**item).where(ShipmentFirstLegTracking.id == self.id).execute()
+            if node.identify_status == pending.PENDING:
+                pending.apply_changes({node.order_code: (-1, None)})
+        events.publish(events.NODE_REVIEWED, [node.order_code], nodeIds=[self.id])
+
+
+class TrackBatchReview:
+    """人工批量审核提交"""
+
+    # 每条 UPDATE 里的节点数
+    CHUNK_SIZE = 500
+
+    def __init__(self, items: list):
+        # items: ShipmentsReviewBatchItem 列表 同一节点出现多次时以最后一条为准
+        self.items = {item.id: item for item in items}
+
+    def submit(self) -> schemas.ShipmentsReviewBatchResult:
+        """
+        一个事务内审核全部节点
+        先一次取出节点的订单号和原审核状态, 再按块用 CASE id WHEN ... 的 UPDATE 写入人工审核结果,
+        语句数与节点数无关; 原来是待审核的节点同时扣减订单的待审核数
+        """
+        ids = list(self.items)
+        now = datetime.now()
+        t = ShipmentFirstLegTracking
+        with database.atomic():
+            nodes = {}
+            for i in range(0, len(ids), self.CHUNK_SIZE):
+                # 锁住这些节点 并发审核同一节点时不会按过期的审核状态重复扣减待审核数
+                query = lock_rows(t.select(t.id, t.order_code, t.identify_status).where(t.id.in_(ids[i:i + self.CHUNK_SIZE])))
+                nodes.update((node_id, (order_code, status)) for node_id, order_code, status in query.tuples())
+
+            found = [node_id for node_id in ids if node_id in nodes]
+            for i in range(0, len(found), self.CHUNK_SIZE):
+                chunk = found[i:i + self.CHUNK_SIZE]
+                t.update({
+                    t.artificial_track_type: Case(t.id, [(n, self.items[n].artificialTrackType) for n in chunk]),
+                    t.artificial_track_node: Case(t.id, [(n, self.items[n].artificialTrackNode) for n in chunk]),
+                    t.artificial_node_date: Case(t.id, [(n, self.items[n].artificialNodeDate) for n in chunk]),
+                    t.artificial_review_time: now,
+                    t.identify_status: "COMPLETE",  # 人工已审核
+                    t.update_time: now,
+                }).where(t.id.in_(chunk)).execute()
+
+            reviewed = Counter(order_code for order_code, status in nodes.values() if status == pending.PENDING)
+            pending.apply_changes({order_code: (-count, None) for order_code, count in reviewed.items()})
+        events.publish(events.NODE_REVIEWED, [nodes[node_id][0] for node_id in found], nodeIds=found)
+
+        return schemas.ShipmentsReviewBatchResult(
+            reviewed=len(found),
+            results=[schemas.ShipmentsReviewBatchOutcome(id=node_id, status="REVIEWED" if node_id in nodes else "NOT_FOUND")
+                     for node_id in ids],
+        )
 
 
 class AddNode:
@@ -159,8 +271,8 @@ class AddNode:
         item = self.item.model_dump(by_alias=True)
         # 添加额外的字段
         item["order_code"] = self.item.orderCode
-        # 随机生成一个唯一id
-        item["node_id"] = str(int(time.time())) + str(random.randint(100, 1000))
+        # 全局唯一的节点id(Snowflake) 并发添加时不会撞上 (order_code, node_id) 唯一索引
+        item["node_id"] = str(idgen.next_id())
         item["track_content"] = self.item.trackContent  # 人工轨迹文本说明
         item["artificial_review_time"] = datetime.now()
         item["identify_status"] = "COMPLETE"  # 人工已审核
@@ -170,5 +282,8 @@ class AddNode:
         item['update_time'] = datetime.now()
         # 审核人姓名
 
-        # 执行添加操作
-        ShipmentFirstLegTracking.create(**item)
+        # 执行添加操作 同时推进订单的最新轨迹时间
+        with database.atomic():
+            node = ShipmentFirstLegTracking.create(**item)
+            pending.apply_changes(pending.node_changes([(item["order_code"], item["identify_status"], item["track_time"])]))
+        events.publish(events.NODE_ADDED, [item["order_code"]], nodeIds=[node.id])
@@ -1,14 +1,23 @@
-from flask import blueprints
+from flask import blueprints, current_app, request, stream_with_context
 from flask_pydantic import validate
 
-from apps.shipments.exception import ExceptionList, ExceptionLogs, ExceptionsProcessing
-from apps.shipments.order import OrderList, OrderDetail, OrderModify
+from apps import events
+from apps.models import database_stats
+from apps.shipments.blobs import OrderTrackHistory
+from apps.shipments.changes import ChangeFeed
+from apps.shipments.exception import ExceptionList, ExceptionLogs, ExceptionsProcessing, ExceptionsBatchProcessing, \
+    ExceptionTimeline
+from apps.shipments.order import OrderList, OrderExport, OrderDetail, OrderModify, OrderBatchModify, OrderIngest, \
+    order_detail_cache
+from apps.shipments.rollups import ExceptionRollups
 from apps.shipments.schemas import *
-from apps.shipments.track import TrackingNodes, PendingList, TrackReview, AddNode
+from apps.shipments.totals import totals_cache
+from apps.shipments.track import TrackingNodes, TrackingNodesBatch, PendingList, TrackReview, TrackBatchReview, AddNode
 
 order_bp = blueprints.Blueprint("order", __name__)
 track_bp = blueprints.Blueprint("track", __name__)
 exception_bp = blueprints.Blueprint("exception", __name__)
+system_bp = blueprints.Blueprint("system", __name__)
 
 
 @order_bp.route("/orders", methods=["GET"])
@@ -20,6 +29,34 @@ def orders(query: ShipmentsOrdersRequest):
     return Response(result=content)
 
 
+@order_bp.route("/orders/export", methods=["GET"])
+@validate()
+def orders_export(query: ShipmentsOrdersExportRequest):
+    """按订单列表的筛选条件流式导出全部订单(CSV/NDJSON)"""
+    export = OrderExport(filters=query)
+    return current_app.response_class(
+        stream_with_context(export.stream()),
+        mimetype=export.mimetype,
+        headers={"Content-Disposition": f"attachment; filename={export.filename}"},
+    )
+
+
+@order_bp.route("/orders/bulk", methods=["POST"])
+@validate()
+def orders_bulk(body: ShipmentsOrderIngestRequest):
+    """批量导入订单 按订单号新增或更新"""
+    result = OrderIngest(orders=body.orders).ingest()
+    return Response(result=result)
+
+
+@order_bp.route("/orders/batch-modify", methods=["PUT"])
+@validate()
+def orders_batch_modify(body: ShipmentsOrderBatchUpdateRequest):
+    """批量修改订单信息 返回不存在的订单号"""
+    result = OrderBatchModify(items=body.items).modify()
+    return Response(result=result)
+
+
 @order_bp.route("/orders/<order_code>", methods=["GET"])
 @validate()
 def order_detail(order_code: str):
@@ -28,6 +65,14 @@ def order_detail(order_code: str):
     return Response(result=result)
 
 
+@order_bp.route("/orders/<order_code>/track-history", methods=["GET"])
+@validate()
+def order_track_history(order_code: str):
+    """获取订单的头程完整轨迹和轨迹历史(不随订单详情返回)"""
+    result = OrderTrackHistory(order_code=order_code).get_history()
+    return Response(result=result)
+
+
 @order_bp.route("/orders/<order_code>/modify", methods=["PUT"])
 @validate()
 def order_modify(order_code: str, body: ShipmentsOrderUpdateRequest):
@@ -40,10 +85,38 @@ def order_modify(order_code: str, body: ShipmentsOrderUpdateRequest):
 @validate()
 def nodes(order_code: str, query: ShipmentsTrackingRequest):
     """根据订单号获取所有轨迹节点列表"""
-    result = TrackingNodes(order_code=order_code, filters=query).get_tracking()
+    tracking = TrackingNodes(order_code=order_code, filters=query)
+    # 轮询时客户端带上次的ETag 节点没有变化则直接返回304 不加载也不序列化节点
+    etag, headers = tracking.get_validators()
+    if request.if_none_match.contains(etag):
+        return current_app.response_class(status=304, headers=headers)
+    result = tracking.get_tracking()
+    return Response(result=result), headers
+
+
+@track_bp.route("/first-leg-tracking/nodes/batch", methods=["POST"])
+@validate()
+def nodes_batch(body: ShipmentsTrackingBatchRequest):
+    """一次获取多个订单的轨迹节点 返回 订单号 -> 节点列表"""
+    result = TrackingNodesBatch(filters=body).get_tracking()
     return Response(result=result)
 
 
+@track_bp.route("/first-leg-tracking/events", methods=["GET"])
+@validate()
+def node_events(query: ShipmentsEventsRequest):
+    """节点变更事件流(SSE) 待审核页面收到事件后只刷新受影响的订单"""
+    last_event_id = request.headers.get("Last-Event-ID", type=int)
+    if last_event_id is None:
+        last_event_id = query.lastEventId
+    # 不用 stream_with_context: 请求结束后连接立即归还连接池 流式响应期间不占用数据库连接
+    return current_app.response_class(
+        events.stream(last_event_id),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @track_bp.route("/first-leg-tracking/orders", methods=["GET"])
 @validate()
 def pending(query: ShipmentsPendingRequest):
@@ -60,6 +133,14 @@ def review(id: int, body: ShipmentsReviewPostRequest):
     return Response()
 
 
+@track_bp.route("/first-leg-tracking/batch-review", methods=["POST"])
+@validate()
+def batch_review(body: ShipmentsReviewBatchRequest):
+    """批量提交人工审核 返回每个节点的结果"""
+    result = TrackBatchReview(items=body.items).submit()
+    return Response(result=result)
+
+
 @track_bp.route("/first-leg-tracking/add", methods=["POST"])
 @validate()
 def add_node(body: ShipmentsAddNodeRequest):
@@ -84,9 +165,52 @@ def exception_processing(exception_id: int, body: ShipmentsExceptionsProcessingR
     return Response()
 
 
+@exception_bp.route("/exceptions/batch-processing", methods=["POST"])
+@validate()
+def exception_batch_processing(body: ShipmentsExceptionsBatchProcessingRequest):
+    """批量异常操作 返回每个异常的结果"""
+    result = ExceptionsBatchProcessing(items=body.items).processing()
+    return Response(result=result)
+
+
+@exception_bp.route("/exceptions/timeline", methods=["GET"])
+@validate()
+def exception_timeline(query: ShipmentsExceptionTimelineRequest):
+    """一页异常连同各自的处置记录 按游标翻页"""
+    content = ExceptionTimeline(filters=query).get_timeline()
+    return Response(result=content)
+
+
+@exception_bp.route("/exceptions/rollups", methods=["GET"])
+@validate()
+def exception_rollups():
+    """看板: 按 (异常类型, 异常节点, 处置状态, 物流商) 分组的异常数"""
+    content = ExceptionRollups().get_tiles()
+    return Response(result=content)
+
+
 @exception_bp.route("/exceptions/logs", methods=["GET"])
 @validate()
 def exception_logs(query: ShipmentsExceptionsLogsRequest):
     """获取异常日志列表"""
     content = ExceptionLogs(filters=query).get_logs()
     return Response(result=content)
+
+
+@system_bp.route("/changes", methods=["GET"])
+@validate()
+def changes(query: ShipmentsChangesRequest):
+    """轨迹节点/异常/订单的变更流 按游标增量读取"""
+    result = ChangeFeed(filters=query).get_changes()
+    return Response(result=result)
+
+
+@system_bp.route("/stats", methods=["GET"])
+@validate()
+def stats():
+    """运行状态统计 数据库连接池和各缓存"""
+    return Response(result={
+        "dbPool": database_stats(),
+        "listTotals": totals_cache.stats(),
+        "orderDetailCache": order_detail_cache.stats(),
+    })
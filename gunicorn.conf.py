@@ -0,0 +1,37 @@
+"""
+gunicorn 配置
+    gunicorn -c gunicorn.conf.py apps.app:app
+
+    worker 用 gevent 协程: SSE 长连接(/shipments/first-leg-tracking/events)空闲时不占用线程, 单个 worker 可以挂住上千个连接
+    多个 worker(以及轨迹入库/自动采纳等命令行任务)之间的事件分发需要配置 EVENTS_REDIS_URL, 见 apps/events.py
+    订单详情缓存的失效要在 worker 和命令行任务之间生效需要配置 CACHE_REDIS_URL, 见 apps/cache.py
+    ID_WORKER_ID: 本主机(容器)的 worker id 起始值, 每个 worker 使用 起始值 + 槽位号(0 ~ workers-1),
+        不同主机的区间 [ID_WORKER_ID, ID_WORKER_ID + workers) 不能重叠
+"""
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:65010")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+worker_class = "gevent"
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "2000"))
+# SSE 连接会一直保持 不能被同步 worker 的请求超时回收; gevent worker 的 timeout 只用于心跳检测
+timeout = 30
+graceful_timeout = 30
+
+
+def on_starting(server):
+    # master 启动时就检查 不等 worker 导入应用时才失败
+    if "ID_WORKER_ID" not in os.environ:
+        raise RuntimeError("ID_WORKER_ID is not set: it is the first worker id of this host")
+
+
+def pre_fork(server, worker):
+    # 槽位号在 worker 重启后复用 保证 worker id 始终落在本主机的区间内
+    used = {w.id_slot for w in server.WORKERS.values()}
+    worker.id_slot = min(set(range(server.num_workers + 1)) - used)
+
+
+def post_fork(server, worker):
+    from apps import idgen
+
+    idgen.configure(int(os.environ["ID_WORKER_ID"]) + worker.id_slot)
@@ -0,0 +1,48 @@
+"""测试公共夹具: 把全部模型绑定到内存SQLite库 并记录执行过的SQL"""
+import os
+
+# 导入应用之前: 默认库换成SQLite(不需要MySQL驱动) 并提供 worker id
+os.environ.setdefault("DB_ENGINE", "sqlite")
+os.environ.setdefault("DB_NAME", ":memory:")
+os.environ.setdefault("ID_WORKER_ID", "0")
+
+import pytest
+from peewee import SqliteDatabase
+
+from apps import models
+
+MODELS = [value for value in vars(models).values()
+          if isinstance(value, type) and issubclass(value, models.BaseModel) and value is not models.BaseModel]
+
+
+class RecordingSqliteDatabase(SqliteDatabase):
+    """记录每条执行的SQL 用于断言语句数和语句内容"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = []
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        self.statements.append(sql)
+        return super().execute_sql(sql, params, *args, **kwargs)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    from apps.shipments import order, totals
+
+    # 进程级的缓存每个测试重新开始: 语句数断言依赖总数/详情缓存未命中 不能受测试顺序影响
+    monkeypatch.setattr(totals, "totals_cache", totals.TotalsCache())
+    order.order_detail_cache.backend.clear()
+    database = RecordingSqliteDatabase(":memory:")
+    with database.bind_ctx(MODELS):
+        database.create_tables(MODELS)
+        database.statements.clear()
+        yield database
+
+
+@pytest.fixture
+def client(db):
+    from apps.app import app
+
+    return app.test_client()
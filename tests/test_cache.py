@@ -0,0 +1,48 @@
+"""读穿缓存: 加载期间被失效的旧值不写回 失效对共享后端的所有使用方生效"""
+import pytest
+
+from apps.cache import LocalBackend, ReadThroughCache
+
+
+def test_invalidate_during_load_discards_the_loaded_value():
+    cache = ReadThroughCache(LocalBackend(), ttl=60)
+
+    def stale_loader():
+        # 加载读到旧值之后 并发的写操作提交并让缓存失效
+        cache.invalidate("OC1")
+        return "old"
+
+    assert cache.get("OC1", stale_loader) == "old"
+    assert cache.get("OC1", lambda: "new") == "new"
+    assert cache.get("OC1", lambda: "unused") == "new"
+
+
+def test_generation_is_bounded_by_maxsize():
+    backend = LocalBackend(maxsize=2)
+    for key in ("a", "b", "c"):
+        backend.invalidate(key)
+    assert backend.generation("a") == 0
+    assert backend.generation("c") == 1
+
+
+def test_redis_backend_shares_invalidation_between_processes(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = pytest.importorskip("redis")
+    from apps.cache import RedisBackend
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url", classmethod(lambda cls, url: fakeredis.FakeRedis(server=server)))
+    # 两个进程(web worker / 命令行任务)各自的缓存对象
+    web = ReadThroughCache(RedisBackend("redis://"), ttl=60, prefix="order:")
+    job = ReadThroughCache(RedisBackend("redis://"), ttl=60, prefix="order:")
+
+    assert web.get("OC1", lambda: {"status": "old"}) == {"status": "old"}
+    job.invalidate("OC1")
+    assert web.get("OC1", lambda: {"status": "new"}) == {"status": "new"}
+
+    def stale_loader():
+        job.invalidate("OC2")
+        return "old"
+
+    web.get("OC2", stale_loader)
+    assert web.get("OC2", lambda: "new") == "new"
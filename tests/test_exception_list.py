@@ -0,0 +1,85 @@
+"""异常列表/处置记录只在筛选条件需要时才关联订单表和异常表"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from apps.models import ShipmentExceptionHandle, ShipmentOrderException, ShipmentOrderInfo
+from apps.shipments import schemas
+from apps.shipments.exception import ExceptionList, ExceptionLogs
+
+
+@pytest.fixture
+def seeded(db):
+    base = datetime(2025, 1, 1)
+    ShipmentOrderInfo.insert_many([{
+        "order_code": f"OC{i}", "first_leg_tracking_number": f"FL{i}", "shipment_name": f"S{i % 2}",
+        "provider_code": f"P{i % 2}", "warehouse_code": "W", "add_time": base, "create_time": base, "update_time": base,
+    } for i in range(4)]).execute()
+    ShipmentOrderException.insert_many([{
+        "order_code": f"OC{i}", "exception_type": "T", "exception_node": "N", "status": "待处理",
+        "create_time": base + timedelta(hours=i), "update_time": base,
+    } for i in range(4)]).execute()
+    ShipmentExceptionHandle.insert_many([{
+        "exception_id": i + 1, "order_code": f"OC{i}", "content": "c", "status": "处理中", "operator_uid": 1,
+        "operator_name": "admin", "create_time": base + timedelta(hours=i), "update_time": base,
+    } for i in range(4)]).execute()
+    db.statements.clear()
+    return db
+
+
+def scanned_tables(db, query) -> int:
+    """EXPLAIN QUERY PLAN 中扫描/查找的表数 每张参与查询的表一行 SCAN/SEARCH"""
+    sql, params = query.sql()
+    plan = [row[-1] for row in db.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+    return sum(detail.startswith(("SCAN", "SEARCH")) for detail in plan)
+
+
+def test_exception_list_without_order_filter_has_no_join(seeded):
+    query = ExceptionList(schemas.ShipmentsExceptionsRequest()).query
+    assert "JOIN" not in query.sql()[0]
+    assert scanned_tables(seeded, query) == 1
+
+
+@pytest.mark.parametrize("filters", [{"firstLegTrackingNumber": "FL1"}, {"shipmentName": "S1"}])
+def test_exception_list_joins_for_order_filters(seeded, filters):
+    query = ExceptionList(schemas.ShipmentsExceptionsRequest(**filters)).query
+    assert "JOIN" in query.sql()[0]
+    assert scanned_tables(seeded, query) == 2
+
+
+def test_exception_list_page_fills_order_columns_with_one_lookup(seeded):
+    result = ExceptionList(schemas.ShipmentsExceptionsRequest(pageSize=2)).get_list()
+    # count + 一页异常 + 一次订单表 IN 查询
+    assert len(seeded.statements) == 3
+    assert all("JOIN" not in sql for sql in seeded.statements)
+    assert [(item.orderCode, item.firstLegTrackingNumber, item.providerCode) for item in result.content] == [
+        ("OC3", "FL3", "P1"), ("OC2", "FL2", "P0"),
+    ]
+
+
+def test_exception_list_order_filter_results(seeded):
+    result = ExceptionList(schemas.ShipmentsExceptionsRequest(shipmentName="S1")).get_list()
+    assert result.totalElements == 2
+    assert {item.orderCode for item in result.content} == {"OC1", "OC3"}
+
+
+def test_exception_logs_without_order_filter_has_no_join(seeded):
+    for filters in ({}, {"exceptionId": 2}):
+        query = ExceptionLogs(schemas.ShipmentsExceptionsLogsRequest(**filters)).query
+        assert "JOIN" not in query.sql()[0]
+        assert scanned_tables(seeded, query) == 1
+
+
+def test_exception_logs_joins_only_order_table_for_order_filters(seeded):
+    query = ExceptionLogs(schemas.ShipmentsExceptionsLogsRequest(firstLegTrackingNumber="FL1")).query
+    sql = query.sql()[0]
+    assert '"shipment_order_info"' in sql and '"shipment_order_exception"' not in sql
+    assert scanned_tables(seeded, query) == 2
+
+
+def test_exception_logs_page_fills_join_columns(seeded):
+    result = ExceptionLogs(schemas.ShipmentsExceptionsLogsRequest(exceptionId=2)).get_logs()
+    # count + 一页处置记录 + 订单表/异常表各一次 IN 查询
+    assert len(seeded.statements) == 4
+    [item] = result.content
+    assert (item.firstLegTrackingNumber, item.exceptionType, item.createTime) == ("FL1", "T", datetime(2025, 1, 1, 1))
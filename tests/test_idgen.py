@@ -0,0 +1,60 @@
+"""id生成器: 多进程压测没有重复 以及 worker id 缺失/沿用父进程时报错"""
+import multiprocessing
+
+import pytest
+
+from apps import idgen
+
+PROCESSES = 4
+COUNT = 50000  # 每个进程生成的id数 远超单毫秒的序列上限 覆盖序列用完借用下一毫秒的路径
+
+
+def generate(worker_id, count):
+    """(fork 出的子进程)用自己的 worker id 生成 count 个id"""
+    idgen.configure(worker_id)
+    return [idgen.next_id() for _ in range(count)]
+
+
+def forked_child_refuses():
+    """(fork 出的子进程)没有 configure() 时不能沿用父进程的 worker id"""
+    try:
+        idgen.next_id()
+    except RuntimeError:
+        return True
+    return False
+
+
+@pytest.fixture
+def fork():
+    return multiprocessing.get_context("fork")
+
+
+def test_forked_workers_generate_unique_ids(fork):
+    with fork.Pool(PROCESSES) as pool:
+        chunks = pool.starmap(generate, [(worker_id, COUNT) for worker_id in range(1, PROCESSES + 1)])
+
+    for worker_id, ids in enumerate(chunks, 1):
+        assert all(a < b for a, b in zip(ids, ids[1:])), f"worker {worker_id}: ids are not monotonic"
+        assert {(i >> idgen.SEQUENCE_BITS) & idgen.MAX_WORKER_ID for i in ids} == {worker_id}
+    ids = [i for chunk in chunks for i in chunk]
+    assert len(ids) == PROCESSES * COUNT
+    assert len(set(ids)) == len(ids)
+
+
+def test_forked_child_without_configure_refuses(fork, monkeypatch):
+    monkeypatch.setenv("ID_WORKER_ID", "0")
+    idgen.next_id()  # 父进程已经在生成id
+    with fork.Pool(1) as pool:
+        assert pool.apply(forked_child_refuses)
+
+
+def test_missing_worker_id_refuses(monkeypatch):
+    monkeypatch.delenv("ID_WORKER_ID", raising=False)
+    monkeypatch.setattr(idgen, "_generator", None)
+    with pytest.raises(RuntimeError, match="ID_WORKER_ID"):
+        idgen.check()
+
+
+def test_worker_id_out_of_range():
+    with pytest.raises(ValueError):
+        idgen.SnowflakeGenerator(idgen.MAX_WORKER_ID + 1)
@@ -0,0 +1,55 @@
+"""三元组子串搜索: 回填前用 LIKE, 候选id先查出来再按主键校验, % _ 按字面匹配"""
+from datetime import datetime
+
+import pytest
+
+from apps.models import ShipmentOrderInfo
+from apps.shipments import ngram
+
+O = ShipmentOrderInfo
+
+
+@pytest.fixture
+def orders(db):
+    now = datetime(2025, 1, 1)
+    O.insert_many([{
+        "order_code": f"OC{i:04d}", "first_leg_tracking_number": number, "shipment_name": "S", "provider_code": "P",
+        "warehouse_code": "W", "add_time": now, "create_time": now, "update_time": now,
+    } for i, number in enumerate(["FLX_1%", "FLXA1B", "ZZABCD", "ZZABXD"])]).execute()
+    return db
+
+
+def search(term):
+    return sorted(number for number, in O.select(O.first_leg_tracking_number)
+                  .where(ngram.contains(O.first_leg_tracking_number, term)).tuples())
+
+
+def test_like_before_backfill(orders):
+    assert search("ABC") == ["ZZABCD"]
+    assert "shipment_order_ngram" not in " ".join(orders.statements)
+
+
+@pytest.mark.parametrize("backfilled", [False, True])
+def test_wildcards_match_literally(orders, backfilled):
+    if backfilled:
+        ngram.backfill()
+    assert search("X_1") == ["FLX_1%"]
+    assert search("_") == ["FLX_1%"]
+    assert search("1%") == ["FLX_1%"]
+
+
+def test_candidates_are_resolved_before_the_main_query(orders):
+    ngram.backfill()
+    orders.statements.clear()
+    assert search("ZZAB") == ["ZZABCD", "ZZABXD"]
+    main = orders.statements[-1]
+    # 主查询只有 id IN (字面量列表) 没有子查询
+    assert main.count("SELECT") == 1 and '"id" IN (' in main
+
+
+def test_too_many_candidates_fall_back_to_like(orders, monkeypatch):
+    ngram.backfill()
+    monkeypatch.setattr(ngram, "MAX_CANDIDATES", 1)
+    orders.statements.clear()
+    assert search("ZZAB") == ["ZZABCD", "ZZABXD"]
+    assert '"id" IN (' not in orders.statements[-1]
@@ -0,0 +1,46 @@
+"""游标分页: 非法游标在请求校验阶段返回400, 翻页走 (create_time, id) 索引"""
+from datetime import datetime, timedelta
+
+import pydantic
+import pytest
+
+from apps.models import ShipmentOrderInfo
+from apps.shipments import schemas
+from apps.shipments.order import OrderList
+from apps.shipments.pagination import after_cursor, encode_cursor
+
+
+@pytest.mark.parametrize("after", ["not-a-cursor", "W10", encode_cursor(datetime(2025, 1, 1), 1)[:-3]])
+def test_malformed_cursor_is_rejected_by_schema(after):
+    with pytest.raises(pydantic.ValidationError):
+        schemas.ShipmentsOrdersRequest(after=after)
+
+
+def test_malformed_cursor_returns_400(client):
+    for path in ("/shipments/orders", "/shipments/exceptions", "/shipments/exceptions/logs",
+                 "/shipments/changes?feed=orders&"):
+        separator = "" if path.endswith("&") else "?"
+        response = client.get(f"{path}{separator}after=garbage")
+        assert response.status_code == 400, path
+
+
+def test_cursor_page_uses_create_time_index(db):
+    base = datetime(2025, 1, 1)
+    ShipmentOrderInfo.insert_many([{
+        "order_code": f"OC{i}", "first_leg_tracking_number": f"FL{i}", "shipment_name": "S", "provider_code": "P",
+        "warehouse_code": "W", "add_time": base, "create_time": base + timedelta(hours=i), "update_time": base,
+    } for i in range(5)]).execute()
+    filters = schemas.ShipmentsOrdersRequest(cursor=True, pageSize=2)
+    page, next_cursor = OrderList(filters).get_cursor_details()
+    assert [item.orderCode for item in page] == ["OC4", "OC3"]
+
+    filters = schemas.ShipmentsOrdersRequest(cursor=True, pageSize=2, after=next_cursor)
+    page, _ = OrderList(filters).get_cursor_details()
+    assert [item.orderCode for item in page] == ["OC2", "OC1"]
+
+    # 后面的页也是沿索引的范围扫描 不需要排序
+    sql, params = after_cursor(OrderList(filters).query, ShipmentOrderInfo.create_time, ShipmentOrderInfo.id,
+                               next_cursor).limit(3).sql()
+    plan = [row[-1] for row in db.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+    assert any("create_time_id" in detail for detail in plan), plan
+    assert not any("TEMP B-TREE" in detail for detail in plan), plan
@@ -0,0 +1,70 @@
+"""连接池统计: 用SQLite连接池验证 取出/归还连接 以及池满等待的计数 和 /shipments/system/stats 的输出"""
+import threading
+
+import pytest
+from playhouse.pool import MaxConnectionsExceeded
+
+from apps import models
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    database = models.StatsPooledSqliteDatabase(str(tmp_path / "pool.db"), max_connections=1, timeout=0.05)
+    # database_stats() 读取的是 apps.models.database
+    monkeypatch.setattr(models, "database", database)
+    with database.bind_ctx([models.ShipmentJobState]):
+        yield database
+    database.close_all()
+
+
+def test_checkout_and_return(pool):
+    assert models.database_stats() == {"pooled": True, "maxConnections": 1, "inUse": 0, "idle": 0, "waits": 0}
+
+    pool.connect()
+    models.ShipmentJobState.create_table()
+    assert models.database_stats()["inUse"] == 1
+    assert models.database_stats()["idle"] == 0
+
+    pool.close()
+    stats = models.database_stats()
+    assert (stats["inUse"], stats["idle"]) == (0, 1)
+
+    # 再次取出时复用空闲连接
+    pool.connect()
+    assert (models.database_stats()["inUse"], models.database_stats()["idle"]) == (1, 0)
+    pool.close()
+
+
+def test_waits_when_pool_is_full(pool):
+    pool.connect()
+    errors = []
+
+    def other_request():
+        try:
+            pool.connect()
+        except MaxConnectionsExceeded as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=other_request)
+    thread.start()
+    thread.join()
+    assert len(errors) == 1
+    assert models.database_stats()["waits"] == 1
+    pool.close()
+
+
+def test_system_stats_endpoint(client):
+    # 应用默认库(DB_ENGINE=sqlite)就是 StatsPooledSqliteDatabase 请求期间由 FlaskDB 取出连接 请求结束后归还
+    database = models.database
+    assert isinstance(database, models.StatsPooledSqliteDatabase)
+    assert database.is_closed()
+
+    result = client.get("/shipments/stats").get_json()["result"]
+    assert result["dbPool"]["pooled"] is True
+    assert result["dbPool"]["inUse"] == 1
+    assert result["dbPool"]["idle"] == 0
+
+    stats = models.database_stats()
+    assert (stats["inUse"], stats["idle"]) == (0, 1)
+    assert {"hits", "misses"} <= set(result["listTotals"])
+    assert {"hits", "misses", "ttl"} <= set(result["orderDetailCache"])
@@ -0,0 +1,57 @@
+"""SLA增量检测: 每个条件单独走索引 自身标记异常的写入不会让下一次运行重新检测"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from apps.models import ShipmentOrderException, ShipmentOrderInfo
+from apps.shipments import jobstate, sla
+
+O = ShipmentOrderInfo
+
+
+@pytest.fixture
+def orders(db):
+    now = datetime.now().replace(microsecond=0)
+    O.insert_many([{
+        "order_code": f"OC{i}", "first_leg_tracking_number": f"FL{i}", "shipment_name": "S", "provider_code": "P",
+        "warehouse_code": "W", "add_time": now, "create_time": now - timedelta(days=30),
+        "update_time": now - timedelta(days=30),
+        # OC0 轨迹停滞 其余订单最近有轨迹
+        "latest_track_time": now - timedelta(days=10 if i == 0 else 1),
+    } for i in range(5)]).execute()
+    return db
+
+
+def test_incremental_run_skips_the_engines_own_writes(orders):
+    assert sla.SlaEngine(full=True).run()["exceptions"] == 1
+    assert O.get(O.order_code == "OC0").is_exception == 1
+    # 标记异常更新了 OC0 的 update_time, 但那是引擎自己的写入
+    assert sla.SlaEngine().run()["orders"] == 0
+
+    O.update(remark="changed", update_time=datetime.now() + timedelta(seconds=1)).where(O.order_code == "OC3").execute()
+    result = sla.SlaEngine().run()
+    assert result["orders"] == 1 and result["exceptions"] == 0
+    assert ShipmentOrderException.select().count() == 1
+
+
+def test_incremental_lookups_use_indexes(orders):
+    jobstate.set_watermark(sla.JOB_NAME, datetime.now() - timedelta(hours=1))
+    orders.statements.clear()
+    sla.SlaEngine().run()
+    lookups = [sql for sql in orders.statements if sql.startswith('SELECT "t1"."id"') and "IN (" not in sql]
+    assert len(lookups) == 5
+    for sql in lookups:
+        assert " OR " not in sql
+        params = [datetime.now()] * sql.count("?")
+        plan = " ".join(row[-1] for row in orders.execute_sql("EXPLAIN QUERY PLAN " + sql, params))
+        assert plan.startswith("SEARCH") and "INDEX" in plan, (sql, plan)
+
+
+def test_flagging_keeps_up_to_date_aging_current(orders):
+    from apps.shipments.aging import AgingEngine
+
+    AgingEngine().run()
+    sla.SlaEngine(full=True).run()
+    flagged = O.get(O.order_code == "OC0")
+    assert flagged.aging_time == flagged.update_time
+    assert AgingEngine().run()["orders"] == 0